@@ -18,6 +18,7 @@ from mitmproxy.coretypes import basethread
 from mitmproxy.net import server_spec, tls
 from mitmproxy.net.http import http1
 from mitmproxy.net.http.url import hostport
+from mitmproxy.proxy import pool
 from mitmproxy.utils import human
 
 
@@ -88,25 +89,35 @@ class RequestReplayThread(basethread.BaseThread):
                         r.authority = hostport(r.scheme, r.host, r.port)
                 else:
                     server_address = (r.host, r.port)
-                    server = connections.ServerConnection(server_address)
-                    server.connect()
-                    if r.scheme == "https":
-                        server.establish_tls(
-                            sni=f.server_conn.sni,
-                            **tls.client_arguments_from_options(self.options)
-                        )
+                    key = pool.server_key(server_address, r.scheme == "https", f.server_conn.sni)
+                    server = pool.server_pool.acquire(key)
+                    if server is None:
+                        server = connections.ServerConnection(server_address)
+                        server.connect()
+                        if r.scheme == "https":
+                            server.establish_tls(
+                                sni=f.server_conn.sni,
+                                **tls.client_arguments_from_options(self.options)
+                            )
+                        server.pool_key = key
                     r.authority = ""
 
                 server.wfile.write(http1.assemble_request(r))
                 server.wfile.flush()
                 r.timestamp_start = r.timestamp_end = time.time()
 
-                if f.server_conn:
+                # Pooled connections may already be in use by someone else.
+                if f.server_conn and f.server_conn.pool_key is None:
                     f.server_conn.close()
                 f.server_conn = server
 
                 f.response = http1.read_response(
                     server.rfile, r, body_size_limit=bsl)
+                server.reusable = not (
+                    http1.connection_close(r.http_version, r.headers) or
+                    http1.connection_close(f.response.http_version, f.response.headers) or
+                    http1.expected_http_body_size(r, f.response) == -1
+                )
             response_reply = self.channel.ask("response", f)
             if response_reply == exceptions.Kill:
                 raise exceptions.Kill()
@@ -121,7 +132,7 @@ class RequestReplayThread(basethread.BaseThread):
         finally:
             r.authority = authority_backup
             f.live = False
-            if server and server.connected():
+            if server and server.connected() and not (server.reusable and pool.server_pool.release(server)):
                 server.finish()
                 server.close()
 
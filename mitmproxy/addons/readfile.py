@@ -5,6 +5,7 @@ import typing
 
 from mitmproxy import ctx
 from mitmproxy import exceptions
+from mitmproxy import flow
 from mitmproxy import flowfilter
 from mitmproxy import io
 from mitmproxy import command
@@ -40,13 +41,15 @@ class ReadFile:
             self.filter = filt
 
     async def load_flows(self, fo: typing.IO[bytes]) -> int:
+        return await self._load_flows(io.FlowReader(fo).stream())
+
+    async def _load_flows(self, flows: typing.Iterable[flow.Flow]) -> int:
         cnt = 0
-        freader = io.FlowReader(fo)
         try:
-            for flow in freader.stream():
-                if self.filter and not self.filter(flow):
+            for f in flows:
+                if self.filter and not self.filter(f):
                     continue
-                await ctx.master.load_flow(flow)
+                await ctx.master.load_flow(f)
                 cnt += 1
         except (OSError, exceptions.FlowReadException) as e:
             if cnt:
@@ -59,12 +62,11 @@ class ReadFile:
 
     async def load_flows_from_path(self, path: str) -> int:
         path = os.path.expanduser(path)
-        try:
-            with open(path, "rb") as f:
-                return await self.load_flows(f)
-        except OSError as e:
-            ctx.log.error(f"Cannot load flows: {e}")
-            raise exceptions.FlowReadException(str(e)) from e
+        if not os.access(path, os.R_OK):
+            ctx.log.error(f"Cannot load flows: {path} is not readable.")
+            raise exceptions.FlowReadException(f"{path} is not readable.")
+        # Without proxy server, large files are decoded by worker processes; flows still arrive in order.
+        return await self._load_flows(io.stream_flows_from_paths([path], ctx.options.flow_load_processes))
 
     async def doread(self, rfile):
         self.is_reading = True
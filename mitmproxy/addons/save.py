@@ -25,6 +25,28 @@ class Save:
             "save_stream_filter", typing.Optional[str], None,
             "Filter which flows are written to file."
         )
+        loader.add_option(
+            "save_index", bool, False,
+            """
+            Write an index next to saved flow files (<path>.idx), so that
+            single flows can be looked up without reading the whole file.
+            """
+        )
+        loader.add_option(
+            "save_compress", bool, False,
+            """
+            Write zstd-compressed flow files. Flows appended to an existing
+            file are written in the format of that file.
+            """
+        )
+        loader.add_option(
+            "save_compress_dict", typing.Optional[str], None,
+            """
+            zstd dictionary for compressed flow files, e.g. trained with
+            `zstd --train` on dumped request and response headers. By
+            default, a dictionary is trained from the first flows of each file.
+            """
+        )
 
     def open_file(self, path):
         if path.startswith("+"):
@@ -35,12 +57,44 @@ class Save:
         path = os.path.expanduser(path)
         return open(path, mode)
 
+    def compress(self, f) -> bool:
+        """
+        Whether to write the opened flow file f compressed.
+        """
+        if f.tell() == 0:
+            return ctx.options.save_compress
+        with open(f.name, "rb") as existing:
+            return io.compressed.is_compressed(existing)
+
+    def dictionary(self) -> typing.Optional[bytes]:
+        if not ctx.options.save_compress_dict:
+            return None
+        with open(os.path.expanduser(ctx.options.save_compress_dict), "rb") as f:
+            return f.read()
+
+    def writer(self, f, flt=None):
+        """
+        A writer for the opened flow file f, with an index if save_index is set.
+        """
+        try:
+            compress = self.compress(f)
+            dictionary = self.dictionary() if compress else None
+            index_fo = open(io.index.index_path(f.name), f.mode) if ctx.options.save_index else None
+        except OSError:
+            f.close()
+            raise
+        if index_fo:
+            return io.IndexedFlowWriter(f, index_fo, flt, compress, dictionary)
+        if compress:
+            return io.ZstdFlowWriter(f, flt, dictionary=dictionary)
+        return io.FilteredFlowWriter(f, flt)
+
     def start_stream_to_path(self, path, flt):
         try:
             f = self.open_file(path)
+            self.stream = self.writer(f, flt)
         except OSError as v:
             raise exceptions.OptionsError(str(v))
-        self.stream = io.FilteredFlowWriter(f, flt)
         self.active_flows = set()
 
     def configure(self, updated):
@@ -54,7 +108,8 @@ class Save:
                     )
             else:
                 self.filt = None
-        if "save_stream_file" in updated or "save_stream_filter" in updated:
+        restart = {"save_stream_file", "save_stream_filter", "save_index", "save_compress", "save_compress_dict"}
+        if restart & set(updated):
             if self.stream:
                 self.done()
             if ctx.options.save_stream_file:
@@ -68,12 +123,12 @@ class Save:
         """
         try:
             f = self.open_file(path)
+            stream = self.writer(f)
         except OSError as v:
             raise exceptions.CommandError(v) from v
-        stream = io.FlowWriter(f)
         for i in flows:
             stream.add(i)
-        f.close()
+        self.close(stream)
         ctx.log.alert("Saved %s flows." % len(flows))
 
     def tcp_start(self, flow):
@@ -108,5 +163,11 @@ class Save:
             for f in self.active_flows:
                 self.stream.add(f)
             self.active_flows = set()
-            self.stream.fo.close()
+            self.close(self.stream)
             self.stream = None
+
+    @staticmethod
+    def close(stream):
+        stream.fo.close()
+        if isinstance(stream, io.IndexedFlowWriter):
+            stream.index_fo.close()
@@ -94,6 +94,7 @@ class ServerPlayback:
     @command.command("replay.server.file")
     def load_file(self, path: mitmproxy.types.Path) -> None:
         try:
+            # The proxy is running: no worker processes, see io.parallel.
             flows = io.read_flows_from_paths([path])
         except exceptions.FlowReadException as e:
             raise exceptions.CommandError(str(e))
@@ -191,7 +192,9 @@ class ServerPlayback:
         if not self.configured and ctx.options.server_replay:
             self.configured = True
             try:
-                flows = io.read_flows_from_paths(ctx.options.server_replay)
+                flows = list(io.stream_flows_from_paths(
+                    ctx.options.server_replay, ctx.options.flow_load_processes
+                ))
             except exceptions.FlowReadException as e:
                 raise exceptions.OptionsError(str(e))
             self.load_flows(flows)
@@ -6,6 +6,7 @@ import bisect
 import shutil
 import sqlite3
 import copy
+import hashlib
 import os
 
 from mitmproxy import flowfilter
@@ -29,6 +30,46 @@ class KeyifyList:
         return self.key(self.inner[k])
 
 
+class _BlobBatch:
+    """
+    Reference count changes of the blob table and the body rows pointing
+    to it, written together by SessionDB.store_flows.
+    """
+
+    def __init__(self):
+        self.blobs: typing.Dict[str, bytes] = {}
+        self.refs: typing.Counter[str] = collections.Counter()
+        self.insert: typing.List[tuple] = []
+        self.update: typing.List[tuple] = []
+        self.delete: typing.List[tuple] = []
+
+    def ref(self, digest: str, content: bytes) -> None:
+        self.blobs[digest] = content
+        self.refs[digest] += 1
+
+    def deref(self, digest: typing.Optional[str]) -> None:
+        # Bodies of sessions from before the blob table have no hash.
+        if digest is not None:
+            self.refs[digest] -= 1
+
+    def write(self, con: sqlite3.Connection) -> None:
+        con.executemany(
+            "INSERT OR IGNORE INTO blob (hash, refs, content) VALUES(?, 0, ?);",
+            self.blobs.items()
+        )
+        con.executemany(
+            "UPDATE blob SET refs = refs + ? WHERE hash = ?;",
+            [(n, digest) for digest, n in self.refs.items() if n]
+        )
+        con.executemany("DELETE FROM body WHERE flow_id = ? AND type_id = ?;", self.delete)
+        con.executemany("UPDATE body SET hash = ?, content = NULL WHERE flow_id = ? AND type_id = ?;", self.update)
+        con.executemany("INSERT INTO body (flow_id, type_id, hash) VALUES(?, ?, ?);", self.insert)
+        con.executemany(
+            "DELETE FROM blob WHERE hash = ? AND refs <= 0;",
+            [(digest,) for digest, n in self.refs.items() if n < 0]
+        )
+
+
 # Could be implemented using async libraries
 class SessionDB:
     """
@@ -53,9 +94,10 @@ class SessionDB:
         self.live_components: typing.Dict[str, tuple] = {}
         self.tempdir: tempfile.TemporaryDirectory = None
         self.con: sqlite3.Connection = None
-        # This is used for fast look-ups over bodies already dumped to database.
+        # This is used for fast look-ups over bodies already dumped to database:
+        # (flow id, type id) -> hash of the body, None for bodies stored inline.
         # This permits to enforce one-to-one relationship between flow and body table.
-        self.body_ledger: typing.Set[str] = set()
+        self.body_ledger: typing.Dict[typing.Tuple[str, int], typing.Optional[str]] = {}
         self.id_ledger: typing.Set[str] = set()
         if db_path is not None and os.path.isfile(db_path):
             self._load_session(db_path)
@@ -84,6 +126,22 @@ class SessionDB:
         if not self.is_session_db(path):
             raise SessionLoadException('Given path does not point to a valid Session')
         self.con = sqlite3.connect(path)
+        self._upgrade_session()
+        self.id_ledger.update(fid for fid, in self.con.execute("SELECT id FROM flow;"))
+        for fid, type_id, digest in self.con.execute("SELECT flow_id, type_id, hash FROM body;"):
+            self.body_ledger[(fid, type_id)] = digest
+
+    def _upgrade_session(self):
+        """
+        Add the blob table to sessions created before bodies were deduplicated.
+        """
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(body);")]
+        if "hash" not in columns:
+            self.con.executescript(
+                "ALTER TABLE body ADD COLUMN hash CHAR(64);"
+                "CREATE TABLE IF NOT EXISTS blob (hash CHAR(64) PRIMARY KEY, refs INTEGER NOT NULL, content BLOB);"
+                "CREATE INDEX IF NOT EXISTS body_flow_id ON body(flow_id);"
+            )
 
     def _create_session(self):
         script_path = pkg_data.path("io/sql/session_create.sql")
@@ -143,57 +201,97 @@ class SessionDB:
                 flow.server_conn.via.rfile, flow.server_conn.via.wfile, flow.server_conn.via.reply = via
         return flow
 
+    def _stash_body(self, fid, type_id, message, batch):
+        """
+        Bodies over content_threshold are stored once per distinct content in the
+        blob table, and referenced by hash from the body table.
+        Returns the message to serialize: if the body was stashed, a copy without
+        it that shares everything else with the original.
+        """
+        key = (fid, type_id)
+        content = message.raw_content
+        if content is None or len(content) <= self.content_threshold:
+            if key in self.body_ledger:
+                batch.deref(self.body_ledger.pop(key))
+                batch.delete.append(key)
+            return message
+        digest = hashlib.sha256(content).hexdigest()
+        if key not in self.body_ledger:
+            batch.insert.append((fid, type_id, digest))
+            batch.ref(digest, content)
+        elif self.body_ledger[key] != digest:
+            batch.update.append((digest, fid, type_id))
+            batch.deref(self.body_ledger[key])
+            batch.ref(digest, content)
+        self.body_ledger[key] = digest
+        stripped = copy.copy(message)
+        stripped.data = copy.copy(message.data)
+        stripped.data.content = b""
+        return stripped
+
     def store_flows(self, flows):
-        body_buf = []
+        batch = _BlobBatch()
         flow_buf = []
         for flow in flows:
             self.id_ledger.add(flow.id)
             self._disassemble(flow)
             f = copy.copy(flow)
-            f.request = copy.deepcopy(flow.request)
+            f.request = self._stash_body(flow.id, 1, flow.request, batch)
             if flow.response:
-                f.response = copy.deepcopy(flow.response)
-            f.id = flow.id
-            if len(f.request.content) > self.content_threshold and f.id not in self.body_ledger:
-                body_buf.append((f.id, 1, f.request.content))
-                f.request.content = b""
-                self.body_ledger.add(f.id)
-            if f.response and f.id not in self.body_ledger:
-                if len(f.response.content) > self.content_threshold:
-                    body_buf.append((f.id, 2, f.response.content))
-                    f.response.content = b""
+                f.response = self._stash_body(flow.id, 2, flow.response, batch)
             flow_buf.append((f.id, protobuf.dumps(f)))
         self.con.executemany("INSERT OR REPLACE INTO flow VALUES(?, ?);", flow_buf)
-        if body_buf:
-            self.con.executemany("INSERT INTO body (flow_id, type_id, content) VALUES(?, ?, ?);", body_buf)
+        batch.write(self.con)
         self.con.commit()
 
+    @staticmethod
+    def _select(con, sql, ids):
+        """
+        Run sql, which ends in an IN clause to be filled with ids, in batches
+        that stay below SQLite's limit of variables.
+        """
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            yield from con.execute(sql.format(','.join('?' * len(chunk))), chunk)
+
     def retrieve_flows(self, ids=None):
         flows = []
         with self.con as con:
             if not ids:
-                sql = "SELECT f.content, b.type_id, b.content " \
-                      "FROM flow f " \
-                      "LEFT OUTER JOIN body b ON f.id = b.flow_id;"
-                rows = con.execute(sql).fetchall()
+                rows = con.execute("SELECT id, content FROM flow;").fetchall()
+                bodies = con.execute("SELECT flow_id, type_id, hash, content FROM body;").fetchall()
+                blobs = dict(con.execute("SELECT hash, content FROM blob;"))
             else:
-                sql = "SELECT f.content, b.type_id, b.content " \
-                      "FROM flow f " \
-                      "LEFT OUTER JOIN body b ON f.id = b.flow_id " \
-                      f"AND f.id IN ({','.join(['?' for _ in range(len(ids))])});"
-                rows = con.execute(sql, ids).fetchall()
-            for row in rows:
-                flow = protobuf.loads(row[0])
-                if row[1]:
-                    typ = self.type_mappings["body"][row[1]]
-                    if typ and row[2]:
-                        setattr(getattr(flow, typ), "content", row[2])
+                ids = list(ids)
+                rows = list(self._select(con, "SELECT id, content FROM flow WHERE id IN ({});", ids))
+                bodies = list(self._select(
+                    con, "SELECT flow_id, type_id, hash, content FROM body WHERE flow_id IN ({});", ids
+                ))
+                # Each distinct body is only read once.
+                blobs = dict(self._select(
+                    con, "SELECT hash, content FROM blob WHERE hash IN ({});",
+                    list({digest for _, _, digest, _ in bodies if digest})
+                ))
+            by_flow = collections.defaultdict(list)
+            for fid, type_id, digest, content in bodies:
+                by_flow[fid].append((type_id, digest, content))
+            for fid, content in rows:
+                flow = protobuf.loads(content)
+                for type_id, digest, content in by_flow[fid]:
+                    message = getattr(flow, self.type_mappings["body"][type_id])
+                    if digest:
+                        message.raw_content = blobs.get(digest)
+                    elif content:
+                        # Stored inline, decoded, by sessions from before the blob table.
+                        message.content = content
                 flow = self._reassemble(flow)
                 flows.append(flow)
         return flows
 
     def clear(self):
-        self.con.executescript("DELETE FROM body; DELETE FROM annotation; DELETE FROM flow;")
+        self.con.executescript("DELETE FROM body; DELETE FROM blob; DELETE FROM annotation; DELETE FROM flow;")
+        self.body_ledger.clear()
+        self.id_ledger.clear()
 
 
 matchall = flowfilter.parse(".")
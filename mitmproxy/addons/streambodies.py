@@ -1,11 +1,117 @@
+import hashlib
+import tempfile
+import threading
 import typing
 
+from mitmproxy.net.http import encoding
 from mitmproxy.net.http import http1
 from mitmproxy import exceptions
 from mitmproxy import ctx
 from mitmproxy.utils import human
 
 
+# Tee copies smaller than this stay in memory, larger ones are moved to disk.
+TEE_SPOOL_SIZE = 1024 * 1024
+
+
+class Tee:
+    """
+    A response.stream callable that passes the body through to the client
+    unchanged while keeping a decoded copy in a spooled temporary file.
+    Size and sha256 of the decoded body are computed on the fly.
+
+    The copy is complete once done is set; on_done is then called from the
+    proxy thread. If the body cannot be decoded the copy is dropped and error
+    is set, streaming to the client is not affected.
+    """
+
+    def __init__(
+        self,
+        content_encoding: typing.Optional[str] = None,
+        inner: typing.Optional[typing.Callable] = None,
+        on_done: typing.Optional[typing.Callable[[], None]] = None,
+    ):
+        self.inner = inner
+        self.on_done = on_done
+        self.file = tempfile.SpooledTemporaryFile(max_size=TEE_SPOOL_SIZE, prefix="mitmproxy-tee-")
+        self.lock = threading.Lock()
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.done = False
+        self.error: typing.Optional[str] = None
+        try:
+            self.decoder = encoding.decoder(content_encoding)
+        except ValueError as e:
+            self.fail(str(e))
+
+    def __call__(self, chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+        if self.inner:
+            chunks = self.inner(chunks)
+        for chunk in chunks:
+            self.write(chunk, False)
+            yield chunk
+        self.write(b"", True)
+        if not self.error:
+            self.done = True
+            if self.on_done:
+                self.on_done()
+
+    def write(self, chunk: bytes, final: bool) -> None:
+        if self.error:
+            return
+        try:
+            data = self.decoder.decompress(chunk)
+            if final:
+                data += self.decoder.flush()
+        except Exception as e:
+            self.fail("{} when decoding streamed body: {}".format(type(e).__name__, e))
+            return
+        if data:
+            self.size += len(data)
+            self.sha256.update(data)
+            with self.lock:
+                if self.file.closed:
+                    # Released while streaming, the client is not affected.
+                    self.error = "Streamed body copy has been released."
+                    return
+                self.file.seek(0, 2)
+                self.file.write(data)
+
+    def fail(self, error: str) -> None:
+        self.error = error
+        self.close()
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+    def chunks(self, size: int = TEE_SPOOL_SIZE) -> typing.Iterator[bytes]:
+        """
+        Read the copy back in chunks. Several readers may do so concurrently.
+        """
+        offset = 0
+        while True:
+            with self.lock:
+                if self.file.closed:
+                    raise ValueError("Streamed body copy has been released.")
+                self.file.seek(offset)
+                data = self.file.read(size)
+            if not data:
+                return
+            offset += len(data)
+            yield data
+
+    def head(self, size: int) -> bytes:
+        return next(self.chunks(size), b"")
+
+    @property
+    def released(self) -> bool:
+        return self.file.closed
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
 class StreamBodies:
     def __init__(self):
         self.max_size = None
@@ -19,6 +125,15 @@ class StreamBodies:
             Understands k/m/g suffixes, i.e. 3m for 3 megabytes.
             """
         )
+        loader.add_option(
+            "stream_tee", bool, False,
+            """
+            Keep a decoded copy of streamed response bodies from the recorded
+            host (see host) in a temporary file, so that they can still be
+            recorded. Files are spooled to disk, the body is never held in
+            memory as a whole.
+            """
+        )
         loader.add_option(
             "stream_websockets", bool, False,
             """
@@ -48,6 +163,28 @@ class StreamBodies:
                 # r.stream may already be a callable, which we want to preserve.
                 r.stream = r.stream or True
                 ctx.log.info("Streaming {} {}".format("response from" if not is_request else "request to", f.request.host))
+                # Only bodies that will be recorded are copied, nothing else releases the copy.
+                if (
+                    not is_request and ctx.options.stream_tee and not isinstance(r.stream, Tee)
+                    and ctx.options.host in f.request.host
+                ):
+                    r.stream = Tee(
+                        r.headers.get("content-encoding"),
+                        r.stream if callable(r.stream) else None,
+                        self.updater(f),
+                    )
+
+    @staticmethod
+    def updater(f):
+        """
+        Announce the flow again once its streamed body has been copied.
+        Called from the proxy thread, the update runs on the event loop.
+        """
+        master = ctx.master
+
+        def update():
+            master.channel.loop.call_soon_threadsafe(master.addons.trigger, "update", [f])
+        return update
 
     def requestheaders(self, f):
         self.run(f, True)
@@ -2,15 +2,21 @@ import os
 import ssl
 import time
 import datetime
+import hashlib
 import ipaddress
 import sys
+import threading
 import typing
 import contextlib
+from collections import OrderedDict
+from concurrent import futures
 
 from pyasn1.type import univ, constraint, char, namedtype, tag
 from pyasn1.codec.der.decoder import decode
 from pyasn1.error import PyAsn1Error
 import OpenSSL
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 
 from mitmproxy.coretypes import serializable
 
@@ -80,7 +86,29 @@ def create_ca(organization, cn, exp, key_size):
     return key, cert
 
 
-def dummy_cert(privkey, cacert, commonname, sans, organization):
+LEAF_KEY_TYPES = ("rsa", "ecdsa")
+
+
+def create_leaf_key(key_type: str) -> typing.Optional[OpenSSL.crypto.PKey]:
+    """
+        Creates the key pair shared by generated certificates.
+        None for "rsa": the certificates then use the CA key pair, which is the
+        fastest option for RSA because no new key needs to be generated.
+        ECDSA (P-256) keys are cheap to create and make every handshake cheaper.
+    """
+    if key_type == "ecdsa":
+        key = ec.generate_private_key(ec.SECP256R1())
+        # PKey.from_cryptography_key does not support EC keys in all pyOpenSSL versions.
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        )
+        return OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, pem)
+    return None
+
+
+def dummy_cert(privkey, cacert, commonname, sans, organization, leaf_key=None):
     """
         Generates a dummy certificate.
 
@@ -89,6 +117,7 @@ def dummy_cert(privkey, cacert, commonname, sans, organization):
         commonname: Common name for the generated certificate.
         sans: A list of Subject Alternate Names.
         organization: Organization name for the generated certificate.
+        leaf_key: Key pair of the generated certificate, the CA key pair if None.
 
         Returns cert if operation succeeded, None if not.
     """
@@ -131,49 +160,192 @@ def dummy_cert(privkey, cacert, commonname, sans, organization):
             b"serverAuth,clientAuth"
         )
     ])
-    cert.set_pubkey(cacert.get_pubkey())
+    if leaf_key is not None:
+        cert.set_pubkey(leaf_key)
+    else:
+        cert.set_pubkey(cacert.get_pubkey())
     cert.sign(privkey, "sha256")
     return Cert(cert)
 
 
+_executor: typing.Optional[futures.ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _background() -> futures.ThreadPoolExecutor:
+    """
+        The thread that generates certificates ahead of time, shared by all certificate stores.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(1, thread_name_prefix="certificate generation")
+        return _executor
+
+
 class CertStoreEntry:
 
     def __init__(self, cert, privatekey, chain_file):
         self.cert = cert
         self.privatekey = privatekey
         self.chain_file = chain_file
+        self.used = time.monotonic()
 
 
 TCustomCertId = bytes  # manually provided certs (e.g. mitmproxy's --certs)
-TGeneratedCertId = typing.Tuple[typing.Optional[bytes], typing.Tuple[bytes, ...]]  # (common_name, sans)
+# (common_name, sans, organization)
+TGeneratedCertId = typing.Tuple[typing.Optional[bytes], typing.Tuple[bytes, ...], typing.Optional[bytes]]
 TCertId = typing.Union[TCustomCertId, TGeneratedCertId]
 
 
+class CertCache:
+
+    """
+        An on-disk cache of generated certificates, stored next to the CA.
+
+        Every entry is a PEM file with the certificate and, if it has one of its
+        own, the private key. Entries are only read on a miss of the in-memory
+        store. The modification time of a file is its last use, so the least
+        recently used entries are evicted first, also across restarts.
+    """
+
+    def __init__(self, path: str, ca: "Cert", size: int, key_type: str = "rsa") -> None:
+        self.path = path
+        self.size = size
+        # Certificates of a previous CA or another key type are never loaded and get evicted eventually.
+        self.ca_digest = ca.digest("sha256") + key_type.encode()
+        self.lock = threading.Lock()
+        # file name -> None, least recently used first. Listed on the first write.
+        self.index: typing.Optional[typing.OrderedDict[str, None]] = None
+
+    def filename(self, key: TGeneratedCertId) -> str:
+        commonname, sans, organization = key
+        h = hashlib.sha256(self.ca_digest)
+        for part in (commonname, organization, *sans):
+            part = part or b""
+            h.update(b"%d:%s" % (len(part), part))
+        return h.hexdigest()[:40] + ".pem"
+
+    def get(self, key: TGeneratedCertId) -> typing.Optional[typing.Tuple["Cert", typing.Optional[OpenSSL.crypto.PKey]]]:
+        name = self.filename(key)
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            cert = Cert.from_pem(raw)
+            privatekey = None
+            if b"PRIVATE KEY-----" in raw:
+                privatekey = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, raw)
+        except (OSError, OpenSSL.crypto.Error):
+            return None
+        # Leave some margin so that a cached certificate does not expire while in use.
+        if cert.notafter < datetime.datetime.utcnow() + datetime.timedelta(days=1):
+            return None
+        self._touch(name)
+        return cert, privatekey
+
+    def touch(self, key: TGeneratedCertId) -> None:
+        """
+            Marks an entry as used.
+        """
+        self._touch(self.filename(key))
+
+    def _touch(self, name: str) -> None:
+        with contextlib.suppress(OSError):
+            os.utime(os.path.join(self.path, name))
+        with self.lock:
+            if self.index is not None and name in self.index:
+                self.index.move_to_end(name)
+
+    def put(self, key: TGeneratedCertId, cert: "Cert", privatekey: typing.Optional[OpenSSL.crypto.PKey] = None) -> None:
+        name = self.filename(key)
+        raw = cert.to_pem()
+        if privatekey is not None:
+            raw += OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, privatekey)
+        tmp = os.path.join(self.path, "%s.%d.tmp" % (name, threading.get_ident()))
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with CertStore.umask_secret(), open(tmp, "wb") as f:
+                f.write(raw)
+            os.replace(tmp, os.path.join(self.path, name))
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            return
+        evicted = []
+        with self.lock:
+            if self.index is None:
+                self.index = self._list()
+            self.index[name] = None
+            self.index.move_to_end(name)
+            while len(self.index) > self.size:
+                evicted.append(self.index.popitem(last=False)[0])
+        for i in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.path, i))
+
+    def _list(self) -> typing.OrderedDict[str, None]:
+        entries = []
+        with contextlib.suppress(OSError):
+            for i in os.scandir(self.path):
+                if i.name.endswith(".pem"):
+                    with contextlib.suppress(OSError):
+                        entries.append((i.stat().st_mtime, i.name))
+        entries.sort()
+        return OrderedDict((name, None) for _, name in entries)
+
+
 class CertStore:
 
     """
         Implements an in-memory certificate store.
     """
     STORE_CAP = 100
+    CACHE_TOUCH_INTERVAL = 60
 
     def __init__(
             self,
             default_privatekey,
             default_ca,
             default_chain_file,
-            dhparams):
+            dhparams,
+            cache: typing.Optional[CertCache] = None,
+            leaf_key: typing.Optional[OpenSSL.crypto.PKey] = None):
         self.default_privatekey = default_privatekey
         self.default_ca = default_ca
         self.default_chain_file = default_chain_file
         self.dhparams = dhparams
+        self.cache = cache
+        self.leaf_key = leaf_key
         self.certs: typing.Dict[TCertId, CertStoreEntry] = {}
-        self.expire_queue = []
-
-    def expire(self, entry):
-        self.expire_queue.append(entry)
-        if len(self.expire_queue) > self.STORE_CAP:
-            d = self.expire_queue.pop(0)
-            self.certs = {k: v for k, v in self.certs.items() if v != d}
+        # Generated certificates, least recently used first.
+        self.expire_queue: typing.OrderedDict[TGeneratedCertId, CertStoreEntry] = OrderedDict()
+        self.lock = threading.Lock()
+        # Certificates being generated in the background.
+        self.pending: typing.Dict[TGeneratedCertId, futures.Future] = {}
+
+    def expire(self, key: TGeneratedCertId, entry: CertStoreEntry) -> None:
+        with self.lock:
+            self.certs[key] = entry
+            self.expire_queue[key] = entry
+            self.expire_queue.move_to_end(key)
+            while len(self.expire_queue) > self.STORE_CAP:
+                d, _ = self.expire_queue.popitem(last=False)
+                self.certs.pop(d, None)
+
+    def touch(self, key: TGeneratedCertId) -> None:
+        with self.lock:
+            entry = self.expire_queue.get(key)
+            if entry is None:
+                return
+            self.expire_queue.move_to_end(key)
+            now = time.monotonic()
+            # The on-disk order only needs to be roughly right.
+            touch_cache = self.cache is not None and now - entry.used > self.CACHE_TOUCH_INTERVAL
+            if touch_cache:
+                entry.used = now
+        if touch_cache:
+            self.cache.touch(key)
 
     @staticmethod
     def load_dhparam(path):
@@ -196,7 +368,14 @@ class CertStore:
             return dh
 
     @classmethod
-    def from_store(cls, path, basename, key_size, passphrase: typing.Optional[bytes] = None):
+    def from_store(
+            cls,
+            path,
+            basename,
+            key_size,
+            passphrase: typing.Optional[bytes] = None,
+            cache_size: int = 0,
+            key_type: str = "rsa"):
         ca_path = os.path.join(path, basename + "-ca.pem")
         if not os.path.exists(ca_path):
             key, ca = cls.create_store(path, basename, key_size)
@@ -212,7 +391,10 @@ class CertStore:
                 passphrase)
         dh_path = os.path.join(path, basename + "-dhparam.pem")
         dh = cls.load_dhparam(dh_path)
-        return cls(key, ca, ca_path, dh)
+        cache = None
+        if cache_size > 0:
+            cache = CertCache(os.path.join(path, basename + "-certs"), Cert(ca), cache_size, key_type)
+        return cls(key, ca, ca_path, dh, cache, create_leaf_key(key_type))
 
     @staticmethod
     @contextlib.contextmanager
@@ -312,6 +494,63 @@ class CertStore:
         for i in names:
             self.certs[i] = entry
 
+    def pregenerate(self, hostnames: typing.Iterable[str]) -> None:
+        """
+            Generates certificates for hostnames in the background,
+            so that they are in the certificate cache before the first handshake.
+        """
+        for host in hostnames:
+            try:
+                name = host.encode("idna")
+            except UnicodeError:
+                continue
+            self.prefetch(name, [name])
+
+    def prefetch(
+            self,
+            commonname: typing.Optional[bytes],
+            sans: typing.List[bytes],
+            organization: typing.Optional[bytes] = None
+    ) -> None:
+        """
+            Generates a certificate in the background. A get_cert call with the
+            same arguments returns it, or waits for it if it is not ready yet.
+        """
+        sans = sorted(set(sans))
+        key: TGeneratedCertId = (commonname, tuple(sans), organization)
+        if self._lookup(commonname, sans, key):
+            return
+        with self.lock:
+            if key not in self.pending:
+                self.pending[key] = _background().submit(self._generate, key)
+
+    def _generate(self, key: TGeneratedCertId) -> CertStoreEntry:
+        try:
+            commonname, sans, organization = key
+            cached = self.cache.get(key) if self.cache else None
+            if cached:
+                cert, privatekey = cached
+            else:
+                cert = dummy_cert(
+                    self.default_privatekey,
+                    self.default_ca,
+                    commonname,
+                    list(sans),
+                    organization,
+                    self.leaf_key)
+                privatekey = self.leaf_key
+                if self.cache:
+                    self.cache.put(key, cert, privatekey)
+            entry = CertStoreEntry(
+                cert=cert,
+                privatekey=privatekey or self.default_privatekey,
+                chain_file=self.default_chain_file)
+            self.expire(key, entry)
+            return entry
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
     @staticmethod
     def asterisk_forms(dn: bytes) -> typing.List[bytes]:
         """
@@ -324,6 +563,20 @@ class CertStore:
             ret.append(b"*." + b".".join(parts[i:]))
         return ret
 
+    def _lookup(self, commonname, sans, key: TGeneratedCertId) -> typing.Optional[TCertId]:
+        potential_keys: typing.List[TCertId] = []
+        if commonname:
+            potential_keys.extend(self.asterisk_forms(commonname))
+        for s in sans:
+            potential_keys.extend(self.asterisk_forms(s))
+        potential_keys.append(b"*")
+        potential_keys.append(key)
+
+        return next(
+            filter(lambda k: k in self.certs, potential_keys),
+            None
+        )
+
     def get_cert(
             self,
             commonname: typing.Optional[bytes],
@@ -341,32 +594,23 @@ class CertStore:
             organization: Organization name for the generated certificate.
         """
 
-        potential_keys: typing.List[TCertId] = []
-        if commonname:
-            potential_keys.extend(self.asterisk_forms(commonname))
-        for s in sans:
-            potential_keys.extend(self.asterisk_forms(s))
-        potential_keys.append(b"*")
-        potential_keys.append((commonname, tuple(sans)))
+        # The order of the SANs does not matter, but should not change the key.
+        sans = sorted(set(sans))
+        key: TGeneratedCertId = (commonname, tuple(sans), organization)
 
-        name = next(
-            filter(lambda key: key in self.certs, potential_keys),
-            None
-        )
-        if name:
-            entry = self.certs[name]
+        name = self._lookup(commonname, sans, key)
+        entry = self.certs.get(name) if name else None
+        if entry is not None:
+            if name == key:
+                self.touch(key)
         else:
-            entry = CertStoreEntry(
-                cert=dummy_cert(
-                    self.default_privatekey,
-                    self.default_ca,
-                    commonname,
-                    sans,
-                    organization),
-                privatekey=self.default_privatekey,
-                chain_file=self.default_chain_file)
-            self.certs[(commonname, tuple(sans))] = entry
-            self.expire(entry)
+            with self.lock:
+                future = self.pending.get(key)
+            if future is not None:
+                # Already being generated in the background.
+                entry = future.result()
+            else:
+                entry = self._generate(key)
 
         return entry.cert, entry.privatekey, entry.chain_file
 
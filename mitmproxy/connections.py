@@ -213,6 +213,8 @@ class ServerConnection(tcp.TCPClient, stateobject.StateObject):
         timestamp_tcp_setup: TCP ACK received timestamp
         timestamp_tls_setup: TLS established timestamp
         timestamp_end: Connection end timestamp
+        pool_key: Key in the upstream connection pool, None if the connection is not pooled
+        reusable: True if the last request/response exchange completed and the connection may be reused
     """
 
     def __init__(self, address, source_address=None, spoof_source_address=None):
@@ -226,6 +228,8 @@ class ServerConnection(tcp.TCPClient, stateobject.StateObject):
         self.timestamp_end = None
         self.timestamp_tcp_setup = None
         self.timestamp_tls_setup = None
+        self.pool_key = None
+        self.reusable = False
 
     def connected(self):
         return bool(self.connection) and not self.finished
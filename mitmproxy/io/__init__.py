@@ -1,7 +1,12 @@
 from .io import FlowWriter, FlowReader, FilteredFlowWriter, read_flows_from_paths
 from .db import DBHandler
+from .compressed import ZstdFlowWriter
+from .index import FlowIndex, IndexedFlowReader, IndexedFlowWriter
+from .parallel import stream_flows_from_paths, stream_flows_from_bytes
 
 
 __all__ = [
-    "FlowWriter", "FlowReader", "FilteredFlowWriter", "read_flows_from_paths", "DBHandler"
+    "FlowWriter", "FlowReader", "FilteredFlowWriter", "read_flows_from_paths", "DBHandler", "ZstdFlowWriter",
+    "FlowIndex", "IndexedFlowReader", "IndexedFlowWriter",
+    "stream_flows_from_paths", "stream_flows_from_bytes",
 ]
@@ -0,0 +1,259 @@
+"""
+zstd-compressed flow files.
+
+A compressed flow file starts with MAGIC, followed by records of a one-byte
+type, a four-byte big-endian payload length and the payload:
+
+    d   a zstd dictionary, used by the flow records that refer to its id
+    f   one flow: a zstd frame of its tnetstring
+
+Every flow is an independent frame, so a flow can be decoded on its own given
+its record offset and the dictionary it was compressed with. Dictionaries are
+trained on the headers and metadata of the first flows of a file (bodies are
+left out), which is where most of the redundancy between flows is.
+"""
+import struct
+import typing
+
+import zstandard as zstd
+
+from mitmproxy import flowfilter
+from mitmproxy.io import tnetstring
+
+MAGIC = b"MITMZST\x01"
+RECORD = struct.Struct(">cI")
+RECORD_DICT = b"d"
+RECORD_FLOW = b"f"
+
+LEVEL = 3
+# Train a dictionary from this many flows, or as many as fit in TRAIN_SIZE.
+TRAIN_SAMPLES = 256
+TRAIN_SIZE = 4 * 1024 * 1024
+DICT_SIZE = 64 * 1024
+
+TSerializable = tnetstring.TSerializable
+
+
+def is_compressed(fo) -> bool:
+    """
+    Check for MAGIC without consuming any data.
+    The file must support peek() or seek(); other files are taken to be uncompressed.
+    """
+    peek = getattr(fo, "peek", None)
+    if peek is not None:
+        return peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    try:
+        pos = fo.tell()
+        head = fo.read(len(MAGIC))
+        fo.seek(pos)
+    except (OSError, AttributeError):
+        return False
+    return head == MAGIC
+
+
+def record(type: bytes, payload: bytes) -> bytes:
+    return RECORD.pack(type, len(payload)) + payload
+
+
+def _sample_state(state: dict) -> dict:
+    """
+    The flow state without message bodies, as a dictionary training sample.
+    """
+    sample = dict(state)
+    for part in ("request", "response"):
+        if sample.get(part):
+            sample[part] = dict(sample[part], content=None)
+    return sample
+
+
+class ZstdFlowWriter:
+    """
+    Write flows as a compressed flow file, see the module docstring.
+
+    The file is expected to be empty, or to be a compressed flow file that
+    is appended to. Without a dictionary, one is trained from the first
+    flows; those are compressed without dictionary.
+    """
+
+    def __init__(
+        self,
+        fo,
+        flt=None,
+        level: int = LEVEL,
+        dictionary: typing.Optional[bytes] = None,
+        train: bool = True,
+    ):
+        self.fo = fo
+        self.flt = flt
+        self.level = level
+        self.train = train and dictionary is None
+        self.samples: typing.List[bytes] = []
+        self.samples_size = 0
+        self.started = False
+        self.compressor = zstd.ZstdCompressor(level=level, write_content_size=True)
+        self.dictionary = None
+        if dictionary is not None:
+            self.use_dictionary(zstd.ZstdCompressionDict(dictionary))
+
+    def use_dictionary(self, dictionary: zstd.ZstdCompressionDict) -> None:
+        self.dictionary = dictionary
+        self.compressor = zstd.ZstdCompressor(level=self.level, dict_data=dictionary, write_content_size=True)
+
+    def add(self, flow) -> None:
+        if self.flt and not flowfilter.match(self.flt, flow):
+            return
+        self.write_state(flow.get_state())
+
+    def write_state(self, state: dict) -> typing.Tuple[int, int]:
+        """
+        Write a flow state. Returns the number of bytes written before
+        the flow's record, and the length of the record.
+        """
+        prefix = b""
+        if not self.started:
+            self.started = True
+            if self.fo.tell() == 0:
+                prefix += MAGIC
+            if self.dictionary is not None:
+                prefix += record(RECORD_DICT, self.dictionary.as_bytes())
+        if self.train:
+            prefix += self._train(state)
+        data = record(RECORD_FLOW, self.compressor.compress(tnetstring.dumps(state)))
+        if prefix:
+            self.fo.write(prefix)
+        self.fo.write(data)
+        return len(prefix), len(data)
+
+    def _train(self, state: dict) -> bytes:
+        sample = tnetstring.dumps(_sample_state(state))
+        self.samples.append(sample)
+        self.samples_size += len(sample)
+        if len(self.samples) < TRAIN_SAMPLES and self.samples_size < TRAIN_SIZE:
+            return b""
+        self.train = False
+        samples, self.samples = self.samples, []
+        try:
+            dictionary = zstd.train_dictionary(DICT_SIZE, samples)
+        except zstd.ZstdError:
+            # Not enough (or too uniform) samples: stay without dictionary.
+            return b""
+        self.use_dictionary(dictionary)
+        return record(RECORD_DICT, dictionary.as_bytes())
+
+
+class Dictionaries:
+    """
+    The dictionaries of a compressed flow file, by id.
+    Frames without dictionary use id 0.
+
+    Given the file, dictionaries that have not been added are looked up in
+    it, for reading single flows.
+    """
+
+    def __init__(self, fo=None) -> None:
+        self.fo = fo
+        self.decompressors: typing.Dict[int, zstd.ZstdDecompressor] = {0: zstd.ZstdDecompressor()}
+
+    def add(self, data: bytes) -> None:
+        try:
+            dictionary = zstd.ZstdCompressionDict(data)
+            self.decompressors[dictionary.dict_id()] = zstd.ZstdDecompressor(dict_data=dictionary)
+        except zstd.ZstdError as e:
+            raise ValueError(f"not a compressed flow file: {e}")
+
+    def _find(self) -> None:
+        fo, self.fo = self.fo, None
+        for offset, type, length in skim_records(fo, len(MAGIC)):
+            if type == RECORD_DICT:
+                fo.seek(offset + RECORD.size)
+                self.add(fo.read(length - RECORD.size))
+
+    def decompress(self, frame: bytes) -> bytes:
+        """
+        Raises:
+            ValueError, if the frame is invalid or its dictionary is unknown.
+        """
+        try:
+            dict_id = zstd.get_frame_parameters(frame).dict_id
+            if dict_id not in self.decompressors and self.fo is not None:
+                self._find()
+            if dict_id not in self.decompressors:
+                raise ValueError("not a compressed flow file: unknown dictionary")
+            return self.decompressors[dict_id].decompress(frame)
+        except zstd.ZstdError as e:
+            raise ValueError(f"not a compressed flow file: {e}")
+
+
+def read_record(fo) -> typing.Optional[typing.Tuple[bytes, bytes]]:
+    """
+    Read the next record as (type, payload), None at the end of the file.
+    """
+    header = fo.read(RECORD.size)
+    if not header:
+        return None
+    if len(header) != RECORD.size:
+        raise ValueError("not a compressed flow file: truncated record")
+    type, length = RECORD.unpack(header)
+    payload = fo.read(length)
+    if len(payload) != length:
+        raise ValueError("not a compressed flow file: truncated record")
+    return type, payload
+
+
+def flow_record(fo, offset: int, length: int) -> bytes:
+    """
+    The zstd frame of the flow record at offset.
+    """
+    fo.seek(offset)
+    data = fo.read(length)
+    if len(data) != length or length < RECORD.size:
+        raise ValueError("not a compressed flow file: truncated record")
+    type, size = RECORD.unpack(data[:RECORD.size])
+    if type != RECORD_FLOW or size != length - RECORD.size:
+        raise ValueError("not a compressed flow file: no flow record")
+    return data[RECORD.size:]
+
+
+def skim_records(fo, offset: int) -> typing.Iterator[typing.Tuple[int, bytes, int]]:
+    """
+    Yield (offset, type, length) of the records starting at offset, reading
+    only their headers. length is the length of the whole record.
+    """
+    while True:
+        fo.seek(offset)
+        header = fo.read(RECORD.size)
+        if not header:
+            return
+        if len(header) != RECORD.size:
+            raise ValueError("not a compressed flow file: truncated record")
+        type, length = RECORD.unpack(header)
+        yield offset, type, RECORD.size + length
+        offset += RECORD.size + length
+
+
+def decode_records(fo, dictionaries: Dictionaries) -> typing.Iterator[TSerializable]:
+    """
+    Yield the flow states of the records read from fo.
+    Dictionary records are added to dictionaries.
+    """
+    while True:
+        r = read_record(fo)
+        if r is None:
+            return
+        type, payload = r
+        if type == RECORD_DICT:
+            dictionaries.add(payload)
+        elif type == RECORD_FLOW:
+            yield tnetstring.loads(dictionaries.decompress(payload))
+        else:
+            raise ValueError(f"not a compressed flow file: unknown record type {type!r}")
+
+
+def load_all(fo) -> typing.Iterator[TSerializable]:
+    """
+    Yield the flow states of a compressed flow file, starting at MAGIC.
+    """
+    if fo.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a compressed flow file")
+    yield from decode_records(fo, Dictionaries())
+
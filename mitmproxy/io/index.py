@@ -0,0 +1,359 @@
+"""
+Sidecar indexes for flow dumps.
+
+The index of ``flows.dump`` lives in ``flows.dump.idx``. It is a sequence of
+tnetstrings: a header followed by one entry per flow, holding the byte range of
+the flow in the dump and a few fields that can be filtered on without decoding
+the flow. Both files are append-only, so appending to a dump just appends to
+its index.
+
+For compressed dumps (see mitmproxy.io.compressed), the byte ranges are those
+of the flow records, which can be decompressed one by one.
+
+An index that does not cover the whole dump (because flows were appended by a
+writer without index) is completed when it is opened; an index that does not
+match the dump is rebuilt.
+"""
+import os
+import typing
+
+from mitmproxy import exceptions
+from mitmproxy import flow
+from mitmproxy import flowfilter
+from mitmproxy.io import compat
+from mitmproxy.io import compressed
+from mitmproxy.io import io
+from mitmproxy.io import tnetstring
+from mitmproxy.net.http import url
+from mitmproxy.utils import strutils
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+
+class IndexEntry(typing.NamedTuple):
+    offset: int
+    length: int
+    id: str
+    type: str
+    timestamp: typing.Optional[float]
+    host: typing.Optional[str]
+    method: typing.Optional[str]
+    url: typing.Optional[str]
+
+    def dump(self) -> bytes:
+        return tnetstring.dumps(list(self))
+
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def index_entry(state: dict, offset: int, length: int) -> IndexEntry:
+    """
+    Build the index entry of a flow from its (migrated) state.
+    """
+    request = state.get("request")
+    if request:
+        timestamp = request["timestamp_start"]
+        host = request["host"]
+        method = strutils.always_str(request["method"], "utf-8", "surrogateescape")
+        if request.get("first_line_format") == "authority" or method == "CONNECT":
+            u = f"{host}:{request['port']}"
+        else:
+            u = url.unparse(
+                strutils.always_str(request["scheme"], "utf-8", "surrogateescape"),
+                host,
+                request["port"],
+                strutils.always_str(request["path"], "utf-8", "surrogateescape"),
+            )
+    else:
+        timestamp = state["client_conn"].get("timestamp_start")
+        address = state["server_conn"].get("address")
+        host = address[0] if address else None
+        method = None
+        u = None
+    return IndexEntry(offset, length, state["id"], state["type"], timestamp, host, method, u)
+
+
+class IndexedFlowWriter(io.FlowWriter):
+    """
+    A FlowWriter that also appends to the index of the dump, optionally
+    writing only flows matching flt. Both files must be opened in the same
+    binary write or append mode. With compress, the dump is written
+    compressed, using the given zstd dictionary if any.
+    """
+
+    def __init__(self, fo, index_fo, flt=None, compress=False, dictionary=None):
+        super().__init__(fo)
+        self.index_fo = index_fo
+        self.flt = flt
+        self.compressor = compressed.ZstdFlowWriter(fo, dictionary=dictionary) if compress else None
+        if index_fo.tell() == 0:
+            index_fo.write(tnetstring.dumps({"version": INDEX_VERSION}))
+
+    def add(self, flow):
+        if self.flt and not flowfilter.match(self.flt, flow):
+            return
+        d = flow.get_state()
+        offset = self.fo.tell()
+        if self.compressor:
+            skipped, length = self.compressor.write_state(d)
+            offset += skipped
+        else:
+            data = tnetstring.dumps(d)
+            self.fo.write(data)
+            length = len(data)
+        self.index_fo.write(index_entry(d, offset, length).dump())
+
+
+class FlowIndex:
+    """
+    The index of a flow dump, see the module docstring.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.compressed = False
+        self.entries: typing.List[IndexEntry] = []
+        self.by_id: typing.Dict[str, IndexEntry] = {}
+
+    @classmethod
+    def open(cls, path: str, update: bool = True) -> "FlowIndex":
+        """
+        Read the index of the dump at path. Flows missing from the index are
+        indexed, which decodes only those flows; with update the index file
+        is brought up to date as well.
+
+        Raises:
+            FlowReadException, if the dump cannot be read.
+        """
+        index = cls(path)
+        try:
+            size = os.path.getsize(path)
+            with open(path, "rb") as dump:
+                index.compressed = compressed.is_compressed(dump)
+                indexed, clean = index._read_entries(dump, size)
+                end = indexed[-1].offset + indexed[-1].length if indexed else 0
+                scanned = index._scan(dump, end)
+        except OSError as e:
+            raise exceptions.FlowReadException(e.strerror)
+        index._set_entries(indexed + scanned)
+        if update:
+            if not indexed or not clean:
+                index._write(index.entries, rebuild=True)
+            elif scanned:
+                index._write(scanned, rebuild=False)
+        return index
+
+    def _read_entries(self, dump, size: int) -> typing.Tuple[typing.List[IndexEntry], bool]:
+        """
+        The valid entries of the index file, and whether the file can be appended to.
+        """
+        entries: typing.List[IndexEntry] = []
+        try:
+            with open(index_path(self.path), "rb") as f:
+                header = tnetstring.load(f)
+                if not isinstance(header, dict) or header.get("version") != INDEX_VERSION:
+                    return [], False
+                while True:
+                    try:
+                        entries.append(IndexEntry(*tnetstring.load(f)))  # type: ignore
+                    except ValueError as e:
+                        if str(e) == "not a tnetstring: empty file":
+                            break
+                        # A partially written last entry.
+                        return self._valid(dump, size, entries), False
+        except (OSError, ValueError, TypeError):
+            return [], False
+        valid = self._valid(dump, size, entries)
+        return valid, len(valid) == len(entries)
+
+    def _valid(self, dump, size: int, entries: typing.List[IndexEntry]) -> typing.List[IndexEntry]:
+        """
+        The entries if they describe a contiguous prefix of the dump, otherwise none.
+        In compressed dumps, dictionary records may lie between flows.
+        Only the last entry is compared against the dump itself.
+        """
+        end = len(compressed.MAGIC) if self.compressed else 0
+        for e in entries:
+            if e.offset < end if self.compressed else e.offset != end:
+                return []
+            end = e.offset + e.length
+        if end > size:
+            return []
+        if entries:
+            last = entries[-1]
+            dump.seek(last.offset)
+            if self.compressed:
+                head = dump.read(compressed.RECORD.size)
+                if len(head) != compressed.RECORD.size:
+                    return []
+                type, length = compressed.RECORD.unpack(head)
+                if type != compressed.RECORD_FLOW or length + compressed.RECORD.size != last.length:
+                    return []
+            else:
+                head = dump.read(11)
+                colon = head.find(b":")
+                if colon <= 0 or not head[:colon].isdigit() or int(head[:colon]) + colon + 2 != last.length:
+                    return []
+        return entries
+
+    def _scan(self, dump, offset: int) -> typing.List[IndexEntry]:
+        """
+        Index the flows of the dump starting at offset.
+        """
+        if self.compressed:
+            return self._scan_compressed(dump, offset)
+        entries = []
+        dump.seek(offset)
+        while True:
+            try:
+                state = tnetstring.load(dump)
+            except ValueError as e:
+                if str(e) == "not a tnetstring: empty file":
+                    break
+                raise exceptions.FlowReadException("Invalid data format.") from e
+            end = dump.tell()
+            try:
+                state = compat.migrate_flow(state)  # type: ignore
+            except ValueError as e:
+                raise exceptions.FlowReadException(str(e)) from e
+            entries.append(index_entry(state, offset, end - offset))
+            offset = end
+        return entries
+
+    def _scan_compressed(self, dump, offset: int) -> typing.List[IndexEntry]:
+        entries = []
+        dictionaries = compressed.Dictionaries(dump)
+        try:
+            for offset, type, length in compressed.skim_records(dump, max(offset, len(compressed.MAGIC))):
+                if type == compressed.RECORD_DICT:
+                    continue
+                frame = compressed.flow_record(dump, offset, length)
+                state = tnetstring.loads(dictionaries.decompress(frame))
+                entries.append(index_entry(compat.migrate_flow(state), offset, length))  # type: ignore
+        except ValueError as e:
+            raise exceptions.FlowReadException("Invalid data format.") from e
+        return entries
+
+    def _write(self, entries: typing.List[IndexEntry], rebuild: bool) -> None:
+        try:
+            with open(index_path(self.path), "wb" if rebuild else "ab") as f:
+                if rebuild:
+                    f.write(tnetstring.dumps({"version": INDEX_VERSION}))
+                for e in entries:
+                    f.write(e.dump())
+        except OSError:
+            # The index is only a cache, a read-only location is fine.
+            pass
+
+    def _set_entries(self, entries: typing.List[IndexEntry]) -> None:
+        self.entries = entries
+        self.by_id = {e.id: e for e in entries}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> typing.Iterator[IndexEntry]:
+        return iter(self.entries)
+
+    def get(self, flow_id: str) -> typing.Optional[IndexEntry]:
+        return self.by_id.get(flow_id)
+
+    def select(
+        self,
+        host: typing.Optional[str] = None,
+        method: typing.Optional[str] = None,
+        url: typing.Optional[str] = None,
+        since: typing.Optional[float] = None,
+        until: typing.Optional[float] = None,
+        type: typing.Optional[str] = None,
+    ) -> typing.List[IndexEntry]:
+        """
+        Entries matching all given criteria: host and type must be equal,
+        method is compared case-insensitively, url must contain the given
+        string and the timestamp must be within [since, until).
+        """
+        if method is not None:
+            method = method.upper()
+        result = []
+        for e in self.entries:
+            if host is not None and e.host != host:
+                continue
+            if method is not None and (e.method or "").upper() != method:
+                continue
+            if url is not None and (e.url is None or url not in e.url):
+                continue
+            if type is not None and e.type != type:
+                continue
+            if since is not None and (e.timestamp is None or e.timestamp < since):
+                continue
+            if until is not None and (e.timestamp is None or e.timestamp >= until):
+                continue
+            result.append(e)
+        return result
+
+
+class IndexedFlowReader:
+    """
+    Random access to the flows of a dump through its index.
+    Flows are only decoded when they are loaded.
+
+        with IndexedFlowReader("flows.dump") as reader:
+            for f in reader.stream(reader.index.select(host="example.com")):
+                ...
+    """
+
+    def __init__(self, path: str, update_index: bool = True) -> None:
+        self.path = os.path.expanduser(path)
+        self.index = FlowIndex.open(self.path, update_index)
+        try:
+            self.fo = open(self.path, "rb")
+        except OSError as e:
+            raise exceptions.FlowReadException(e.strerror)
+        self.dictionaries = compressed.Dictionaries(self.fo) if self.index.compressed else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.fo.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def load(self, entry: IndexEntry) -> flow.Flow:
+        """
+        Raises:
+            FlowReadException, if the flow cannot be read.
+        """
+        try:
+            if self.dictionaries is not None:
+                data = self.dictionaries.decompress(compressed.flow_record(self.fo, entry.offset, entry.length))
+            else:
+                self.fo.seek(entry.offset)
+                data = self.fo.read(entry.length)
+            state = tnetstring.loads(data)
+            state = compat.migrate_flow(state)  # type: ignore
+        except ValueError as e:
+            raise exceptions.FlowReadException(str(e)) from e
+        if state["type"] not in io.FLOW_TYPES or state["id"] != entry.id:
+            raise exceptions.FlowReadException("Flow index does not match the flow file.")
+        return io.FLOW_TYPES[state["type"]].from_state(state)
+
+    def get(self, flow_id: str) -> typing.Optional[flow.Flow]:
+        entry = self.index.get(flow_id)
+        if entry is None:
+            return None
+        return self.load(entry)
+
+    def stream(self, entries: typing.Optional[typing.Iterable[IndexEntry]] = None) -> typing.Iterator[flow.Flow]:
+        """
+        Lazily load the given entries, all flows by default.
+        """
+        for entry in self.index if entries is None else entries:
+            yield self.load(entry)
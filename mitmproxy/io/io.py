@@ -9,6 +9,7 @@ from mitmproxy import tcp
 from mitmproxy import websocket
 
 from mitmproxy.io import compat
+from mitmproxy.io import compressed
 from mitmproxy.io import tnetstring
 
 FLOW_TYPES: Dict[str, Type[flow.Flow]] = dict(
@@ -33,15 +34,10 @@ class FlowReader:
 
     def stream(self) -> Iterable[flow.Flow]:
         """
-            Yields Flow objects from the dump.
+            Yields Flow objects from the dump, which may be compressed.
         """
         try:
-            while True:
-                # FIXME: This cast hides a lack of dynamic type checking
-                loaded = cast(
-                    Dict[Union[bytes, str], Any],
-                    tnetstring.load(self.fo),
-                )
+            for loaded in self._load():
                 try:
                     mdata = compat.migrate_flow(loaded)
                 except ValueError as e:
@@ -49,11 +45,23 @@ class FlowReader:
                 if mdata["type"] not in FLOW_TYPES:
                     raise exceptions.FlowReadException("Unknown flow type: {}".format(mdata["type"]))
                 yield FLOW_TYPES[mdata["type"]].from_state(mdata)
-        except ValueError as e:
-            if str(e) == "not a tnetstring: empty file":
-                return  # Error is due to EOF
+        except ValueError:
             raise exceptions.FlowReadException("Invalid data format.")
 
+    def _load(self) -> Iterable[Dict[Union[bytes, str], Any]]:
+        if compressed.is_compressed(self.fo):
+            # FIXME: This cast hides a lack of dynamic type checking
+            yield from cast(Iterable[Dict[Union[bytes, str], Any]], compressed.load_all(self.fo))
+            return
+        while True:
+            try:
+                loaded = tnetstring.load(self.fo)
+            except ValueError as e:
+                if str(e) == "not a tnetstring: empty file":
+                    return  # Error is due to EOF
+                raise
+            yield cast(Dict[Union[bytes, str], Any], loaded)
+
 
 class FilteredFlowWriter:
     def __init__(self, fo, flt):
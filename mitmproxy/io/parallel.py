@@ -0,0 +1,233 @@
+"""
+Decode flow files in a pool of worker processes.
+
+Files are split into segments of consecutive flows by only reading the length
+prefixes of the top-level tnetstrings. Workers decode and migrate whole
+segments into flow objects, which are sent back pickled: unpickling a flow is
+considerably cheaper than creating it from its state. The calling process
+yields them in file order. Worker processes are only used while the calling
+process has no other threads, e.g. before the proxy server is started.
+
+Compressed files are split at record boundaries; their segments carry the
+dictionaries read so far.
+"""
+import collections
+import itertools
+import multiprocessing
+import os
+import threading
+import typing
+from concurrent import futures
+from io import BytesIO
+
+from mitmproxy import exceptions
+from mitmproxy import flow
+from mitmproxy.io import compat
+from mitmproxy.io import compressed
+from mitmproxy.io import io
+from mitmproxy.io import tnetstring
+
+# Segments are at least this large, unless the file ends first.
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# A source is a path, or the data of a segment itself.
+# Segments of compressed files have a tuple of dictionaries, others None.
+Dictionaries = typing.Optional[typing.Tuple[bytes, ...]]
+Segment = typing.Tuple[typing.Union[str, bytes], int, typing.Optional[int], Dictionaries]
+
+
+def _skim(fo, segment_size: int) -> typing.Iterator[typing.Tuple[int, typing.Optional[int], Dictionaries]]:
+    """
+    Yield (offset, length, dictionaries) of the segments of a flow file.
+    A segment with length None extends to the end of the file: it starts with
+    invalid data, decoding it reports the error.
+    """
+    if compressed.is_compressed(fo):
+        yield from _skim_compressed(fo, segment_size)
+        return
+    start = offset = 0
+    while True:
+        fo.seek(offset)
+        head = fo.read(11)
+        if not head:
+            break
+        colon = head.find(b":")
+        if colon <= 0 or not head[:colon].isdigit():
+            if offset > start:
+                yield start, offset - start, None
+            yield offset, None, None
+            return
+        offset += colon + int(head[:colon]) + 2
+        if offset - start >= segment_size:
+            yield start, offset - start, None
+            start = offset
+    if offset > start:
+        yield start, offset - start, None
+
+
+def _skim_compressed(fo, segment_size: int) -> typing.Iterator[typing.Tuple[int, typing.Optional[int], Dictionaries]]:
+    dictionaries: typing.List[bytes] = []
+    start = end = len(compressed.MAGIC)
+    try:
+        for offset, type, length in compressed.skim_records(fo, start):
+            if type == compressed.RECORD_DICT:
+                fo.seek(offset + compressed.RECORD.size)
+                dictionaries.append(fo.read(length - compressed.RECORD.size))
+            end = offset + length
+            if end - start >= segment_size:
+                yield start, end - start, tuple(dictionaries)
+                start = end
+    except ValueError:
+        yield start, None, tuple(dictionaries)
+        return
+    if end > start:
+        yield start, end - start, tuple(dictionaries)
+
+
+def _states(fo, dictionaries: Dictionaries) -> typing.Iterator[dict]:
+    if dictionaries is not None:
+        d = compressed.Dictionaries()
+        for data in dictionaries:
+            d.add(data)
+        yield from compressed.decode_records(fo, d)  # type: ignore
+        return
+    while True:
+        try:
+            yield tnetstring.load(fo)  # type: ignore
+        except ValueError as e:
+            if str(e) == "not a tnetstring: empty file":
+                return
+            raise
+
+
+def _decode_segment(
+    source: typing.Union[str, bytes],
+    offset: int,
+    length: typing.Optional[int],
+    dictionaries: Dictionaries = None,
+) -> list:
+    """
+    Decode the flows of a segment. Runs in the workers.
+    """
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, "rb") as f:
+            f.seek(offset)
+            data = f.read() if length is None else f.read(length)
+    fo = BytesIO(data)
+    flows: list = []
+    states = _states(fo, dictionaries)
+    try:
+        while True:
+            try:
+                state = next(states)
+            except StopIteration:
+                return flows
+            except ValueError:
+                raise exceptions.FlowReadException("Invalid data format.")
+            try:
+                state = compat.migrate_flow(state)  # type: ignore
+            except ValueError as e:
+                raise exceptions.FlowReadException(str(e))
+            if state["type"] not in io.FLOW_TYPES:
+                raise exceptions.FlowReadException("Unknown flow type: {}".format(state["type"]))
+            flows.append(io.FLOW_TYPES[state["type"]].from_state(state))
+    except exceptions.FlowReadException as e:
+        # The flows decoded before the error are passed on like FlowReader does.
+        flows.append(e)
+        return flows
+
+
+def _flows(decoded: list) -> typing.Iterator[flow.Flow]:
+    for f in decoded:
+        if isinstance(f, exceptions.FlowReadException):
+            raise f
+        yield f
+
+
+def _pool_context():
+    """
+    Workers are forked: spawned workers would re-run the main script of
+    entry points that are not guarded by `if __name__ == "__main__"`.
+    Forking is only safe while this is the only thread: a running proxy has
+    server, connection and executor threads whose locks the children would
+    inherit in whatever state they are in. Flows are decoded in-process then.
+    """
+    if threading.active_count() > 1:
+        return None
+    try:
+        return multiprocessing.get_context("fork")
+    except ValueError:  # pragma: no cover
+        return None
+
+
+def _stream(segments: typing.Iterable[Segment], processes: int) -> typing.Iterator[flow.Flow]:
+    segments = iter(segments)
+    head = list(itertools.islice(segments, 2))
+    context = _pool_context()
+    if processes == 1 or len(head) < 2 or context is None:
+        # Not worth starting processes for a single segment.
+        for segment in itertools.chain(head, segments):
+            yield from _flows(_decode_segment(*segment))
+        return
+
+    pool = futures.ProcessPoolExecutor(processes, mp_context=context)
+    pending: typing.Deque[futures.Future] = collections.deque()
+    try:
+        for segment in itertools.chain(head, segments):
+            pending.append(pool.submit(_decode_segment, *segment))
+            # Keep memory bounded: only a few segments per worker are in flight.
+            if len(pending) >= processes * 2:
+                yield from _flows(pending.popleft().result())
+        while pending:
+            yield from _flows(pending.popleft().result())
+    finally:
+        for f in pending:
+            f.cancel()
+        pool.shutdown(wait=True)
+
+
+def _processes(processes: int) -> int:
+    return processes if processes > 0 else (os.cpu_count() or 1)
+
+
+def stream_flows_from_paths(
+    paths: typing.Iterable[str],
+    processes: int = 0,
+    segment_size: int = SEGMENT_SIZE,
+) -> typing.Iterator[flow.Flow]:
+    """
+    Yield the flows of all files, in order, decoded by up to processes
+    worker processes (0: one per CPU core, 1: no worker processes).
+
+    Raises:
+        FlowReadException, if any error occurs.
+    """
+    def segments():
+        for path in paths:
+            path = os.path.expanduser(path)
+            try:
+                with open(path, "rb") as f:
+                    skimmed = list(_skim(f, segment_size))
+            except OSError as e:
+                raise exceptions.FlowReadException(e.strerror)
+            for offset, length, dictionaries in skimmed:
+                yield path, offset, length, dictionaries
+
+    yield from _stream(segments(), _processes(processes))
+
+
+def stream_flows_from_bytes(
+    data: bytes,
+    processes: int = 0,
+    segment_size: int = SEGMENT_SIZE,
+) -> typing.Iterator[flow.Flow]:
+    """
+    Like stream_flows_from_paths, for the contents of a flow file.
+    """
+    def segments():
+        for offset, length, dictionaries in _skim(BytesIO(data), segment_size):
+            yield data[offset:None if length is None else offset + length], 0, None, dictionaries
+
+    yield from _stream(segments(), _processes(processes))
@@ -5,14 +5,24 @@ id VARCHAR(36) PRIMARY KEY,
 content BLOB
 );
 
+CREATE TABLE blob (
+hash CHAR(64) PRIMARY KEY,
+refs INTEGER NOT NULL,
+content BLOB
+);
+
 CREATE TABLE body (
 id INTEGER PRIMARY KEY,
 flow_id VARCHAR(36),
 type_id INTEGER,
 content BLOB,
-FOREIGN KEY(flow_id) REFERENCES flow(id)
+hash CHAR(64),
+FOREIGN KEY(flow_id) REFERENCES flow(id),
+FOREIGN KEY(hash) REFERENCES blob(hash)
 );
 
+CREATE INDEX body_flow_id ON body(flow_id);
+
 CREATE TABLE annotation (
 id INTEGER PRIMARY KEY,
 flow_id VARCHAR(36),
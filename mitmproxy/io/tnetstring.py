@@ -45,6 +45,9 @@ import typing
 
 TSerializable = typing.Union[None, str, bool, int, float, bytes, list, tuple, dict]
 
+#  Strings up to this size are copied into a single output chunk by dumps().
+SMALL_CHUNK = 1024
+
 
 def dumps(value: TSerializable) -> bytes:
     """
@@ -83,6 +86,42 @@ def _rdumpq(q: collections.deque, size: int, value: TSerializable) -> int:
     strings, especially on deeply nested structures.
     """
     write = q.appendleft
+    #  Fast paths for the exact types that make up most of a flow's state.
+    #  Small strings are written as a single chunk, large ones are not copied.
+    t = type(value)
+    if t is bytes or t is str:
+        if t is bytes:
+            data, tag = value, b','
+        else:
+            data, tag = value.encode("utf8"), b';'  # type: ignore
+        ldata = len(data)
+        if ldata <= SMALL_CHUNK:
+            chunk = b'%d:%s%s' % (ldata, data, tag)
+            write(chunk)
+            return size + len(chunk)
+        span = b'%d:' % ldata
+        write(tag)
+        write(data)
+        write(span)
+        return size + 1 + len(span) + ldata
+    if t is dict:
+        write(b'}')
+        init_size = size = size + 1
+        for (k, v) in value.items():  # type: ignore
+            size = _rdumpq(q, size, v)
+            size = _rdumpq(q, size, k)
+        span = b'%d:' % (size - init_size)
+        write(span)
+        return size + len(span)
+    if t is list or t is tuple:
+        write(b']')
+        init_size = size = size + 1
+        for item in reversed(value):  # type: ignore
+            size = _rdumpq(q, size, item)
+        span = b'%d:' % (size - init_size)
+        write(span)
+        return size + len(span)
+
     if value is None:
         write(b'0:~')
         return size + 3
@@ -153,7 +192,8 @@ def loads(string: bytes) -> TSerializable:
     """
     This function parses a tnetstring into a python object.
     """
-    return pop(string)[0]
+    data = _as_bytes(string)
+    return _pop(data, memoryview(data), 0, len(data))[0]
 
 
 def load(file_handle: typing.BinaryIO) -> TSerializable:
@@ -163,6 +203,25 @@ def load(file_handle: typing.BinaryIO) -> TSerializable:
     python object.  The file must support the read() method, and this
     function promises not to read more data than necessary.
     """
+    data_length = _read_length(file_handle)
+    #  Read the data and its type tag in one go and parse it in place.
+    data = file_handle.read(data_length + 1)
+    if len(data) != data_length + 1:
+        raise ValueError("not a tnetstring: truncated data")
+    return _parse(data[data_length], data, memoryview(data), 0, data_length)
+
+
+def _read_length(file_handle: typing.BinaryIO) -> int:
+    #  Buffered files let us look at the length prefix without consuming
+    #  anything beyond it, so it can be read in one call.
+    peek = getattr(file_handle, "peek", None)
+    if peek is not None:
+        head = peek(11)[:11]
+        colon = head.find(b":")
+        if 0 < colon <= 9 and head[:colon].isdigit():
+            file_handle.read(colon + 1)
+            return int(head[:colon])
+
     #  Read the length prefix one char at a time.
     #  Note that the netstring spec explicitly forbids padding zeros.
     c = file_handle.read(1)
@@ -176,53 +235,12 @@ def load(file_handle: typing.BinaryIO) -> TSerializable:
         c = file_handle.read(1)
     if c != b":":
         raise ValueError("not a tnetstring: missing or invalid length prefix")
-
-    data = file_handle.read(int(data_length))
-    data_type = file_handle.read(1)[0]
-
-    return parse(data_type, data)
+    return int(data_length)
 
 
 def parse(data_type: int, data: bytes) -> TSerializable:
-    if data_type == ord(b','):
-        return data
-    if data_type == ord(b';'):
-        return data.decode("utf8")
-    if data_type == ord(b'#'):
-        try:
-            return int(data)
-        except ValueError:
-            raise ValueError(f"not a tnetstring: invalid integer literal: {data!r}")
-    if data_type == ord(b'^'):
-        try:
-            return float(data)
-        except ValueError:
-            raise ValueError(f"not a tnetstring: invalid float literal: {data!r}")
-    if data_type == ord(b'!'):
-        if data == b'true':
-            return True
-        elif data == b'false':
-            return False
-        else:
-            raise ValueError(f"not a tnetstring: invalid boolean literal: {data!r}")
-    if data_type == ord(b'~'):
-        if data:
-            raise ValueError(f"not a tnetstring: invalid null literal: {data!r}")
-        return None
-    if data_type == ord(b']'):
-        l = []
-        while data:
-            item, data = pop(data)
-            l.append(item)  # type: ignore
-        return l
-    if data_type == ord(b'}'):
-        d = {}
-        while data:
-            key, data = pop(data)
-            val, data = pop(data)
-            d[key] = val  # type: ignore
-        return d
-    raise ValueError(f"unknown type tag: {data_type}")
+    data = _as_bytes(data)
+    return _parse(data_type, data, memoryview(data), 0, len(data))
 
 
 def pop(data: bytes) -> typing.Tuple[TSerializable, bytes]:
@@ -231,20 +249,90 @@ def pop(data: bytes) -> typing.Tuple[TSerializable, bytes]:
     It returns a tuple giving the parsed object and a string
     containing any unparsed data from the end of the string.
     """
-    #  Parse out data length, type and remaining string.
+    data = _as_bytes(data)
+    value, end = _pop(data, memoryview(data), 0, len(data))
+    return value, data[end:]
+
+
+def _as_bytes(data) -> bytes:
+    if isinstance(data, bytes):
+        return data
+    return bytes(data)
+
+
+def _pop(data: bytes, view: memoryview, start: int, end: int) -> typing.Tuple[TSerializable, int]:
+    """
+    Parse the tnetstring at data[start:end] and return the parsed object
+    and the offset of the first unparsed byte.
+
+    Offsets are used instead of slices, so that the remaining data is never
+    copied: parsing is linear in the size of the input.
+    """
+    #  Parse out data length and type.
+    #  A colon found beyond end leads to an invalid length below.
+    colon = data.find(b':', start, start + 21)
     try:
-        blength, data = data.split(b':', 1)
-        length = int(blength)
+        if colon < 0:
+            raise ValueError
+        length = int(data[start:colon])
     except ValueError:
-        raise ValueError(f"not a tnetstring: missing or invalid length prefix: {data!r}")
-    try:
-        data, data_type, remain = data[:length], data[length], data[length + 1:]
-    except IndexError:
-        #  This fires if len(data) < dlen, meaning we don't need
-        #  to further validate that data is the right length.
+        raise ValueError(f"not a tnetstring: missing or invalid length prefix: {data[start:start + 20]!r}")
+    start = colon + 1
+    stop = start + length
+    if length < 0 or stop >= end:
+        #  This fires if the data is shorter than the length prefix, meaning we
+        #  don't need to further validate that data is the right length.
         raise ValueError(f"not a tnetstring: invalid length prefix: {length}")
-    # Parse the data based on the type tag.
-    return parse(data_type, data), remain
+    # Parse the data based on the type tag, byte strings are the common case.
+    data_type = data[stop]
+    if data_type == 44:  # ','
+        return data[start:stop], stop + 1
+    return _parse(data_type, data, view, start, stop), stop + 1
+
+
+def _parse(data_type: int, data: bytes, view: memoryview, start: int, end: int) -> TSerializable:
+    if data_type == 44:  # ','
+        if start == 0 and end == len(data):
+            return data
+        return data[start:end]
+    if data_type == 59:  # ';'
+        return str(view[start:end], "utf8")
+    if data_type == 35:  # '#'
+        try:
+            return int(data[start:end])
+        except ValueError:
+            raise ValueError(f"not a tnetstring: invalid integer literal: {data[start:end]!r}")
+    if data_type == 93:  # ']'
+        l = []
+        while start < end:
+            item, start = _pop(data, view, start, end)
+            l.append(item)  # type: ignore
+        return l
+    if data_type == 125:  # '}'
+        d = {}
+        while start < end:
+            key, start = _pop(data, view, start, end)
+            val, start = _pop(data, view, start, end)
+            d[key] = val  # type: ignore
+        return d
+    if data_type == 94:  # '^'
+        try:
+            return float(data[start:end])
+        except ValueError:
+            raise ValueError(f"not a tnetstring: invalid float literal: {data[start:end]!r}")
+    if data_type == 33:  # '!'
+        value = data[start:end]
+        if value == b'true':
+            return True
+        elif value == b'false':
+            return False
+        else:
+            raise ValueError(f"not a tnetstring: invalid boolean literal: {value!r}")
+    if data_type == 126:  # '~'
+        if start != end:
+            raise ValueError(f"not a tnetstring: invalid null literal: {data[start:end]!r}")
+        return None
+    raise ValueError(f"unknown type tag: {data_type}")
 
 
 __all__ = ["dump", "dumps", "load", "loads", "pop"]
@@ -230,4 +230,83 @@ custom_encode = {
     "zstd": encode_zstd,
 }
 
-__all__ = ["encode", "decode"]
+
+class _IdentityDecoder:
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _ZlibDecoder:
+    """
+        Incremental gzip/deflate decoder. Like decode_deflate, deflate data
+        without a zlib header is accepted as well.
+    """
+    def __init__(self, wbits: int, lenient: bool = False):
+        self.obj = zlib.decompressobj(wbits)
+        self.lenient = lenient
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            decoded = self.obj.decompress(data)
+        except zlib.error:
+            if not self.lenient:
+                raise
+            self.obj = zlib.decompressobj(-15)
+            decoded = self.obj.decompress(data)
+        if data:
+            # The header has been seen, no more guessing.
+            self.lenient = False
+        return decoded
+
+    def flush(self) -> bytes:
+        return self.obj.flush()
+
+
+class _BrotliDecoder:
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.obj.process(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class _ZstdDecoder:
+    def __init__(self):
+        self.obj = zstd.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.obj.decompress(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def decoder(encoding: Optional[str]):
+    """
+    Return an incremental decoder for the given content-encoding, an object
+    with decompress(data) -> bytes and flush() -> bytes methods.
+
+    Raises:
+        ValueError, if the encoding is not supported.
+    """
+    encoding = (encoding or "identity").strip().lower()
+    if encoding in ("none", "identity"):
+        return _IdentityDecoder()
+    if encoding == "gzip":
+        return _ZlibDecoder(16 + zlib.MAX_WBITS)
+    if encoding in ("deflate", "deflateraw"):
+        return _ZlibDecoder(zlib.MAX_WBITS, lenient=True)
+    if encoding == "br":
+        return _BrotliDecoder()
+    if encoding == "zstd":
+        return _ZstdDecoder()
+    raise ValueError("Unsupported content encoding: {}".format(repr(encoding)))
+
+
+__all__ = ["encode", "decode", "decoder"]
@@ -1,6 +1,8 @@
 import os
 import errno
+import queue
 import select
+import selectors
 import socket
 import sys
 import threading
@@ -103,70 +105,134 @@ class Writer(_FileLike):
 
 class Reader(_FileLike):
 
-    def read(self, length):
+    def __init__(self, o):
+        super().__init__(o)
+        # Scratch buffer for recv_into, see _readinto.
+        self._buffer = memoryview(bytearray(self.BLOCKSIZE))
+
+    def _io(self, fn, *args):
         """
-            If length is -1, we read until connection closes.
+            Call fn(*args) on the underlying object, retry on SSL.WantRead/WantWrite
+            and translate errors into mitmproxy exceptions.
+
+            Returns a false value if the connection was closed.
         """
-        result = b''
         start = time.time()
-        while length == -1 or length > 0:
-            if length == -1 or length > self.BLOCKSIZE:
-                rlen = self.BLOCKSIZE
-            else:
-                rlen = length
+        while True:
             try:
-                data = self.o.read(rlen)
+                return fn(*args)
             except SSL.ZeroReturnError:
                 # TLS connection was shut down cleanly
-                break
-            except (SSL.WantWriteError, SSL.WantReadError):
+                return None
+            except (SSL.WantWriteError, SSL.WantReadError) as e:
                 # From the OpenSSL docs:
                 # If the underlying BIO is non-blocking, SSL_read() will also return when the
                 # underlying BIO could not satisfy the needs of SSL_read() to continue the
                 # operation. In this case a call to SSL_get_error with the return value of
                 # SSL_read() will yield SSL_ERROR_WANT_READ or SSL_ERROR_WANT_WRITE.
                 # 300 is OpenSSL default timeout
-                timeout = self.o.gettimeout() or 300
-                if (time.time() - start) < timeout:
-                    time.sleep(0.1)
-                    continue
-                else:
+                # Instead of polling, wait until the socket is actually ready.
+                remaining = (self.o.gettimeout() or 300) - (time.time() - start)
+                if remaining <= 0:
                     raise exceptions.TcpTimeout()
+                wait_ready(self.o, e.__class__ is SSL.WantWriteError, remaining)
+                continue
             except socket.timeout:
                 raise exceptions.TcpTimeout()
             except OSError as e:
                 raise exceptions.TcpDisconnect(str(e))
             except SSL.SysCallError as e:
                 if e.args == (-1, 'Unexpected EOF'):
-                    break
+                    return None
                 raise exceptions.TlsException(str(e))
             except SSL.Error as e:
                 raise exceptions.TlsException(str(e))
-            self.first_byte_timestamp = self.first_byte_timestamp or time.time()
-            if not data:
+
+    def _readinto(self, view):
+        if isinstance(self.o, SSL.Connection):
+            return self.o.recv_into(view, len(view))
+        if hasattr(self.o, "readinto"):
+            return self.o.readinto(view) or 0
+        data = self.o.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _peek_some(self, length):
+        """
+            Wait until data is available and return up to length bytes without consuming them.
+        """
+        if isinstance(self.o, socket_fileobject):
+            return self.o._sock.recv(length, socket.MSG_PEEK)
+        return self.o.recv(length, socket.MSG_PEEK)
+
+    def read(self, length):
+        """
+            If length is -1, we read until connection closes.
+        """
+        result = bytearray()
+        while length == -1 or length > 0:
+            if length == -1 or length > self.BLOCKSIZE:
+                rlen = self.BLOCKSIZE
+            else:
+                rlen = length
+            n = self._io(self._readinto, self._buffer[:rlen])
+            if not n:
                 break
-            result += data
+            self.first_byte_timestamp = self.first_byte_timestamp or time.time()
+            result += self._buffer[:n]
             if length != -1:
-                length -= len(data)
+                length -= n
+        result = bytes(result)
         self.add_log(result)
         return result
 
-    def readline(self, size=None):
-        result = b''
-        bytes_read = 0
-        while True:
-            if size is not None and bytes_read >= size:
+    def readuntil(self, delimiter, size=None):
+        """
+            Read up to and including the next occurrence of delimiter, at most
+            size bytes, or until the connection closes.
+
+            On sockets this never reads past the delimiter: the data is peeked
+            at first and then only the bytes up to the delimiter are consumed,
+            so whatever follows stays available to the next layer (e.g. a TLS
+            handshake after CONNECT, or a raw TCP/WebSocket relay).
+        """
+        if not isinstance(self.o, (socket_fileobject, SSL.Connection)):
+            return self._readuntil_bytewise(delimiter, size)
+        result = bytearray()
+        while size is None or len(result) < size:
+            rlen = self.BLOCKSIZE if size is None else min(self.BLOCKSIZE, size - len(result))
+            peeked = self._io(self._peek_some, rlen)
+            if not peeked:
+                break
+            # The delimiter may have started in what we already consumed.
+            overlap = min(len(delimiter) - 1, len(result))
+            found = (bytes(result[len(result) - overlap:]) + peeked).find(delimiter)
+            want = len(peeked) if found == -1 else found + len(delimiter) - overlap
+            n = self._io(self._readinto, self._buffer[:want])
+            if not n:
+                break
+            self.first_byte_timestamp = self.first_byte_timestamp or time.time()
+            result += self._buffer[:n]
+            if found != -1 and n == want:
                 break
+        result = bytes(result)
+        self.add_log(result)
+        return result
+
+    def _readuntil_bytewise(self, delimiter, size=None):
+        result = b''
+        while size is None or len(result) < size:
             ch = self.read(1)
-            bytes_read += 1
             if not ch:
                 break
-            else:
-                result += ch
-                if ch == b'\n':
-                    break
+            result += ch
+            if result.endswith(delimiter):
+                break
         return result
 
+    def readline(self, size=None):
+        return self.readuntil(b"\n", size)
+
     def safe_read(self, length):
         """
             Like .read, but is guaranteed to either return length bytes, or
@@ -208,9 +274,25 @@ class Reader(_FileLike):
             raise NotImplementedError("Can only peek into (pyOpenSSL) sockets")
 
 
+# poll() has no FD_SETSIZE limit, which select() hits with many open connections.
+_Selector = getattr(selectors, "PollSelector", selectors.SelectSelector)
+
+
+def wait_ready(conn, write=False, timeout=None):
+    """
+    Block until conn (a socket or SSL.Connection) is ready for reading or writing.
+
+    Returns:
+        False if the timeout expired first.
+    """
+    with _Selector() as selector:
+        selector.register(conn, selectors.EVENT_WRITE if write else selectors.EVENT_READ)
+        return bool(selector.select(timeout))
+
+
 def ssl_read_select(rlist, timeout):
     """
-    This is a wrapper around select.select() which also works for SSL.Connections
+    This is a wrapper around select() (poll() where available) which also works for SSL.Connections
     by taking ssl_connection.pending() into account.
 
     Caveats:
@@ -223,10 +305,16 @@ def ssl_read_select(rlist, timeout):
     Returns:
         subset of rlist which is ready for reading.
     """
-    return [
+    ready = [
         conn for conn in rlist
         if isinstance(conn, SSL.Connection) and conn.pending() > 0
-    ] or select.select(rlist, (), (), timeout)[0]
+    ]
+    if ready:
+        return ready
+    with _Selector() as selector:
+        for conn in rlist:
+            selector.register(conn, selectors.EVENT_READ)
+        return [key.fileobj for key, _ in selector.select(timeout)]
 
 
 def close_socket(sock):
@@ -377,6 +465,9 @@ class TCPClient(_Connection):
         # it tries to renegotiate...
         if self.connection:
             if isinstance(self.connection, SSL.Connection):
+                if self.tls_established:
+                    # By now we have seen the session tickets of TLS 1.3 servers.
+                    tls.save_client_session(self.connection)
                 close_socket(self.connection._socket)
             else:
                 close_socket(self.connection)
@@ -387,11 +478,9 @@ class TCPClient(_Connection):
             sni=sni,
             **sslctx_kwargs
         )
-        self.connection = SSL.Connection(context, self.connection)
+        self.connection = tls.client_connection(context, self.connection, sni, self.address)
         if sni:
             self.sni = sni
-            self.connection.set_tlsext_host_name(sni.encode("idna"))
-        self.connection.set_connect_state()
         try:
             self.connection.do_handshake()
         except SSL.Error as v:
@@ -399,6 +488,7 @@ class TCPClient(_Connection):
                 raise self.ssl_verification_error
             else:
                 raise exceptions.TlsException("SSL handshake error: %s" % repr(v))
+        tls.save_client_session(self.connection)
 
         self.cert = certs.Cert(self.connection.get_peer_certificate())
 
@@ -501,8 +591,12 @@ class BaseHandler(_Connection):
             cert=cert,
             key=key,
             **sslctx_kwargs)
-        self.connection = SSL.Connection(context, self.connection)
-        self.connection.set_accept_state()
+        self.connection = tls.server_connection(
+            context,
+            self.connection,
+            handle_sni=sslctx_kwargs.get("handle_sni"),
+            alpn_select_callback=sslctx_kwargs.get("alpn_select_callback"),
+        )
         try:
             self.connection.do_handshake()
         except SSL.Error as v:
@@ -546,9 +640,128 @@ class Counter:
             self._count -= 1
 
 
+class WorkerPool:
+    """
+        A bounded pool of threads for handling client connections.
+
+        Submitted jobs wait in a bounded queue until a worker is free. Workers
+        are started on demand up to max_workers and exit again after being
+        idle for idle_timeout seconds. Jobs that waited longer than
+        queue_timeout are passed to reject instead of being run: the client
+        has most likely given up on them already.
+    """
+
+    def __init__(
+        self,
+        name,
+        max_workers,
+        queue_size,
+        queue_timeout=None,
+        reject=None,
+        idle_timeout=60
+    ):
+        self.name = name
+        self.max_workers = max_workers
+        self.queue_timeout = queue_timeout
+        self.reject = reject
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self.workers = 0
+        self.idle = 0
+        self.busy = 0
+        self.handled = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def full(self):
+        return self.queue.full()
+
+    def submit(self, fn, *args):
+        """
+            Returns False if the queue is full and the job was not accepted.
+        """
+        try:
+            self.queue.put_nowait((time.monotonic(), fn, args))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        self._spawn()
+        return True
+
+    def _spawn(self):
+        with self._lock:
+            if self.workers >= self.max_workers or self.idle >= self.queue.qsize():
+                return
+            self.workers += 1
+            self.idle += 1
+        t = basethread.BaseThread(
+            f"{self.name} worker",
+            target=self._work,
+        )
+        t.daemon = True
+        try:
+            t.start()
+        except threading.ThreadError:
+            with self._lock:
+                self.workers -= 1
+                self.idle -= 1
+
+    def _work(self):
+        while True:
+            try:
+                queued_at, fn, args = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # A job may have been submitted right after the timeout,
+                    # while this worker was still counted as idle.
+                    if self.queue.qsize():
+                        continue
+                    self.workers -= 1
+                    self.idle -= 1
+                return
+            with self._lock:
+                self.idle -= 1
+                self.busy += 1
+            # Make sure the remaining jobs are not left waiting for this worker.
+            self._spawn()
+            try:
+                if self.queue_timeout and time.monotonic() - queued_at > self.queue_timeout:
+                    with self._lock:
+                        self.dropped += 1
+                    if self.reject:
+                        self.reject(*args)
+                else:
+                    fn(*args)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.idle += 1
+                    self.handled += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                max_workers=self.max_workers,
+                workers=self.workers,
+                busy=self.busy,
+                queued=self.queue.qsize(),
+                queue_size=self.queue.maxsize,
+                utilization=self.busy / self.max_workers,
+                handled=self.handled,
+                dropped=self.dropped,
+                rejected=self.rejected,
+            )
+
+
 class TCPServer:
 
-    def __init__(self, address):
+    def __init__(self, address, max_workers=0, queue_size=128, queue_timeout=None):
+        """
+            With max_workers=0 every connection is handled in its own thread,
+            otherwise connections are handled by a bounded WorkerPool.
+        """
         self.address = address
         self.__is_shut_down = threading.Event()
         self.__is_shut_down.set()
@@ -595,6 +808,17 @@ class TCPServer:
         self.address = self.socket.getsockname()
         self.socket.listen()
         self.handler_counter = Counter()
+        self.pool = None
+        if max_workers:
+            self.pool = WorkerPool(
+                "TCPConnectionHandler ({}: {}:{})".format(
+                    self.__class__.__name__, self.address[0], self.address[1]
+                ),
+                max_workers,
+                queue_size,
+                queue_timeout,
+                reject=lambda connection, client_address: close_socket(connection),
+            )
 
     def connection_thread(self, connection, client_address):
         with self.handler_counter:
@@ -616,9 +840,18 @@ class TCPServer:
         self.__is_shut_down.clear()
         try:
             while not self.__shutdown_request:
+                if self.pool is not None and self.pool.full():
+                    # Backpressure: leave new connections in the listen backlog
+                    # until the workers have caught up.
+                    time.sleep(poll_interval)
+                    continue
                 r, w_, e_ = select.select([self.socket], [], [], poll_interval)
                 if self.socket in r:
                     connection, client_address = self.socket.accept()
+                    if self.pool is not None:
+                        if not self.pool.submit(self.connection_thread, connection, client_address):
+                            close_socket(connection)
+                        continue
                     t = basethread.BaseThread(
                         "TCPConnectionHandler ({}: {}:{} -> {}:{})".format(
                             self.__class__.__name__,
@@ -640,6 +873,15 @@ class TCPServer:
             self.__shutdown_request = False
             self.__is_shut_down.set()
 
+    def stats(self):
+        """
+            Connection handling metrics: queue depth and worker utilization.
+        """
+        if self.pool is not None:
+            return self.pool.stats()
+        active = self.handler_counter.count
+        return dict(max_workers=0, workers=active, busy=active, queued=0)
+
     def shutdown(self):
         self.__shutdown_request = True
         self.__is_shut_down.wait()
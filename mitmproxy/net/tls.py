@@ -2,11 +2,13 @@
 # then add options to disable certain methods
 # https://bugs.launchpad.net/pyopenssl/+bug/1020632/comments/3
 import binascii
+import collections
 import io
 import os
 import struct
 import threading
 import typing
+import weakref
 
 import certifi
 from OpenSSL import SSL
@@ -212,6 +214,123 @@ def _create_ssl_context(
     return context
 
 
+class ContextCache:
+    """
+    Setting up an SSL context (trust store, certificate chain, cipher list, DH parameters)
+    costs more than many handshakes, but a context can be shared by any number of connections.
+    Contexts are cached by the arguments they are created with, the least recently used are dropped.
+
+    Sharing the context also enables session resumption: the server side keeps its session
+    cache and ticket keys in the context, and the client side offers the last session we had
+    with a server (see :py:meth:`get_session`).
+    """
+
+    def __init__(self, size: int = 512, sessions_per_context: int = 256) -> None:
+        self.size = size
+        self.sessions_per_context = sessions_per_context
+        self.lock = threading.Lock()
+        self.contexts: typing.OrderedDict[tuple, SSL.Context] = collections.OrderedDict()
+        self.sessions: typing.MutableMapping[SSL.Context, typing.OrderedDict[typing.Hashable, SSL.Session]] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def get(self, key: typing.Optional[tuple], create: typing.Callable[[], SSL.Context]) -> SSL.Context:
+        if key is None:
+            return create()
+        with self.lock:
+            context = self.contexts.get(key)
+            if context is not None:
+                self.contexts.move_to_end(key)
+                return context
+        # Creating a context takes a while, don't block other handshakes meanwhile.
+        context = create()
+        with self.lock:
+            context = self.contexts.setdefault(key, context)
+            self.contexts.move_to_end(key)
+            while len(self.contexts) > self.size:
+                self.contexts.popitem(last=False)
+        return context
+
+    def get_session(self, context: SSL.Context, server: typing.Hashable) -> typing.Optional[SSL.Session]:
+        with self.lock:
+            sessions = self.sessions.get(context)
+            return sessions.get(server) if sessions else None
+
+    def set_session(self, context: SSL.Context, server: typing.Hashable, session: SSL.Session) -> None:
+        with self.lock:
+            sessions = self.sessions.setdefault(context, collections.OrderedDict())
+            sessions[server] = session
+            sessions.move_to_end(server)
+            while len(sessions) > self.sessions_per_context:
+                sessions.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.contexts.clear()
+            self.sessions.clear()
+
+
+context_cache = ContextCache()
+
+
+def _cache_key(*args, **kwargs) -> typing.Optional[tuple]:
+    """
+    A hashable key for context arguments, or None if the arguments cannot be cached.
+    """
+    key = args + tuple(
+        (k, tuple(v) if isinstance(v, list) else v)
+        for k, v in sorted(kwargs.items())
+    )
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _connection_callback(name: str):
+    """
+    Contexts are shared, so per-connection callbacks are kept in the app data of the connection.
+    """
+    def callback(conn, *args):
+        return conn.get_app_data()[name](conn, *args)
+    callback.__name__ = name
+    return callback
+
+
+def _verify_server_cert(
+        conn: SSL.Connection,
+        x509: SSL.X509,
+        errno: int,
+        depth: int,
+        is_cert_verified: bool
+) -> bool:
+    data = conn.get_app_data() or {}
+    sni = data.get("sni")
+    if is_cert_verified and depth == 0 and not sni:
+        conn.cert_error = exceptions.InvalidCertificateException(
+            "Certificate verification error for {}: Cannot validate hostname, SNI missing.".format(
+                data.get("address")
+            )
+        )
+        is_cert_verified = False
+    elif is_cert_verified:
+        pass
+    else:
+        conn.cert_error = exceptions.InvalidCertificateException(
+            "Certificate verification error for {}: {} (errno: {}, depth: {})".format(
+                sni,
+                SSL._ffi.string(
+                    SSL._lib.X509_verify_cert_error_string(errno)).decode(),
+                errno,
+                depth
+            )
+        )
+
+    # SSL_VERIFY_NONE: The handshake will be continued regardless of the verification result.
+    return is_cert_verified
+
+
 def create_client_context(
         cert: str = None,
         sni: str = None,
@@ -220,6 +339,9 @@ def create_client_context(
         **sslctx_kwargs
 ) -> SSL.Context:
     """
+    Returns a (shared) client context. The context does not depend on the server:
+    use :py:func:`client_connection` to set up SNI and hostname verification for a connection.
+
     Args:
         cert: Path to a file containing both client cert and private key.
         sni: Server Name Indication. Required for VERIFY_PEER
@@ -231,44 +353,38 @@ def create_client_context(
         raise exceptions.TlsException(
             "Cannot validate certificate hostname without SNI")
 
-    def verify_callback(
-            conn: SSL.Connection,
-            x509: SSL.X509,
-            errno: int,
-            depth: int,
-            is_cert_verified: bool
-    ) -> bool:
-        if is_cert_verified and depth == 0 and not sni:
-            conn.cert_error = exceptions.InvalidCertificateException(
-                f"Certificate verification error for {address}: Cannot validate hostname, SNI missing."
-            )
-            is_cert_verified = False
-        elif is_cert_verified:
-            pass
-        else:
-            conn.cert_error = exceptions.InvalidCertificateException(
-                "Certificate verification error for {}: {} (errno: {}, depth: {})".format(
-                    sni,
-                    SSL._ffi.string(
-                        SSL._lib.X509_verify_cert_error_string(errno)).decode(),
-                    errno,
-                    depth
-                )
-            )
+    def create():
+        context = _create_ssl_context(
+            verify=verify,
+            verify_callback=_verify_server_cert,
+            **sslctx_kwargs,
+        )
 
-        # SSL_VERIFY_NONE: The handshake will be continued regardless of the verification result.
-        return is_cert_verified
+        # Client Certs
+        if cert:
+            try:
+                context.use_privatekey_file(cert)
+                context.use_certificate_chain_file(cert)
+            except SSL.Error as v:
+                raise exceptions.TlsException(
+                    "SSL client certificate error: %s" % str(v))
+        return context
+
+    return context_cache.get(_cache_key("client", cert, verify, **sslctx_kwargs), create)
 
-    context = _create_ssl_context(
-        verify=verify,
-        verify_callback=verify_callback,
-        **sslctx_kwargs,
-    )
 
+def client_connection(context: SSL.Context, sock, sni: str = None, address=None) -> SSL.Connection:
+    """
+    Creates a client connection for a context from :py:func:`create_client_context`,
+    and offers the last session with the same server for resumption.
+    """
+    conn = SSL.Connection(context, sock)
+    conn.set_app_data({"sni": sni, "address": address})
     if sni:
-        # Manually enable hostname verification on the context object.
+        conn.set_tlsext_host_name(sni.encode("idna"))
+        # Manually enable hostname verification on the connection.
         # https://wiki.openssl.org/index.php/Hostname_validation
-        param = SSL._lib.SSL_CTX_get0_param(context._context)
+        param = SSL._lib.SSL_get0_param(conn._ssl)
         # Matching on the CN is disabled in both Chrome and Firefox, so we disable it, too.
         # https://www.chromestatus.com/feature/4981025180483584
         SSL._lib.X509_VERIFY_PARAM_set_hostflags(
@@ -279,16 +395,25 @@ def create_client_context(
             SSL._lib.X509_VERIFY_PARAM_set1_host(
                 param, sni.encode("idna"), 0) == 1
         )
+    session = context_cache.get_session(context, (sni, address))
+    if session is not None:
+        conn.set_session(session)
+    conn.set_connect_state()
+    return conn
 
-    # Client Certs
-    if cert:
-        try:
-            context.use_privatekey_file(cert)
-            context.use_certificate_chain_file(cert)
-        except SSL.Error as v:
-            raise exceptions.TlsException(
-                "SSL client certificate error: %s" % str(v))
-    return context
+
+def save_client_session(conn: SSL.Connection) -> None:
+    """
+    Remembers the session of an established client connection for resumption.
+    TLS 1.3 servers send their session tickets after the handshake, so this should be called
+    again before the connection is closed.
+    """
+    data = conn.get_app_data()
+    if not data:
+        return
+    session = conn.get_session()
+    if session is not None:
+        context_cache.set_session(conn.get_context(), (data["sni"], data["address"]), session)
 
 
 def accept_all(
@@ -311,9 +436,15 @@ def create_server_context(
         chain_file=None,
         dhparams=None,
         extra_chain_certs: typing.Optional[typing.Iterable[certs.Cert]] = None,
+        alpn_select_callback: typing.Callable[[
+            typing.Any, typing.Any], bytes] = None,
         **sslctx_kwargs
 ) -> SSL.Context:
     """
+        Returns a (shared) server context. The handle_sni and alpn_select_callback
+        callbacks are not part of the context: use :py:func:`server_connection`
+        to create connections that use them.
+
         cert: A certs.Cert object or the path to a certificate
         chain file.
 
@@ -337,31 +468,66 @@ def create_server_context(
     else:
         verify = SSL.VERIFY_NONE
 
-    context = _create_ssl_context(
-        ca_pemfile=chain_file,
-        verify=verify,
-        verify_callback=accept_all,
-        **sslctx_kwargs,
-    )
-
-    context.use_privatekey(key)
-    if isinstance(cert, certs.Cert):
-        context.use_certificate(cert.x509)
-    else:
-        context.use_certificate_chain_file(cert)
+    def create():
+        context = _create_ssl_context(
+            ca_pemfile=chain_file,
+            verify=verify,
+            verify_callback=accept_all,
+            alpn_select_callback=_connection_callback("alpn_select_callback") if alpn_select_callback else None,
+            **sslctx_kwargs,
+        )
 
-    if extra_chain_certs:
-        for i in extra_chain_certs:
-            context.add_extra_chain_cert(i.x509)
+        context.use_privatekey(key)
+        if isinstance(cert, certs.Cert):
+            context.use_certificate(cert.x509)
+        else:
+            context.use_certificate_chain_file(cert)
 
-    if handle_sni:
-        # SNI callback happens during do_handshake()
-        context.set_tlsext_servername_callback(handle_sni)
+        if extra_chain_certs:
+            for i in extra_chain_certs:
+                context.add_extra_chain_cert(i.x509)
+
+        if handle_sni:
+            # SNI callback happens during do_handshake()
+            context.set_tlsext_servername_callback(_connection_callback("handle_sni"))
+
+        if dhparams:
+            SSL._lib.SSL_CTX_set_tmp_dh(context._context, dhparams)
+
+        # Session IDs are only resumed within the same session id context.
+        context.set_session_id(b"mitmproxy")
+        return context
+
+    key_ = _cache_key(
+        "server",
+        cert.digest("sha256") if isinstance(cert, certs.Cert) else cert,
+        # The key object itself: the cache keeps it alive, so its identity is not reused.
+        key,
+        handle_sni is not None,
+        alpn_select_callback is not None,
+        request_client_cert,
+        chain_file,
+        dhparams,
+        tuple(i.digest("sha256") for i in extra_chain_certs) if extra_chain_certs else None,
+        **sslctx_kwargs
+    )
+    return context_cache.get(key_, create)
 
-    if dhparams:
-        SSL._lib.SSL_CTX_set_tmp_dh(context._context, dhparams)
 
-    return context
+def server_connection(
+        context: SSL.Context,
+        sock,
+        handle_sni=None,
+        alpn_select_callback=None,
+) -> SSL.Connection:
+    """
+    Creates a server connection for a context from :py:func:`create_server_context`,
+    with the callbacks that were passed there.
+    """
+    conn = SSL.Connection(context, sock)
+    conn.set_app_data({"handle_sni": handle_sni, "alpn_select_callback": alpn_select_callback})
+    conn.set_accept_state()
+    return conn
 
 
 def is_tls_record_magic(d):
@@ -1,5 +1,6 @@
 from typing import Optional, Sequence
 
+from mitmproxy import certs
 from mitmproxy import optmanager
 from mitmproxy.net import tls
 
@@ -51,6 +52,33 @@ class Options(optmanager.OptManager):
             "cert_passphrase", Optional[str], None,
             "Passphrase for decrypting the private key provided in the --cert option."
         )
+        self.add_option(
+            "cert_cache_size", int, 1000,
+            """
+            Number of generated certificates kept on disk next to the CA, so
+            that they survive restarts. The least recently used are evicted.
+            0 to disable.
+            """
+        )
+        self.add_option(
+            "cert_key_type", str, "ecdsa",
+            """
+            Key type of generated certificates. "ecdsa" uses a P-256 key,
+            which makes handshakes with clients cheaper. "rsa" uses the key
+            pair of the CA.
+            """,
+            choices=list(certs.LEAF_KEY_TYPES),
+        )
+        self.add_option(
+            "cert_pregenerate", Sequence[str], [],
+            """
+            Hostnames to generate certificates for in the background at
+            startup. The pregenerated certificates cover the hostname only, so
+            they are used when the certificate is not derived from the
+            upstream certificate (upstream_cert disabled, or the server
+            connection is established after the client handshake).
+            """
+        )
         self.add_option(
             "ciphers_client", Optional[str], None,
             "Set supported ciphers for client connections using OpenSSL syntax."
@@ -85,10 +113,56 @@ class Options(optmanager.OptManager):
             "listen_port", int, LISTEN_PORT,
             "Proxy service port."
         )
+        self.add_option(
+            "connection_workers", int, 0,
+            """
+            Handle client connections with a pool of at most this many
+            threads. A connection occupies its worker until it is closed, so
+            this should be well above the number of connections a client keeps
+            open. 0 starts one thread per connection.
+            """
+        )
+        self.add_option(
+            "connection_queue", int, 128,
+            """
+            Number of accepted connections that may wait for a free worker.
+            When the queue is full, new connections stay in the listen backlog.
+            """
+        )
+        self.add_option(
+            "connection_queue_timeout", int, 30,
+            "Close queued connections that waited longer than this many seconds. 0 to disable."
+        )
+        self.add_option(
+            "upstream_keepalive", bool, False,
+            """
+            Keep upstream connections open after a completed HTTP/1 exchange
+            and reuse them for later requests to the same server with the same
+            TLS parameters, across client connections and replays. Reused
+            connections do not raise the serverconnect event again.
+            Not available in upstream proxy mode.
+            """
+        )
+        self.add_option(
+            "upstream_keepalive_timeout", int, 30,
+            "Close pooled upstream connections that have been idle for this many seconds."
+        )
+        self.add_option(
+            "upstream_keepalive_max", int, 6,
+            "Maximum number of idle pooled connections per upstream server."
+        )
         # 自定义添加
         self.add_option(
             "host", str, "", "只显示此域名"
         )
+        self.add_option(
+            "host_passthrough", bool, False,
+            """
+            设置了host时，CONNECT目标不匹配host的连接直接按TCP转发，
+            不解析http、不解密tls、不产生flow。
+            只作用于https，普通http请求仍会经过代理。
+            """
+        )
         self.add_option(
             "upstream_bind_address", str, "",
             "Address to bind upstream requests to."
@@ -106,6 +180,15 @@ class Options(optmanager.OptManager):
             "Connect to upstream server to look up certificate details."
         )
 
+        self.add_option(
+            "flow_load_processes", int, 0,
+            """
+            Decode large flow files in this many worker processes when they
+            are read for server replay at startup, or with --rfile while no
+            proxy server is running. 0 uses one process per CPU core, 1
+            decodes in the main process.
+            """
+        )
         self.add_option(
             "http2", bool, True,
             "Enable/disable HTTP/2 support. "
@@ -118,6 +201,17 @@ class Options(optmanager.OptManager):
             with misbehaving servers.
             """
         )
+        self.add_option(
+            "http2_stream_workers", int, 0,
+            """
+            Handle HTTP/2 streams with a pool of at most this many threads,
+            shared by all connections. Streams beyond that wait for a free
+            worker. A stream holds its worker for as long as it is open, so
+            long-lived streams such as server-sent events or long polls can
+            keep all others waiting; size the pool for them. 0 starts one
+            thread per stream.
+            """
+        )
         self.add_option(
             "websocket", bool, True,
             "Enable/disable WebSocket support. "
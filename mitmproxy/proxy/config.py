@@ -8,6 +8,18 @@ from mitmproxy import certs
 from mitmproxy import exceptions
 from mitmproxy import options as moptions
 from mitmproxy.net import server_spec
+from mitmproxy.proxy.pool import server_pool
+from mitmproxy.proxy.protocol import http2
+
+POOL_INVALIDATING_OPTIONS = {
+    "mode", "upstream_bind_address", "ssl_insecure", "ssl_verify_upstream_trusted_confdir",
+    "ssl_verify_upstream_trusted_ca", "ssl_version_server", "ciphers_server", "client_certs",
+}
+# Options the certificate store is built from. Rebuilding it discards the generated
+# certificates, the leaf key and pending prefetches, so other changes keep it.
+CERTSTORE_OPTIONS = {
+    "confdir", "key_size", "cert_passphrase", "cert_cache_size", "cert_key_type", "certs",
+}
 
 
 class HostMatcher:
@@ -50,42 +62,62 @@ class ProxyConfig:
             self.check_filter = HostMatcher("ignore", options.ignore_hosts)
         elif options.allow_hosts:
             self.check_filter = HostMatcher("allow", options.allow_hosts)
+        elif options.host and options.host_passthrough:
+            # softmock只关心host匹配的请求，其余的https连接直接转发
+            self.check_filter = HostMatcher("allow", [re.escape(options.host)])
         else:
             self.check_filter = HostMatcher(False)
         if "tcp_hosts" in updated:
             self.check_tcp = HostMatcher("tcp", options.tcp_hosts)
 
-        certstore_path = os.path.expanduser(options.confdir)
-        if not os.path.exists(os.path.dirname(certstore_path)):
-            raise exceptions.OptionsError(
-                "Certificate Authority parent directory does not exist: %s" %
-                os.path.dirname(certstore_path)
-            )
-        key_size = options.key_size
-        passphrase = options.cert_passphrase.encode("utf-8") if options.cert_passphrase else None
-        self.certstore = certs.CertStore.from_store(
-            certstore_path,
-            moptions.CONF_BASENAME,
-            key_size,
-            passphrase
+        server_pool.configure(
+            options.upstream_keepalive,
+            options.upstream_keepalive_timeout,
+            options.upstream_keepalive_max
         )
+        if updated & POOL_INVALIDATING_OPTIONS:
+            # Pooled connections were verified and set up with the previous settings.
+            server_pool.clear()
+        if "http2_stream_workers" in updated and options.http2_stream_workers:
+            http2.stream_workers.max_workers = options.http2_stream_workers
 
-        for c in options.certs:
-            parts = c.split("=", 1)
-            if len(parts) == 1:
-                parts = ["*", parts[0]]
-
-            cert = os.path.expanduser(parts[1])
-            if not os.path.exists(cert):
-                raise exceptions.OptionsError(
-                    "Certificate file does not exist: %s" % cert
-                )
-            try:
-                self.certstore.add_cert_file(parts[0], cert, passphrase)
-            except crypto.Error:
+        if updated & CERTSTORE_OPTIONS:
+            certstore_path = os.path.expanduser(options.confdir)
+            if not os.path.exists(os.path.dirname(certstore_path)):
                 raise exceptions.OptionsError(
-                    "Invalid certificate format: %s" % cert
+                    "Certificate Authority parent directory does not exist: %s" %
+                    os.path.dirname(certstore_path)
                 )
+            key_size = options.key_size
+            passphrase = options.cert_passphrase.encode("utf-8") if options.cert_passphrase else None
+            self.certstore = certs.CertStore.from_store(
+                certstore_path,
+                moptions.CONF_BASENAME,
+                key_size,
+                passphrase,
+                options.cert_cache_size,
+                options.cert_key_type
+            )
+
+            for c in options.certs:
+                parts = c.split("=", 1)
+                if len(parts) == 1:
+                    parts = ["*", parts[0]]
+
+                cert = os.path.expanduser(parts[1])
+                if not os.path.exists(cert):
+                    raise exceptions.OptionsError(
+                        "Certificate file does not exist: %s" % cert
+                    )
+                try:
+                    self.certstore.add_cert_file(parts[0], cert, passphrase)
+                except crypto.Error:
+                    raise exceptions.OptionsError(
+                        "Invalid certificate format: %s" % cert
+                    )
+
+        if options.cert_pregenerate and (CERTSTORE_OPTIONS | {"cert_pregenerate"}) & updated:
+            self.certstore.pregenerate(options.cert_pregenerate)
         m = options.mode
         if m.startswith("upstream:") or m.startswith("reverse:"):
             _, spec = server_spec.parse_with_mode(options.mode)
@@ -0,0 +1,146 @@
+import threading
+import time
+import typing
+
+from mitmproxy import connections
+from mitmproxy.net import tcp
+
+
+def server_key(address, tls: bool, sni: typing.Optional[str] = None, alpn=None) -> tuple:
+    """
+    The pool key of a server connection. Connections are only shared if they
+    were established to the same address with identical TLS parameters.
+    """
+    return (
+        tuple(address),
+        bool(tls),
+        sni if tls else None,
+        tuple(alpn) if tls and alpn else None,
+    )
+
+
+class ServerConnectionPool:
+    """
+    Idle upstream connections, keyed by :py:func:`server_key`.
+
+    A connection is only handed out to one user at a time. It is put back with
+    :py:meth:`release` after a complete request/response exchange, and is
+    checked for liveness before it is reused: connections that have been idle
+    longer than ``idle_timeout`` or became readable (closed by the server, or
+    unexpected data) are closed instead.
+    """
+
+    def __init__(self, idle_timeout: float = 30, max_per_host: int = 6) -> None:
+        self.enabled = False
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        self.lock = threading.Lock()
+        # key -> [(connection, idle since)], the most recently used at the end
+        self.idle: typing.Dict[tuple, typing.List[typing.Tuple[connections.ServerConnection, float]]] = {}
+        self.reused = 0
+        self.released = 0
+        self.discarded = 0
+
+    def configure(self, enabled: bool, idle_timeout: float, max_per_host: int) -> None:
+        self.enabled = enabled
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        if not enabled:
+            self.clear()
+
+    def acquire(self, key: tuple) -> typing.Optional[connections.ServerConnection]:
+        """
+        Take an idle connection for key out of the pool, or return None.
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self.lock:
+            entries = self.idle.get(key)
+            while entries:
+                candidate, since = entries.pop()
+                if now - since < self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+            if not entries:
+                self.idle.pop(key, None)
+        # Checking the socket does not need the lock.
+        if conn is not None and not self._alive(conn):
+            stale.append(conn)
+            conn = None
+        self._close(stale)
+        if conn is not None:
+            with self.lock:
+                self.reused += 1
+        return conn
+
+    def release(self, conn: connections.ServerConnection) -> bool:
+        """
+        Put a connection back into the pool.
+        Returns False if the connection cannot be pooled; the caller has to close it then.
+        """
+        key = getattr(conn, "pool_key", None)
+        if not self.enabled or key is None or not conn.connected():
+            return False
+        if conn.get_alpn_proto_negotiated() == b"h2":
+            # HTTP/2 connections are multiplexed by their layer and never shared.
+            return False
+        now = time.monotonic()
+        stale = []
+        with self.lock:
+            entries = self.idle.setdefault(key, [])
+            while entries and now - entries[0][1] >= self.idle_timeout:
+                stale.append(entries.pop(0)[0])
+            pooled = len(entries) < self.max_per_host
+            if pooled:
+                conn.reusable = False
+                entries.append((conn, now))
+                self.released += 1
+            elif not entries:
+                del self.idle[key]
+        self._close(stale)
+        return pooled
+
+    def clear(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        self._close(conn for entries in idle.values() for conn, _ in entries)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "idle": sum(len(i) for i in self.idle.values()),
+                "hosts": len(self.idle),
+                "reused": self.reused,
+                "released": self.released,
+                "discarded": self.discarded,
+            }
+
+    @staticmethod
+    def _alive(conn: connections.ServerConnection) -> bool:
+        if not conn.connected():
+            return False
+        try:
+            if conn.tls_established and conn.connection.pending():
+                return False
+            # An idle connection must not have anything to read:
+            # readable means EOF, a reset or a response nobody asked for.
+            return not tcp.wait_ready(conn.connection, timeout=0)
+        except (OSError, ValueError):
+            return False
+
+    def _close(self, conns) -> None:
+        for conn in conns:
+            with self.lock:
+                self.discarded += 1
+            try:
+                conn.finish()
+            except Exception:
+                pass
+            conn.close()
+
+
+server_pool = ServerConnectionPool()
@@ -2,6 +2,7 @@ from mitmproxy import exceptions
 from mitmproxy import connections
 from mitmproxy import controller  # noqa
 from mitmproxy.proxy import config  # noqa
+from mitmproxy.proxy.pool import server_pool
 
 
 class _LayerCodeCompletion:
@@ -147,14 +148,32 @@ class ServerConnectionMixin:
         Deletes (and closes) an existing server connection.
         Must not be called if there is no existing connection.
         """
-        self.log("serverdisconnect", "debug", [repr(self.server_conn.address)])
         address = self.server_conn.address
-        self.server_conn.finish()
-        self.server_conn.close()
-        self.channel.tell("serverdisconnect", self.server_conn)
+        if self.server_conn.reusable and server_pool.release(self.server_conn):
+            self.log("serverdisconnect (pooled)", "debug", [repr(address)])
+        else:
+            self.log("serverdisconnect", "debug", [repr(address)])
+            self.server_conn.finish()
+            self.server_conn.close()
+            self.channel.tell("serverdisconnect", self.server_conn)
 
         self.server_conn = self.__make_server_conn(address)
 
+    def reuse_server_conn(self, key) -> bool:
+        """
+        Replaces the (not yet connected) server connection with an idle pooled connection for key.
+        Returns False if there is none; the caller has to connect then.
+        The serverconnect event is not sent again for a reused connection.
+        """
+        if self.server_conn.connected() or self.config.options.spoof_source_address:
+            return False
+        conn = server_pool.acquire(key)
+        if conn is None:
+            return False
+        self.server_conn = conn
+        self.log("serverconnect (reused)", "debug", [repr(conn.address)])
+        return True
+
     def connect(self):
         """
         Establishes a server connection.
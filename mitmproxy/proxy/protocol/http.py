@@ -214,6 +214,7 @@ class HttpLayer(base.Layer):
                 resp = f.response
             else:
                 resp = http.make_connect_response(f.request.data.http_version)
+                self.prefetch_cert(f.request.host, f.request.port)
 
             self.send_response(resp)
 
@@ -232,6 +233,28 @@ class HttpLayer(base.Layer):
 
         return False
 
+    def prefetch_cert(self, host: str, port: int) -> None:
+        """
+        Start generating the certificate for the host of a CONNECT request while the client
+        starts its TLS handshake.
+
+        This only applies with upstream_cert disabled. Otherwise the certificate is derived
+        from the server certificate, which is not known before the server handshake, so there
+        is nothing to generate ahead of time.
+        """
+        if self.config.options.upstream_cert:
+            return
+        address = (host, port)
+        if self.config.check_filter and self.config.check_filter(address):
+            return
+        if self.config.check_tcp(address):
+            return
+        try:
+            name = host.encode("idna")
+        except UnicodeError:
+            return
+        self.config.certstore.prefetch(name, [name])
+
     def handle_upstream_connect(self, f):
         # if the user specifies a response in the http_connect hook, we do not connect upstream here.
         # https://github.com/mitmproxy/mitmproxy/pull/2473
@@ -460,6 +483,9 @@ class HttpLayer(base.Layer):
             if self.check_close_connection(f):
                 return False
 
+            if f.response.status_code != 101 and f.server_conn is self.server_conn:
+                self.server_conn.reusable = True
+
             # Handle 101 Switching Protocols
             if f.response.status_code == 101:
                 # Handle a successful HTTP 101 Switching Protocols Response,
@@ -525,9 +551,11 @@ class HttpLayer(base.Layer):
                 self.set_server_tls(tls, address[0])
             # Establish connection is necessary.
             if not self.server_conn.connected():
-                self.connect()
+                self.connect(reuse=True)
         else:
             if not self.server_conn.connected():
                 self.connect()
             if tls:
                 raise exceptions.HttpProtocolException("Cannot change scheme in upstream proxy mode.")
+        # Only a completed exchange makes the connection reusable again.
+        self.server_conn.reusable = False
@@ -27,6 +27,8 @@ class SafeH2Connection(connection.H2Connection):
         super().__init__(*args, **kwargs)
         self.conn = conn
         self.lock = threading.RLock()
+        # Notified when the peer opens up flow control windows.
+        self.window_updated = threading.Condition(self.lock)
 
     def safe_acknowledge_received_data(self, acknowledged_size: int, stream_id: int):
         if acknowledged_size == 0:
@@ -56,19 +58,24 @@ class SafeH2Connection(connection.H2Connection):
             self.send_headers(stream_id, headers.fields, **kwargs)
             self.conn.send(self.data_to_send())
 
+    def notify_window_updated(self):
+        with self.window_updated:
+            self.window_updated.notify_all()
+
     def safe_send_body(self, raise_zombie: Callable, stream_id: int, chunks: List[bytes], end_stream=True):
         for chunk in chunks:
             position = 0
             while position < len(chunk):
                 self.lock.acquire()
                 raise_zombie(self.lock.release)
-                max_outbound_frame_size = self.max_outbound_frame_size
-                frame_chunk = chunk[position:position +
-                                    max_outbound_frame_size]
-                if self.local_flow_control_window(stream_id) < len(frame_chunk):  # pragma: no cover
+                window = self.local_flow_control_window(stream_id)
+                if window <= 0:  # pragma: no cover
+                    # Wait for a WINDOW_UPDATE or SETTINGS frame from the peer.
+                    # The timeout makes sure we notice streams that died in the meantime.
+                    self.window_updated.wait(0.1)
                     self.lock.release()
-                    time.sleep(0.1)
                     continue
+                frame_chunk = chunk[position:position + min(window, self.max_outbound_frame_size)]
                 self.send_data(stream_id, frame_chunk)
                 try:
                     self.conn.send(self.data_to_send())
@@ -76,7 +83,7 @@ class SafeH2Connection(connection.H2Connection):
                     raise e
                 finally:
                     self.lock.release()
-                position += max_outbound_frame_size
+                position += len(frame_chunk)
         if end_stream:
             with self.lock:
                 raise_zombie()
@@ -169,7 +176,7 @@ class Http2Layer(base.Layer):
         elif isinstance(event, events.StreamReset):
             return self._handle_stream_reset(eid, event, is_server, other_conn)
         elif isinstance(event, events.RemoteSettingsChanged):
-            return self._handle_remote_settings_changed(event, other_conn)
+            return self._handle_remote_settings_changed(event, source_conn, other_conn)
         elif isinstance(event, events.ConnectionTerminated):
             return self._handle_connection_terminated(event, is_server)
         elif isinstance(event, events.PushedStreamReceived):
@@ -178,6 +185,8 @@ class Http2Layer(base.Layer):
             return self._handle_priority_updated(eid, event)
         elif isinstance(event, events.TrailersReceived):
             return self._handle_trailers(eid, event, is_server, other_conn)
+        elif isinstance(event, events.WindowUpdated):
+            return self._handle_window_updated(source_conn)
 
         # fail-safe for unhandled events
         return True
@@ -193,7 +202,14 @@ class Http2Layer(base.Layer):
             self.streams[eid].priority_depends_on = event.priority_updated.depends_on
             self.streams[eid].priority_weight = event.priority_updated.weight
             self.streams[eid].handled_priority_event = event.priority_updated
-        self.streams[eid].start()
+        if not self.streams[eid].start():
+            self.log("Too many HTTP/2 streams waiting for a worker, refusing stream.", "info")
+            self.streams[eid].kill()
+            self.connections[self.client_conn].safe_reset_stream(
+                eid,
+                h2.errors.ErrorCodes.REFUSED_STREAM
+            )
+            return True
         self.streams[eid].request_message.arrived.set()
         return True
 
@@ -249,10 +265,16 @@ class Http2Layer(base.Layer):
         self.streams[eid].trailers = trailers
         return True
 
-    def _handle_remote_settings_changed(self, event, other_conn):
+    def _handle_remote_settings_changed(self, event, source_conn, other_conn):
         new_settings = {key: cs.new_value for (
             key, cs) in event.changed_settings.items()}
         self.connections[other_conn].safe_update_settings(new_settings)
+        # A new initial window size changes the windows of all streams.
+        self.connections[source_conn].notify_window_updated()
+        return True
+
+    def _handle_window_updated(self, source_conn):
+        self.connections[source_conn].notify_window_updated()
         return True
 
     def _handle_connection_terminated(self, event, is_server):
@@ -301,7 +323,13 @@ class Http2Layer(base.Layer):
         self.streams[event.pushed_stream_id].timestamp_end = time.time()
         self.streams[event.pushed_stream_id].request_message.arrived.set()
         self.streams[event.pushed_stream_id].request_message.stream_ended.set()
-        self.streams[event.pushed_stream_id].start()
+        if not self.streams[event.pushed_stream_id].start():
+            self.log("Too many HTTP/2 streams waiting for a worker, refusing pushed stream.", "info")
+            self.streams[event.pushed_stream_id].kill()
+            self.connections[self.client_conn].safe_reset_stream(
+                event.pushed_stream_id,
+                h2.errors.ErrorCodes.REFUSED_STREAM
+            )
         return True
 
     def _handle_priority_updated(self, eid, event):
@@ -410,6 +438,11 @@ class Http2Layer(base.Layer):
             self._kill_all_streams()
 
 
+# Runs the streams of all HTTP/2 connections, see the http2_stream_workers option.
+# Its size is set by ProxyConfig.configure. Streams that do not fit into the
+# queue are refused with REFUSED_STREAM.
+stream_workers = tcp.WorkerPool("Http2SingleStreamLayer", 64, 4096)
+
 def detect_zombie_stream(func):  # pragma: no cover
     @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
@@ -421,7 +454,13 @@ def detect_zombie_stream(func):  # pragma: no cover
     return wrapper
 
 
-class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThread):
+class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer):
+    """
+    A single HTTP/2 stream. The Http2Layer reads all frames of the connection
+    and feeds them into the stream's messages; the stream itself runs the
+    regular HttpLayer on a shared worker thread (or its own thread if
+    http2_stream_workers is 0).
+    """
 
     class Message:
         def __init__(self, headers=None):
@@ -440,9 +479,8 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
             self.stream_ended = threading.Event()
 
     def __init__(self, ctx, h2_connection, stream_id: int, request_headers: mitmproxy.net.http.Headers) -> None:
-        super().__init__(
-            ctx, name=f"Http2SingleStreamLayer-{stream_id}"
-        )
+        super().__init__(ctx)
+        self.name = f"Http2SingleStreamLayer-{stream_id}"
         self.h2_connection = h2_connection
         self.zombie: Optional[float] = None
         self.client_stream_id: int = stream_id
@@ -468,7 +506,7 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
             self.response_message.arrived.set()
             self.response_message.stream_ended.set()
 
-    def connect(self):  # pragma: no cover
+    def connect(self, reuse=False):  # pragma: no cover
         raise exceptions.Http2ProtocolException(
             "HTTP2 layer should already have a connection.")
 
@@ -751,7 +789,17 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
             )
 
     def __call__(self):  # pragma: no cover
-        raise OSError('Http2SingleStreamLayer must be run as thread')
+        raise OSError('Http2SingleStreamLayer must be run with start()')
+
+    def start(self) -> bool:
+        """
+        Schedule the stream. Returns False if it had to be refused because
+        too many streams are already waiting for a worker.
+        """
+        if self.config.options.http2_stream_workers:
+            return stream_workers.submit(self.run)
+        basethread.BaseThread(self.name, target=self.run).start()
+        return True
 
     def run(self):
         layer = httpbase.HttpLayer(self, self.mode)
@@ -768,5 +816,8 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
                 f"Changing the Host server for HTTP/2 connections not allowed: {e}", "info")
         except exceptions.Kill:  # pragma: no cover
             self.log(flow.Error.KILLED_MESSAGE, "info")
+        except Exception as e:  # pragma: no cover
+            # Workers are shared between streams, an unexpected error must not take one down.
+            self.log(f"Unexpected error in HTTP/2 stream: {e!r}", "error")
 
         self.kill()
@@ -3,6 +3,7 @@ from typing import Union
 
 from mitmproxy import exceptions
 from mitmproxy.net import tls as net_tls
+from mitmproxy.proxy import pool
 from mitmproxy.proxy.protocol import base
 
 # taken from https://testssl.sh/openssl-rfc.mapping.html
@@ -294,12 +295,30 @@ class TlsLayer(base.Layer):
         else:
             return "TlsLayer(inactive)"
 
-    def connect(self):
+    def connect(self, reuse=False):
+        """
+        Args:
+            reuse: Use an idle connection from the upstream connection pool if there is one.
+                Only for connections that are going to speak HTTP.
+        """
         if not self.server_conn.connected():
-            self.ctx.connect()
+            key = self._server_pool_key() if reuse and self._pool_server_conn() else None
+            if key is None or not self.ctx.reuse_server_conn(key):
+                self.ctx.connect()
+                self.server_conn.pool_key = key
         if self._server_tls and not self.server_conn.tls_established:
             self._establish_tls_with_server()
 
+    def _pool_server_conn(self):
+        # In upstream mode, the server connection belongs to the upstream proxy (and to a CONNECT tunnel).
+        options = self.config.options
+        return options.upstream_keepalive and not options.mode.startswith("upstream:")
+
+    def _server_pool_key(self):
+        if self._server_tls:
+            return pool.server_key(self.server_conn.address, True, self.server_sni, self._server_alpn())
+        return pool.server_key(self.server_conn.address, False)
+
     def set_server_tls(self, server_tls: bool, sni: Union[str, None, bool] = None) -> None:
         """
         Set the TLS settings for the next server connection that will be established.
@@ -354,8 +373,7 @@ class TlsLayer(base.Layer):
 
     def _establish_tls_with_client_and_server(self):
         try:
-            self.ctx.connect()
-            self._establish_tls_with_server()
+            self.connect(reuse=True)
         except Exception:
             # If establishing TLS with the server fails, we try to establish TLS with the client nonetheless
             # to send an error message over TLS.
@@ -402,44 +420,53 @@ class TlsLayer(base.Layer):
                 sni_str or repr(self.server_conn.address)
             )
 
+    def _server_alpn(self):
+        """
+        The application protocols we offer to the server.
+        """
+        alpn = None
+        if self._client_tls:
+            if self._client_hello.alpn_protocols:
+                # We only support http/1.1 and h2.
+                # If the server only supports spdy (next to http/1.1), it may select that
+                # and mitmproxy would enter TCP passthrough mode, which we want to avoid.
+                alpn = [
+                    x for x in self._client_hello.alpn_protocols if
+                    not (x.startswith(b"h2-") or x.startswith(b"spdy"))
+                ]
+            if alpn and b"h2" in alpn and not self.config.options.http2:
+                alpn.remove(b"h2")
+
+        if self.client_conn.tls_established and self.client_conn.get_alpn_proto_negotiated():
+            # If the client has already negotiated an ALP, then force the
+            # server to use the same. This can only happen if the host gets
+            # changed after the initial connection was established. E.g.:
+            #   * the client offers http/1.1 and h2,
+            #   * the initial host is only capable of http/1.1,
+            #   * then the first server connection negotiates http/1.1,
+            #   * but after the server_conn change, the new host offers h2
+            #   * which results in garbage because the layers don' match.
+            alpn = [self.client_conn.get_alpn_proto_negotiated()]
+        return alpn
+
+    def _server_ciphers(self):
+        # We pass through the list of ciphers send by the client, because some HTTP/2 servers
+        # will select a non-HTTP/2 compatible cipher from our default list and then hang up
+        # because it's incompatible with h2. :-)
+        ciphers_server = self.config.options.ciphers_server
+        if not ciphers_server and self._client_tls:
+            ciphers_server = []
+            for id in self._client_hello.cipher_suites:
+                if id in CIPHER_ID_NAME_MAP.keys():
+                    ciphers_server.append(CIPHER_ID_NAME_MAP[id])
+            ciphers_server = ':'.join(ciphers_server)
+        return ciphers_server
+
     def _establish_tls_with_server(self):
         self.log("Establish TLS with server", "debug")
         try:
-            alpn = None
-            if self._client_tls:
-                if self._client_hello.alpn_protocols:
-                    # We only support http/1.1 and h2.
-                    # If the server only supports spdy (next to http/1.1), it may select that
-                    # and mitmproxy would enter TCP passthrough mode, which we want to avoid.
-                    alpn = [
-                        x for x in self._client_hello.alpn_protocols if
-                        not (x.startswith(b"h2-") or x.startswith(b"spdy"))
-                    ]
-                if alpn and b"h2" in alpn and not self.config.options.http2:
-                    alpn.remove(b"h2")
-
-            if self.client_conn.tls_established and self.client_conn.get_alpn_proto_negotiated():
-                # If the client has already negotiated an ALP, then force the
-                # server to use the same. This can only happen if the host gets
-                # changed after the initial connection was established. E.g.:
-                #   * the client offers http/1.1 and h2,
-                #   * the initial host is only capable of http/1.1,
-                #   * then the first server connection negotiates http/1.1,
-                #   * but after the server_conn change, the new host offers h2
-                #   * which results in garbage because the layers don' match.
-                alpn = [self.client_conn.get_alpn_proto_negotiated()]
-
-            # We pass through the list of ciphers send by the client, because some HTTP/2 servers
-            # will select a non-HTTP/2 compatible cipher from our default list and then hang up
-            # because it's incompatible with h2. :-)
-            ciphers_server = self.config.options.ciphers_server
-            if not ciphers_server and self._client_tls:
-                ciphers_server = []
-                for id in self._client_hello.cipher_suites:
-                    if id in CIPHER_ID_NAME_MAP.keys():
-                        ciphers_server.append(CIPHER_ID_NAME_MAP[id])
-                ciphers_server = ':'.join(ciphers_server)
-
+            alpn = self._server_alpn()
+            ciphers_server = self._server_ciphers()
             args = net_tls.client_arguments_from_options(self.config.options)
             args["cipher_list"] = ciphers_server
             self.server_conn.establish_tls(
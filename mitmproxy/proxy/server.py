@@ -9,7 +9,9 @@ from mitmproxy import log
 from mitmproxy import platform
 from mitmproxy.proxy import config
 from mitmproxy.proxy import modes
+from mitmproxy.proxy import pool
 from mitmproxy.proxy import root_context
+from mitmproxy.proxy.protocol import http2
 from mitmproxy.net import tcp
 from mitmproxy.net.http import http1
 from mitmproxy.utils import human
@@ -31,6 +33,9 @@ class DummyServer:
     def shutdown(self):
         pass
 
+    def stats(self):
+        return {}
+
 
 class ProxyServer(tcp.TCPServer):
     allow_reuse_address = True
@@ -44,7 +49,10 @@ class ProxyServer(tcp.TCPServer):
         self.config = config
         try:
             super().__init__(
-                (config.options.listen_host, config.options.listen_port)
+                (config.options.listen_host, config.options.listen_port),
+                max_workers=config.options.connection_workers,
+                queue_size=config.options.connection_queue,
+                queue_timeout=config.options.connection_queue_timeout,
             )
             if config.options.mode == "transparent":
                 platform.init_transparent_mode()
@@ -58,6 +66,9 @@ class ProxyServer(tcp.TCPServer):
     def set_channel(self, channel):
         self.channel = channel
 
+    def stats(self):
+        return dict(super().stats(), upstream=pool.server_pool.stats(), http2=http2.stream_workers.stats())
+
     def handle_client_connection(self, conn, client_address):
         h = ConnectionHandler(
             conn,
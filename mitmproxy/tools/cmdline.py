@@ -55,6 +55,8 @@ def common_options(parser, opts):
     group = parser.add_argument_group("Proxy Options")
     opts.make_parser(group, "listen_host", metavar="HOST")
     opts.make_parser(group, "listen_port", metavar="PORT", short="p")
+    opts.make_parser(group, "connection_workers", metavar="N")
+    opts.make_parser(group, "upstream_keepalive")
     opts.make_parser(group, "server", short="n")
     opts.make_parser(group, "ignore_hosts", metavar="HOST")
     opts.make_parser(group, "allow_hosts", metavar="HOST")
@@ -68,6 +70,7 @@ def common_options(parser, opts):
     group = parser.add_argument_group("SSL")
     opts.make_parser(group, "certs", metavar="SPEC")
     opts.make_parser(group, "cert_passphrase", metavar="PASS")
+    opts.make_parser(group, "cert_pregenerate", metavar="HOST")
     opts.make_parser(group, "ssl_insecure", short="k")
     opts.make_parser(group, "key_size", metavar="KEY_SIZE")
 
@@ -139,6 +142,7 @@ def mitmweb(opts):
     opts.make_parser(group, "web_host", metavar="HOST")
     # 限制域名
     opts.make_parser(group, "host", metavar="HOST")
+    opts.make_parser(group, "host_passthrough")
 
     common_options(parser, opts)
     group = parser.add_argument_group(
@@ -3,14 +3,12 @@ import hashlib
 import json
 import logging
 import os.path
-import sqlite3
 import re
 import base64
+import weakref
 from io import BytesIO
-from typing import ClassVar, Optional
+from typing import ClassVar, Optional, Union
 from pyparsing import Keyword
-from urllib import parse
-from cchardet import detect
 
 import tornado.escape
 import tornado.web
@@ -27,16 +25,120 @@ from mitmproxy import log
 from mitmproxy import optmanager
 from mitmproxy import version
 from mitmproxy import ctx
-from .replay import proxy_req
-from softmock.database import database
+from mitmproxy.addons.streambodies import Tee
+from softmock.database import parse_status, encode_html, encode_flags
+from softmock.store import store
+from softmock.recorder import recorder
+from softmock.cache import mock_index
+from softmock.replay import Refresher, select_urls
 
 
-def flow_to_json(flow: mitmproxy.flow.Flow) -> dict:
+# 每个message由body计算出的数据（hash、解码后的内容），
+# 只在message的raw_content还是同一个对象时有效，内容修改后重新计算
+_content_cache: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _content_memo(message: Union[http.HTTPRequest, http.HTTPResponse]) -> dict:
+    memo = _content_cache.get(message, None)
+    if memo is None or memo["raw_content"] is not message.raw_content:
+        memo = {"raw_content": message.raw_content}
+        _content_cache[message] = memo
+    return memo
+
+
+def content_hash(message: Union[http.HTTPRequest, http.HTTPResponse]) -> Optional[str]:
+    tee = streamed_body(message)
+    if tee is not None:
+        # 流式转发的body在转发时已经计算了解码后的hash
+        return tee.hexdigest()
+    if not message.raw_content:
+        return None
+    memo = _content_memo(message)
+    if "hash" not in memo:
+        memo["hash"] = hashlib.sha256(message.raw_content).hexdigest()
+    return memo["hash"]
+
+
+def streamed_body(message: Union[http.HTTPRequest, http.HTTPResponse]) -> Optional[Tee]:
+    """
+    流式转发的body的完整副本，见stream_tee
+    """
+    tee = message.stream
+    if isinstance(tee, Tee) and tee.done:
+        return tee
+    return None
+
+
+def release_streamed_body(flow: mitmproxy.flow.Flow) -> None:
+    """
+    释放不会被录制的流式响应body副本，等待录制的副本由recorder释放
+    """
+    if isinstance(flow, http.HTTPFlow) and flow.response and isinstance(flow.response.stream, Tee):
+        if not recorder.holds(flow.response.stream):
+            flow.response.stream.close()
+
+
+def content_length(message: Union[http.HTTPRequest, http.HTTPResponse]) -> Optional[int]:
+    tee = streamed_body(message)
+    if tee is not None:
+        return tee.size
+    return len(message.raw_content) if message.raw_content else None
+
+
+def request_text(request: http.HTTPRequest) -> str:
+    if not request.raw_content:
+        return ""
+    memo = _content_memo(request)
+    if "text" not in memo:
+        try:
+            memo["text"] = request.raw_content.decode()
+        except UnicodeDecodeError:
+            memo["text"] = ""
+    return memo["text"]
+
+
+def response_body(response: http.HTTPResponse) -> bytes:
+    """
+    解码content-encoding后的响应body，用于录制
+    """
+    memo = _content_memo(response)
+    if "content" not in memo:
+        memo["content"] = response.get_content(strict=False)
+    return memo["content"]
+
+
+def response_html(response: http.HTTPResponse) -> dict:
+    """
+    响应body转换为前端使用的html字段，见softmock.database.encode_html
+    """
+    if not response.raw_content:
+        return dict(html=None)
+    memo = _content_memo(response)
+    if "html" not in memo:
+        memo["html"] = encode_html(response_body(response))
+    return memo["html"]
+
+
+def flow_content_to_json(flow: http.HTTPFlow, f: dict) -> dict:
+    """
+    为content=False序列化的flow补上body内容
+    """
+    if flow.request and "request" in f:
+        f["request"]["raw_content"] = request_text(flow.request)
+    if flow.response and "response" in f:
+        f["response"].update(response_html(flow.response))
+    return f
+
+
+def flow_to_json(flow: mitmproxy.flow.Flow, content: bool = True) -> dict:
     """
     Remove flow message content and cert to save transmission space.
 
     Args:
         flow: The original flow.
+        content: Include the decoded body text. List updates only need the
+            metadata and content hashes, the text can be added later with
+            flow_content_to_json.
     """
     f = {
         "id": flow.id,
@@ -47,6 +149,9 @@ def flow_to_json(flow: mitmproxy.flow.Flow) -> dict:
         "type": flow.type,
         "modified": flow.modified(),
         "marked": flow.marked,
+        # 命中的softmock路由模板
+        "mock_route": flow.metadata.get("mock_route", None),
+        "mocked": flow.metadata.get("mocked", False),
     }
     # .alpn_proto_negotiated is bytes, we need to decode that.
     for conn in "client_conn", "server_conn":
@@ -60,31 +165,17 @@ def flow_to_json(flow: mitmproxy.flow.Flow) -> dict:
         f["error"] = flow.error.get_state()
 
     if isinstance(flow, http.HTTPFlow):
-        content_length: Optional[int]
-        content_hash: Optional[str]
         if flow.request:
-            if flow.request.raw_content:
-                content_length = len(flow.request.raw_content)
-                content_hash = hashlib.sha256(
-                    flow.request.raw_content).hexdigest()
-            else:
-                content_length = None
-                content_hash = None
-            try:
-                raw_content = flow.request.raw_content.decode()
-            except:
-                raw_content = ""
             f["request"] = {
                 "method": flow.request.method,
                 "scheme": flow.request.scheme,
                 "host": flow.request.host,
                 "port": flow.request.port,
                 "path": flow.request.path,
-                "raw_content": raw_content,
                 "http_version": flow.request.http_version,
                 "headers": tuple(flow.request.headers.items(True)),
-                "contentLength": content_length,
-                "contentHash": content_hash,
+                "contentLength": content_length(flow.request),
+                "contentHash": content_hash(flow.request),
                 "timestamp_start": flow.request.timestamp_start,
                 "timestamp_end": flow.request.timestamp_end,
                 # TODO: remove, use flow.is_replay instead.
@@ -92,41 +183,23 @@ def flow_to_json(flow: mitmproxy.flow.Flow) -> dict:
                 "pretty_host": flow.request.pretty_host,
             }
         if flow.response:
-            if flow.response.raw_content:
-                content_length = len(flow.response.raw_content)
-                content_hash = hashlib.sha256(
-                    flow.response.raw_content).hexdigest()
-                # 获取html
-                try:
-                    codeType = detect(flow.response.content)['encoding']
-                    html = flow.response.content.decode(codeType)
-                except:
-                    '''
-                    很可能是二进制文件
-                    '''
-                    html = base64.b64encode(flow.response.content).decode()
-            else:
-                content_length = None
-                content_hash = None
-                html = None
-
             f["response"] = {
                 "http_version": flow.response.http_version,
                 "status_code": flow.response.status_code,
                 "reason": flow.response.reason,
                 "headers": tuple(flow.response.headers.items(True)),
-                "contentLength": content_length,
-                "contentHash": content_hash,
+                "contentLength": content_length(flow.response),
+                "contentHash": content_hash(flow.response),
                 "timestamp_start": flow.response.timestamp_start,
                 "timestamp_end": flow.response.timestamp_end,
                 # TODO: remove, use flow.is_replay instead.
                 "is_replay": flow.is_replay == "response",
-                # 内容
-                "html": html
             }
             if flow.response.data.trailers:
                 f["response"]["trailers"] = tuple(
                     flow.response.data.trailers.items(True))
+        if content:
+            flow_content_to_json(flow, f)
 
     f.get("server_conn", {}).pop("certificate_list", None)
     f.get("client_conn", {}).pop("certificate_list", None)
@@ -187,6 +260,16 @@ class RequestHandler(tornado.web.RequestHandler):
         except Exception as e:
             raise APIError(400, "Malformed JSON: {}".format(str(e)))
 
+    @property
+    def detail(self):
+        """
+        网页端提交的记录，格式与/flows返回的一致：{"data": {...}}
+        """
+        try:
+            return json.loads(self.request.body.decode())['data']
+        except Exception as e:
+            raise APIError(400, "Malformed mock detail: {}".format(str(e)))
+
     @property
     def filecontents(self):
         """
@@ -274,61 +357,92 @@ class WebSocketEventBroadcaster(tornado.websocket.WebSocketHandler):
         # )
 
     @classmethod
-    def broadcast(cls, **kwargs):
+    def broadcast(cls, flow=None, **kwargs):
         if kwargs['resource'] != "flows":
             return
         try:
             if not ctx.options.host in kwargs['data']['request']['host']:
+                if flow is not None:
+                    release_streamed_body(flow)
                 return
         except:
             return
 
+        response = None
+        if isinstance(flow, http.HTTPFlow):
+            response = flow.response
+            if flow.request and 'request' in kwargs['data']:
+                # 请求body随录制的数据保存，用于重放
+                kwargs['data']['request']['raw_content'] = request_text(flow.request)
+
+        if kwargs['data'].get('mocked', False) or kwargs['data'].get('mock_route', None):
+            # 由mock返回的请求不重新录制，由路由模板返回的请求不单独录制
+            cls.send_flow(kwargs, response)
+            return
+
         # 记录数据库
-        msg_id = kwargs['data']['id']  # 消息id
         msg_type = kwargs['cmd']  # 记录到数据库的类型
         req = kwargs['data']['request']
-        is_update_response = False if not kwargs['data'].get(
-            'response', None) else True if kwargs['data']['response'].get('html', None) else False
+        tee = streamed_body(response) if response else None
+        if tee is not None and tee.released:
+            # 已经录制过，临时文件已释放
+            tee = None
+        # 录制原始字节，不转换为html，只记录编码标记，html在读取时由body生成
+        body = None
+        if tee is not None:
+            # 流式转发的大body：不转换为html发给前端，录制时由临时文件分块写入数据库
+            body = tee
+            kwargs['data']['response'].update(encode_flags(tee.head(64 * 1024)))
+        elif response and response.raw_content:
+            body = response_body(response)
+            kwargs['data']['response'].update(encode_flags(body[:64 * 1024]))
+        is_update_response = body is not None
         is_update_request = False
         url = req['scheme'] + '://' + req['host'] + \
             req['path'].split('?')[0] + ' ' + req['method']
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"select count(*) from Mock1 where url='{url}'"
-        if [i for i in cursor.execute(sql)][0][0]:  # 已经存在记录，更新记录
+        # 响应会被覆盖时不需要读取旧的body
+        record = recorder.get(url, with_body=not is_update_response)
+        if record:  # 已经存在记录，更新记录
             """
             已经存在记录，则不需要返回新的id，直接把旧的id返回去
             """
 
-            sql = f"select `detail` from Mock1 where url='{url}'"
-            js = [i for i in cursor.execute(sql)][0][0]
-            result = json.loads(parse.unquote(js))
+            result = {'data': record.data}
             kwargs['data']['id'] = result['data']['id']
             kwargs['cmd'] = 'update'
             if not is_update_response:
-                kwargs['data']['response'] = result['data'].get(
+                kwargs['data']['response'] = record.to_json().get(
                     'response', None)
+                body = record.body
             if is_update_request:
                 if result['data']['request'].get('aliasName', None):
                     kwargs['data']['request']['aliasName'] = result['data']['request']['aliasName']
             else:
                 kwargs['data']['request'] = result['data']['request']
-            message = parse.quote(json.dumps(kwargs, ensure_ascii=False))
-            sql = f"update Mock1 set `detail`=? where url=?"
-            cursor.execute(sql, (message, url))
-        else:  # 新增记录
-            message = parse.quote(json.dumps(kwargs, ensure_ascii=False))
-            sql = f"insert into Mock1 (`id`, `detail`, `url`, `status`) values (?, ?, ?, ?)"
-            cursor.execute(
-                sql, (msg_id, message, url, '1'))
-
-        db.commit()
-        cursor.close()
-        db.close()
+        # 由后台线程合并后批量写入数据库
+        recorder.put(url, kwargs['data'], record.enabled if record else True, body)
+        if not record or is_update_response:
+            # 只更新请求时写回的是原有的响应，索引中的mock仍然有效
+            mock_index.invalidate(url)
+        cls.send_flow(kwargs, response if is_update_response and tee is None else None)
 
+    @classmethod
+    def send_flow(cls, kwargs, response=None):
+        """
+        response的body只在有前端连接时才转换为html，不修改录制的数据
+        """
+        if not cls.connections:
+            return
+        if response is not None and response.raw_content and kwargs['data'].get('response', None) is not None:
+            data = dict(kwargs['data'], response=dict(kwargs['data']['response'], **response_html(response)))
+            kwargs = dict(kwargs, data=data)
+        cls.send(json.dumps(kwargs, ensure_ascii=False))
+
+    @classmethod
+    def send(cls, message):
         for conn in cls.connections:
             try:
-                conn.write_message(parse.unquote(message))
+                conn.write_message(message)
             except Exception:  # pragma: no cover
                 # logging.error("Error sending message", exc_info=True)
                 pass
@@ -339,16 +453,72 @@ class ClientConnection(WebSocketEventBroadcaster):
 
 
 class Flows(RequestHandler):
+    PAGE_ARGUMENTS = ('limit', 'cursor', 'since', 'view', 'method', 'path', 'status_code')
+
     def get(self):
         # 获取历史记录
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"select * from Mock1 where url like '%{ctx.options.host}%'"
-        result = [{**json.loads(parse.unquote(i[1]))['data'], "status": parse.unquote(i[3])}
-                  for i in cursor.execute(sql)]
+        recorder.flush()
+        if not any(self.get_argument(i, None) is not None for i in self.PAGE_ARGUMENTS):
+            # 没有分页参数时保持原来的行为，一次返回全部记录
+            self.write([record.to_json() for record in store.list(ctx.options.host)])
+            return
+
+        """
+        分页读取：
+        limit: 每页条数
+        cursor: 上一页返回的cursor
+        since: 只返回该版本之后修改/删除的记录
+        view: summary(默认，不含body) | full
+        method/path/status_code: 过滤条件
+        """
+        try:
+            limit = min(max(int(self.get_argument('limit', '100')), 1), 1000)
+            cursor = self.get_argument('cursor', None)
+            cursor = int(cursor) if cursor is not None else None
+            since = self.get_argument('since', None)
+            since = int(since) if since is not None else None
+            status_code = self.get_argument('status_code', None)
+            status_code = int(status_code) if status_code is not None else None
+        except ValueError as e:
+            raise APIError(400, "Invalid argument: {}".format(str(e)))
+        view = self.get_argument('view', 'summary')
+        if view not in ('summary', 'full'):
+            raise APIError(400, f"Unknown view {view}")
+
+        version = store.version()
+        items, next_cursor = store.page(
+            ctx.options.host,
+            method=self.get_argument('method', None),
+            path=self.get_argument('path', None),
+            status_code=status_code,
+            cursor=cursor,
+            since=since,
+            limit=limit,
+            summary=view == 'summary',
+        )
+        if view == 'full':
+            items = [record.to_json() for record in items]
+        result = dict(
+            items=items,
+            cursor=next_cursor,
+            version=version,
+        )
+        if since is not None and cursor is None:
+            result['deleted'] = store.deleted(since)
         self.write(result)
-        cursor.close()
-        db.close()
+
+
+class FlowDetail(RequestHandler):
+    def get(self):
+        '''
+        获取单条记录的完整数据
+        '''
+        url = base64.b64decode(self.get_argument('url').encode()).decode()
+        recorder.flush()
+        record = store.get(url)
+        if not record:
+            raise APIError(404, "Mock not found.")
+        self.write(record.to_json())
 
 
 class DumpFlows(RequestHandler):
@@ -380,14 +550,9 @@ class ClearAll(RequestHandler):
 
 class SOFTMOCK_ClearAll(RequestHandler):
     def post(self):
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"delete from Mock1 where url like '%{ctx.options.host}%'"
-
-        cursor.execute(sql)
-        db.commit()
-        cursor.close()
-        db.close()
+        recorder.flush()
+        store.clear(ctx.options.host)
+        mock_index.clear()
         self.write('0')
 
 
@@ -425,13 +590,9 @@ class DeleteFlow(RequestHandler):
         删除记录
         '''
         url = base64.b64decode(self.get_argument('url').encode()).decode()
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"delete from Mock1 where `url`='{url}'"
-        cursor.execute(sql)
-        db.commit()
-        cursor.close()
-        db.close()
+        recorder.flush()
+        store.delete(url)
+        mock_index.invalidate(url)
         self.write('0')
 
 
@@ -441,14 +602,9 @@ class CreateFlow(RequestHandler):
         新增记录
         '''
         url = base64.b64decode(self.get_argument('url').encode()).decode()
-        detail = self.request.body.decode()
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"insert into Mock1 (`detail`, `status`, `url`) values (?, ?, ?)"
-        cursor.execute(sql, (parse.quote(detail), '1', url))
-        db.commit()
-        cursor.close()
-        db.close()
+        recorder.flush()
+        store.put(url, self.detail, enabled=True)
+        mock_index.invalidate(url)
         self.write('0')
 
 
@@ -459,16 +615,10 @@ class UpdateFlow(RequestHandler):
         '''
         url = base64.b64decode(self.get_argument('url').encode()).decode()
         status = self.get_argument('status')
-        status = '1' if status == 'true' else status
-        detail = self.request.body.decode()
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
         print('更新：'+url)
-        sql = f"update Mock1 set `detail`='{parse.quote(detail)}', `status`='{status}' where `url`=?"
-        cursor.execute(sql, (url, ))
-        db.commit()
-        cursor.close()
-        db.close()
+        recorder.flush()
+        store.put(url, self.detail, enabled=parse_status(status))
+        mock_index.invalidate(url)
         self.write('0')
 
 
@@ -479,12 +629,9 @@ class UpdateStatus():
         '''
         url = base64.b64decode(self.get_argument('url').encode()).decode()
         status = self.get_argument('status')
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"update Mock1 set `status`='{status}' where url='{url}'"
-        cursor.execute(sql)
-        db.commit()
-        cursor.close()
+        recorder.flush()
+        store.set_enabled(url, parse_status(status))
+        mock_index.invalidate(url)
         self.write('0')
 
 
@@ -575,23 +722,83 @@ class ReplayFlow(RequestHandler):
 
 
 class ReplayMe(RequestHandler):
-    def post(self):
+    async def post(self):
         url = base64.b64decode(self.get_argument('url').encode()).decode()
 
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"select `detail` from Mock1 where url='{url}'"
-        js = [i for i in cursor.execute(sql)][0][0]
-        result = json.loads(parse.unquote(js))
-        # result['data']['response'] = None
-        update_result = proxy_req(result)
-        sql2 = f"update Mock1 set `detail`='{parse.quote(json.dumps(update_result))}' where url='{url}'"
-        cursor.execute(sql2)
-        db.commit()
-        cursor.close()
+        recorder.flush()
+        if not store.get(url, with_body=False):
+            raise APIError(404, "Mock not found.")
+        # 在线程池中请求，不阻塞事件循环
+        errors = await Refresher(concurrency=1).run([url])
+        if errors:
+            raise APIError(502, errors[0][1])
         self.write('0')
 
 
+class RefreshFlows(RequestHandler):
+    def post(self):
+        '''
+        批量刷新录制的数据，进度通过/updates推送：
+        {"resource": "refresh", "cmd": "progress" | "done", "data": {...}}
+        '''
+        try:
+            concurrency = min(max(int(self.get_argument('concurrency', '8')), 1), 64)
+            status_code = self.get_argument('status_code', None)
+            status_code = int(status_code) if status_code is not None else None
+        except ValueError as e:
+            raise APIError(400, "Invalid argument: {}".format(str(e)))
+        recorder.flush()
+        urls = select_urls(
+            ctx.options.host,
+            method=self.get_argument('method', None),
+            path=self.get_argument('path', None),
+            status_code=status_code,
+        )
+
+        def progress(done, total, url, error):
+            ClientConnection.send(json.dumps(dict(
+                resource="refresh",
+                cmd="progress",
+                data=dict(done=done, total=total, url=url, error=error),
+            ), ensure_ascii=False))
+
+        async def run():
+            errors = await Refresher(concurrency, progress=progress).run(urls)
+            ClientConnection.send(json.dumps(dict(
+                resource="refresh",
+                cmd="done",
+                data=dict(total=len(urls), errors=[dict(url=url, error=error) for url, error in errors]),
+            ), ensure_ascii=False))
+
+        asyncio.ensure_future(run())
+        self.write(dict(total=len(urls)))
+
+
+class MockContent(RequestHandler):
+    CHUNK_SIZE = 64 * 1024
+
+    async def get(self):
+        '''
+        以原始字节返回记录的响应body，图片/字体/wasm等不需要经过base64
+        '''
+        url = base64.b64decode(self.get_argument('url').encode()).decode()
+        record = recorder.get(url)
+        if not record or record.body is None:
+            raise APIError(404, "No content.")
+        content_type = "application/octet-stream"
+        for name, value in (record.data.get('response', None) or {}).get('headers', None) or ():
+            if name.lower() == 'content-type':
+                content_type = value
+        self.set_header("Content-Type", content_type)
+        self.set_header("Content-Security-Policy", "sandbox")
+        self.set_header("X-Content-Type-Options", "nosniff")
+        # 大的body分块发送，每块只从memoryview中切出需要的部分
+        view = memoryview(record.body)
+        for i in range(0, len(view), self.CHUNK_SIZE):
+            self.write(bytes(view[i:i + self.CHUNK_SIZE]))
+            await self.flush()
+
+
 class FlowContent(RequestHandler):
     def post(self, flow_id, message):
         self.flow.backup()
@@ -685,6 +892,11 @@ class Settings(RequestHandler):
         self.master.options.update(**update)
 
 
+class ConnectionStats(RequestHandler):
+    def get(self):
+        self.write(self.master.server.stats())
+
+
 class Options(RequestHandler):
     def get(self):
         self.write(optmanager.dump_dicts(self.master.options))
@@ -740,7 +952,10 @@ class Application(tornado.web.Application):
                 (r"/filter-help(?:\.json)?", FilterHelp),
                 (r"/updates", ClientConnection),
                 (r"/events(?:\.json)?", Events),
+                (r"/connections(?:\.json)?", ConnectionStats),
                 (r"/flows(?:\.json)?", Flows),
+                (r"/flow_detail", FlowDetail),
+                (r"/flow_content", MockContent),
                 (r"/flows/dump", DumpFlows),
                 (r"/flows/resume", ResumeFlows),
                 (r"/create", CreateFlow),
@@ -749,6 +964,7 @@ class Application(tornado.web.Application):
                 (r"/delete_flow", DeleteFlow),
                 (r"/clear_all", SOFTMOCK_ClearAll),
                 (r"/replay", ReplayMe),
+                (r"/refresh", RefreshFlows),
                 (r"/update_status", UpdateStatus),
                 (r"/flows/(?P<flow_id>[0-9a-f\-]+)", FlowHandler),
                 (r"/flows/(?P<flow_id>[0-9a-f\-]+)/resume", ResumeFlow),
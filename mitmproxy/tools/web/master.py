@@ -51,17 +51,20 @@ class WebMaster(master.Master):
         app.ClientConnection.broadcast(
             resource="flows",
             cmd="add",
-            data=app.flow_to_json(flow)
+            data=app.flow_to_json(flow, content=False),
+            flow=flow
         )
 
     def _sig_view_update(self, view, flow):
         app.ClientConnection.broadcast(
             resource="flows",
             cmd="update",
-            data=app.flow_to_json(flow)
+            data=app.flow_to_json(flow, content=False),
+            flow=flow
         )
 
     def _sig_view_remove(self, view, flow, index):
+        app.release_streamed_body(flow)
         app.ClientConnection.broadcast(
             resource="flows",
             cmd="remove",
@@ -0,0 +1,148 @@
+import collections
+import threading
+import time
+
+from mitmproxy.net import http
+from softmock.database import split_url, is_pattern
+from softmock.recorder import recorder
+from softmock.routes import Route, RouteTable
+
+
+class MockEntry:
+    """
+    编译好的mock响应：状态码、header列表、body字节在建立索引时一次性算好，
+    命中时直接构造HTTPResponse，不再查库和解析json
+    """
+    __slots__ = ('status_code', 'reason', 'headers', 'content')
+
+    def __init__(self, status_code, reason, headers, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @classmethod
+    def compile(cls, response, body):
+        headers = {}
+        try:
+            for header in response['headers']:
+                headers[header[0]] = header[1]
+        except:
+            pass
+        # body是解压后的原始字节，按content-encoding重新压缩后缓存，命中时不再处理
+        resp = http.Response.make(
+            response.get('status_code', None) or 200,
+            bytes(body or b''),
+            headers
+        )
+        return cls(resp.status_code, resp.data.reason, resp.headers.fields, resp.raw_content)
+
+    def make_response(self) -> http.Response:
+        now = time.time()
+        return http.Response(
+            b"HTTP/1.1",
+            self.status_code,
+            self.reason,
+            self.headers,
+            self.content,
+            None,
+            now,
+            now,
+        )
+
+
+class MockIndex:
+    """
+    常驻内存的mock索引，key与Mock.url一致：`scheme://host/path METHOD`
+
+    未命中时查一次库（包括还未提交的录制数据）并缓存结果（包括"没有可用mock"），
+    最多缓存max_entries条，超出时淘汰最久未使用的，
+    没有录制响应时再按路由模板匹配，
+    数据库中的记录发生变化时需要调用invalidate/clear
+    """
+    max_entries = 10000
+
+    def __init__(self, recorder=recorder):
+        self.recorder = recorder
+        # url -> MockEntry；None表示mock被禁用；False表示没有记录或记录中没有响应
+        self.entries = collections.OrderedDict()
+        self.routes = None
+        self.generation = 0
+        self.routes_generation = 0
+        self.lock = threading.Lock()
+
+    def _load(self, url):
+        record = self.recorder.get(url)
+        if not record:
+            return False
+        response = record.data.get('response', None)
+        if not response:
+            # 只录制了请求（例如请求刚到达时），可以由路由模板返回
+            return False
+        if not record.enabled:
+            return None
+        return MockEntry.compile(response, record.body)
+
+    def _get(self, url):
+        with self.lock:
+            if url in self.entries:
+                self.entries.move_to_end(url)
+                return self.entries[url]
+            generation = self.generation
+        entry = self._load(url)
+        with self.lock:
+            # 加载期间记录被修改过，结果可能已经过期，不写入索引
+            if generation == self.generation:
+                self.entries[url] = entry
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+    def _routes(self):
+        with self.lock:
+            if self.routes is not None:
+                return self.routes
+            generation = self.routes_generation
+        routes = RouteTable()
+        for record in self.recorder.store.patterns():
+            response = record.data.get('response', None)
+            if response:
+                entry = MockEntry.compile(response, record.body)
+                routes.add(Route(record.url, entry, record.data.get('match', None)))
+        with self.lock:
+            if generation == self.routes_generation:
+                self.routes = routes
+        return routes
+
+    def get(self, url):
+        return self._get(url) or None
+
+    def match(self, url, request):
+        """
+        返回(MockEntry, 命中的路由模板)，精确匹配时模板为None，没有mock时返回(None, None)
+        """
+        entry = self._get(url)
+        if entry is not False:
+            return entry, None
+        route = self._routes().match(request)
+        if route is None:
+            return None, None
+        return route.entry, route.url
+
+    def invalidate(self, url):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(url, None)
+            if is_pattern(split_url(url)[2]):
+                self.routes_generation += 1
+                self.routes = None
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.routes_generation += 1
+            self.routes = None
+
+
+mock_index = MockIndex()
@@ -1,15 +1,8 @@
-import sqlite3
-from softmock.database import database
+from softmock.store import store
 
 
 def clear():
-    db = sqlite3.connect(database)
-    cursor = db.cursor()
-    sql = "delete from Mock1"
-
-    cursor.execute(sql)
-    db.commit()
-    cursor.close()
-    db.close()
+    store.clear()
+    store.close()
 
     print('清理完成')
@@ -1,4 +1,304 @@
+import base64
+import codecs
+import json
 import os
+from urllib import parse
+
+from cchardet import detect
+
+from mitmproxy.net.http.headers import parse_content_type
 
 current_path = os.path.abspath(os.path.dirname(__file__))
 database = os.path.join(current_path, "soft_mock.db")
+
+"""
+Mock表结构
+
+url 是记录的唯一key：`scheme://host/path METHOD`，
+host/path/method/status_code/enabled 拆成单独的带索引的列，
+meta 只保存除响应body之外的json数据，响应body以原始字节保存在body列，
+rev 是记录最后一次修改时的全局版本号，由触发器维护，被删除的记录保存在MockDeleted中，
+pattern 标记path是路由模板的记录（见softmock.routes）
+"""
+SCHEMA_VERSION = 4
+
+# 新增的列只能追加在末尾，旧版本的迁移按前缀截取
+V1_COLUMNS = "`id`, `url`, `scheme`, `host`, `path`, `method`, `status_code`, `enabled`, `meta`, `body`"
+MOCK_COLUMNS = V1_COLUMNS + ", `pattern`"
+MOCK_PLACEHOLDERS = ", ".join(["?"] * (MOCK_COLUMNS.count("`") // 2))
+
+PATTERN_CHARS = ('{', '*', '?')
+
+
+def split_url(url):
+    """
+    `scheme://host/path METHOD` -> (scheme, host, path, method)
+    """
+    address, _, method = url.rpartition(' ')
+    scheme, _, rest = address.partition('://')
+    host, slash, path = rest.partition('/')
+    return scheme, host, slash + path, method
+
+
+def is_pattern(path):
+    """
+    path是否是路由模板
+    """
+    return any(c in path for c in PATTERN_CHARS)
+
+
+def _content_type(response):
+    for header in response.get('headers', None) or ():
+        if header[0].lower() == 'content-type':
+            return header[1]
+    return ''
+
+
+def is_binary(response):
+    """
+    旧版本的判断方式：image/video的响应body在json中以base64保存
+    """
+    content_type = _content_type(response)
+    return 'image' in content_type or 'video' in content_type
+
+
+def response_charset(response):
+    content_type = parse_content_type(_content_type(response))
+    charset = content_type[2].get('charset', None) if content_type else None
+    if charset and charset.lower() in ('gb2312', 'gbk'):
+        charset = 'gb18030'
+    return charset
+
+
+"""
+json中的响应body：
+html_encoding为base64时html是body的base64，
+否则html是按html_charset（或content-type中的charset，默认utf-8）解码后的文本
+"""
+
+
+def encode_html(content):
+    """
+    原始body -> json中的html及编码标记
+    """
+    try:
+        charset = detect(content)['encoding']
+        return {'html': content.decode(charset), 'html_charset': charset}
+    except Exception:
+        # 很可能是二进制文件
+        return {'html': base64.b64encode(content).decode(), 'html_encoding': 'base64'}
+
+
+def encode_flags(head):
+    """
+    只根据body开头的一段判断编码标记，用于不在内存中完整保存的大body，
+    结尾可能截断在多字节字符中间，按增量方式解码
+    """
+    try:
+        charset = detect(head)['encoding']
+        codecs.getincrementaldecoder(charset)().decode(head)
+        return {'html_charset': charset}
+    except Exception:
+        return {'html_encoding': 'base64'}
+
+
+def html_to_body(response):
+    """
+    json中的html -> 原始body，会从response中去掉html并补全编码标记
+    """
+    html = response.pop('html', None)
+    if html is None:
+        return None
+    encoding = response.get('html_encoding', None)
+    charset = response.get('html_charset', None)
+    if encoding is None and charset is None and is_binary(response):
+        # 没有编码标记的旧数据
+        encoding = 'base64'
+    if encoding == 'base64':
+        response['html_encoding'] = 'base64'
+        return base64.b64decode(html.encode())
+    charset = charset or response_charset(response) or 'utf-8'
+    try:
+        body = html.encode(charset)
+    except (LookupError, UnicodeError):
+        charset = 'utf-8'
+        body = html.encode(charset, 'surrogatepass')
+    response['html_charset'] = charset
+    return body
+
+
+def body_to_html(response, body):
+    """
+    原始body -> json中的html，无法按记录的字符集解码时改用base64并修改response中的标记
+    """
+    if body is None:
+        return None
+    body = bytes(body)
+    if response.get('html_encoding', None) != 'base64':
+        charset = response.get('html_charset', None) or response_charset(response) or 'utf-8'
+        try:
+            return body.decode(charset)
+        except (LookupError, UnicodeError):
+            response.pop('html_charset', None)
+            response['html_encoding'] = 'base64'
+    return base64.b64encode(body).decode()
+
+
+def dump_mock(data, body=None):
+    """
+    把前端使用的记录数据拆分为(status_code, meta, body)，
+    body为None时由data中的html还原
+    """
+    response = data.get('response', None)
+    status_code = None
+    if response:
+        response = dict(response)
+        status_code = response.get('status_code', None)
+        if body is None:
+            body = html_to_body(response)
+        else:
+            response.pop('html', None)
+    else:
+        body = None
+    meta = json.dumps({**data, 'response': response}, ensure_ascii=False)
+    return status_code, meta, body
+
+
+def load_mock(meta):
+    """
+    meta -> 不含html的记录数据，html由body_to_html按需生成
+    """
+    return json.loads(meta)
+
+
+def mock_row(url, data, enabled=True, body=None):
+    """
+    生成插入Mock表的一行数据，列顺序与MOCK_COLUMNS一致
+    """
+    scheme, host, path, method = split_url(url)
+    status_code, meta, body = dump_mock(data, body)
+    return (data.get('id', None), url, scheme, host, path, method, status_code, int(enabled), meta, body,
+            int(is_pattern(path)))
+
+
+def parse_status(status):
+    return status in ('1', 'true', 1, True)
+
+
+def format_status(enabled):
+    return '1' if enabled else 'false'
+
+
+def _migrate_v1(conn):
+    conn.execute(
+        "create table if not exists Mock ("
+        "`id` TEXT, `url` TEXT primary key, `scheme` TEXT, `host` TEXT, `path` TEXT, `method` TEXT, "
+        "`status_code` INTEGER, `enabled` INTEGER not null default 1, `meta` TEXT, `body` BLOB)"
+    )
+    conn.execute("create index if not exists Mock_host_path on Mock (`host`, `path`)")
+    conn.execute("create index if not exists Mock_method on Mock (`method`)")
+    conn.execute("create index if not exists Mock_status_code on Mock (`status_code`)")
+    conn.execute("create index if not exists Mock_enabled on Mock (`enabled`)")
+    conn.execute(
+        "create table if not exists Html (url varchar(100) primary key, filepath TEXT)")
+
+    tables = {i[0] for i in conn.execute(
+        "select name from sqlite_master where type='table'")}
+    if 'Mock1' not in tables:
+        return
+
+    # 旧版本：每条记录是一个parse.quote(json.dumps(...))的文本
+    def rows():
+        for detail, url, status in conn.cursor().execute("select `detail`, `url`, `status` from Mock1"):
+            try:
+                data = json.loads(parse.unquote(detail))['data']
+            except Exception:
+                continue
+            yield mock_row(url, data, parse_status(status))[:10]
+
+    conn.executemany(
+        f"insert or replace into Mock ({V1_COLUMNS}) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows()
+    )
+    conn.execute("drop table Mock1")
+
+
+def _migrate_v2(conn):
+    conn.execute("alter table Mock add column `rev` INTEGER not null default 0")
+    conn.execute("create index if not exists Mock_rev on Mock (`rev`)")
+    conn.execute(
+        "create table if not exists MockDeleted (`url` TEXT primary key, `rev` INTEGER not null)")
+    conn.execute("create index if not exists MockDeleted_rev on MockDeleted (`rev`)")
+    conn.execute(
+        "create table if not exists Revision (`id` INTEGER primary key check (`id` = 0), `rev` INTEGER not null)")
+    conn.execute("insert or ignore into Revision (`id`, `rev`) values (0, 0)")
+    # 每次写入都把全局版本号加一，并记录到被修改的行上
+    conn.execute(
+        "create trigger if not exists Mock_rev_insert after insert on Mock begin "
+        "update Revision set `rev` = `rev` + 1; "
+        "update Mock set `rev` = (select `rev` from Revision) where rowid = new.rowid; "
+        "delete from MockDeleted where `url` = new.`url`; "
+        "end"
+    )
+    conn.execute(
+        "create trigger if not exists Mock_rev_update after update of "
+        "`status_code`, `enabled`, `meta`, `body` on Mock begin "
+        "update Revision set `rev` = `rev` + 1; "
+        "update Mock set `rev` = (select `rev` from Revision) where rowid = new.rowid; "
+        "end"
+    )
+    conn.execute(
+        "create trigger if not exists Mock_rev_delete after delete on Mock begin "
+        "update Revision set `rev` = `rev` + 1; "
+        "insert or replace into MockDeleted (`url`, `rev`) values (old.`url`, (select `rev` from Revision)); "
+        "end"
+    )
+
+
+def _migrate_v3(conn):
+    conn.execute("alter table Mock add column `pattern` INTEGER not null default 0")
+    conn.execute("create index if not exists Mock_pattern on Mock (`pattern`, `enabled`)")
+    conn.execute(
+        "update Mock set `pattern` = 1 where " +
+        " or ".join(f"instr(`path`, '{c}') > 0" for c in PATTERN_CHARS)
+    )
+
+
+def _migrate_v4(conn):
+    """
+    v4之前文本body按utf-8保存，且没有编码标记：
+    补全标记，并按content-type中的charset重新编码，命中时可以直接返回body
+    """
+    rowids = [i[0] for i in conn.execute("select rowid from Mock where `body` is not null")]
+    for rowid in rowids:
+        meta, body = conn.execute("select `meta`, `body` from Mock where rowid=?", (rowid,)).fetchone()
+        data = json.loads(meta)
+        response = data.get('response', None)
+        if not response or 'html_encoding' in response or 'html_charset' in response:
+            continue
+        if is_binary(response):
+            response['html_encoding'] = 'base64'
+            meta = json.dumps(data, ensure_ascii=False)
+        else:
+            response['html'] = bytes(body).decode('utf-8', 'surrogatepass')
+            _, meta, body = dump_mock(data)
+        conn.execute("update Mock set `meta`=?, `body`=? where rowid=?", (meta, body, rowid))
+
+
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4]
+
+
+def ensure_schema(conn):
+    """
+    创建/升级数据库表结构，由user_version记录当前版本
+    """
+    version = conn.execute("pragma user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    with conn:
+        for migrate in MIGRATIONS[version:]:
+            migrate(conn)
+        conn.execute(f"pragma user_version = {SCHEMA_VERSION}")
+    if version == 0:
+        # 旧数据迁移后回收空间
+        conn.execute("vacuum")
@@ -4,6 +4,7 @@ import click
 from softmock import index
 from softmock.utils.version import version as VERSION
 from softmock import clear
+from softmock.refresh import refresh as refresh_all
 
 
 def version(ctx, param, value):
@@ -23,10 +24,15 @@ def clear_all(ctx, param, value):
 @click.option('--version', '-v', is_flag=True, is_eager=True, expose_value=False, help='查看softmock版本信息', callback=version)
 @click.option('--host', '-h', prompt='请输入要监听的host', help='监听的host')
 @click.option('--clear-all', help='清理所有数据', is_flag=True, is_eager=True, expose_value=False, callback=clear_all)
-def main(host):
+@click.option('--refresh', help='重新请求host下所有录制的接口并更新数据', is_flag=True)
+@click.option('--concurrency', help='刷新时的并发数', default=8, show_default=True)
+def main(host, refresh, concurrency):
     """
     录制接口，并mock数据！
     """
+    if refresh:
+        refresh_all(host, concurrency)
+        return
     index.launch(host)
 
 
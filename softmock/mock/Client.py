@@ -4,8 +4,8 @@ import os
 import subprocess
 from mitmproxy.tools.main import run as mitmproxy_run
 from mitmproxy.tools import web, cmdline
-from softmock.database import database
-import sqlite3
+from softmock.store import store
+from softmock.recorder import recorder
 import click
 
 # 导入addons
@@ -15,16 +15,8 @@ from .addons import Host
 class Proxy:
     def __init__(self, host):
         self.host = host
-        self.conn = sqlite3.connect(database)
         self.network_list = ['Wi-Fi', 'Ethernet']
-        cursor = self.conn.cursor()
-        try:
-            sql = "create table Mock1 (id varchar(100) primary key, detail TEXT, url TEXT, status Text)"
-            cursor.execute(sql)
-            sql = "create table Html (url varchar(100) primary key, filepath TEXT)"
-            cursor.execute(sql)
-        except:
-            pass
+        store.open()
 
     def set_browser_proxy(self):
 
@@ -105,7 +97,7 @@ class Proxy:
 
     def server_start(self):
         sys.argv = sys.argv[0:1]
-        addons = [Host(self.host, self.conn)]  # 添加插件
+        addons = [Host(self.host, store)]  # 添加插件
         # 设置浏览器代理
         self.set_browser_proxy()
         mitmproxy_run(web.master.WebMaster, cmdline.mitmweb,
@@ -118,5 +110,6 @@ class Proxy:
     def run(self):
         print(f'开始记录host：{self.host}，网络请求')
         result = self.server_start()
-        self.conn.close()
+        recorder.close()
+        store.close()
         sys.exit(result)
@@ -1,11 +1,8 @@
-import sqlite3
-import json
-import base64
 from mitmproxy import ctx
 import mitmproxy
-from urllib import parse
 from functools import wraps
-from softmock.database import database
+from softmock.cache import mock_index
+from softmock.recorder import recorder
 
 null = None
 false = False
@@ -13,8 +10,9 @@ undefined = None
 
 
 class Host:
-    def __init__(self, host, conn) -> None:
+    def __init__(self, host, store) -> None:
         self.host = host
+        self.store = store
 
     def exclude_host(fn):
         """
@@ -42,41 +40,26 @@ class Host:
         url = flow.request.scheme + '://' + \
             flow.request.host + \
             flow.request.path.split('?')[0] + ' ' + flow.request.method
-        db = sqlite3.connect(database)
-        cursor = db.cursor()
-        sql = f"select * from Mock1 where url='{url}' and status='1'"
+        entry, route = mock_index.match(url, flow.request)
+        if entry is None:
+            return None
         print(f'拦截{url}到本地')
-        result = cursor.execute(sql)
-        js = [i for i in cursor.execute(sql)]
-        if len(js) > 0:
-            result = json.loads(parse.unquote(js[0][1]))
-            # flow.response = result['data']['response']
-            response = result['data'].get('response', None)
-            if not response:
-                return None
-            headers = {}
-            try:
-                for header in response['headers']:
-                    headers[header[0]] = header[1]
-            except:
-                pass
-            content_type = headers.get(
-                'content-type', None) or headers.get('Content-Type', None)
-            html = response['html']
-            if 'image' in content_type or 'video' in content_type:
-                html = base64.b64decode(html.encode())
-            flow.response = mitmproxy.http.HTTPResponse.make(
-                response['status_code'] or 200,  # (optional) status code
-                html,  # (optional) content
-                headers  # (optional) headers
-            )
-
-        cursor.close()
-        db.close()
+        flow.response = entry.make_response()
+        # mock返回的请求不再录制，也不使索引失效
+        flow.metadata['mocked'] = True
+        if route:
+            # 模板命中的请求不再单独录制
+            flow.metadata['mock_route'] = route
 
     def sentry():
         pass
 
+    def done(self):
+        '''
+        退出时写入还未提交的录制数据
+        '''
+        recorder.close()
+
     @exclude_host
     def response(self, flow: mitmproxy.http.HTTPFlow):
         pass
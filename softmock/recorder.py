@@ -0,0 +1,133 @@
+import threading
+import time
+from typing import Optional
+
+import click
+
+from softmock.store import store, MockRecord, is_chunked
+
+
+class Recorder:
+    """
+    录制数据的后台批量写入
+
+    同一个url的多次更新在内存中合并，由后台线程按时间窗口(interval秒)
+    或数量窗口(batch_size条)在一个事务中提交。
+    未提交的数据可以通过get立即读到，退出时调用close写入剩余数据。
+    网页端修改数据前应先调用flush，保证修改不会被之前的录制覆盖。
+    """
+
+    def __init__(self, store=store, interval: float = 0.2, batch_size: int = 200) -> None:
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        # url -> (data, enabled, body)
+        self.pending: dict = {}
+        # 正在提交的批次，提交完成前仍然可读
+        self.flushing: dict = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.full = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+
+    def get(self, url: str, with_body: bool = True) -> Optional[MockRecord]:
+        with self.lock:
+            item = self.pending.get(url, None) or self.flushing.get(url, None)
+        if item:
+            body = item[2]
+            if is_chunked(body):
+                try:
+                    body = b''.join(body.chunks()) if with_body else None
+                except ValueError:
+                    # 临时文件已经写入数据库并释放
+                    return self.store.get(url, with_body)
+            return MockRecord(url, item[1], item[0], body)
+        return self.store.get(url, with_body)
+
+    def holds(self, body) -> bool:
+        """
+        body是否还在等待写入，等待写入的分块body由这里释放
+        """
+        with self.lock:
+            return any(item[2] is body for item in (*self.pending.values(), *self.flushing.values()))
+
+    def put(self, url: str, data: dict, enabled: bool = True, body=None) -> None:
+        """
+        enabled只用于未提交前的读取，写入数据库时保持记录原有的启用状态，
+        body可以是分块读取的对象（见softmock.store.is_chunked），写入后由这里释放
+        """
+        with self.lock:
+            replaced = self.pending.get(url, None)
+            self.pending[url] = (data, enabled, body)
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(
+                    target=self._run, name="softmock recorder", daemon=True)
+                self.thread.start()
+            self.wakeup.set()
+            if len(self.pending) >= self.batch_size:
+                self.full.set()
+        if replaced:
+            self._release([replaced[2]])
+
+    def flush(self) -> bool:
+        """
+        返回是否写入成功，失败时数据放回队列，由后台线程稍后重试
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return True
+                self.flushing, self.pending = self.pending, {}
+            try:
+                self.store.put_many(
+                    (url, data, body) for url, (data, _, body) in self.flushing.items())
+            except Exception as e:
+                click.secho(f'录制数据写入失败，稍后重试：{e}', fg='red')
+                with self.lock:
+                    failed, self.flushing = self.flushing, {}
+                    # 失败期间又有更新的url以新数据为准
+                    replaced = [failed[url][2] for url in failed if url in self.pending]
+                    self.pending = {**failed, **self.pending}
+                self._release(replaced)
+                return False
+            with self.lock:
+                flushed, self.flushing = self.flushing, {}
+            self._release(body for _, _, body in flushed.values())
+            return True
+
+    def _release(self, bodies) -> None:
+        """
+        释放不再需要写入的分块body
+        """
+        for body in bodies:
+            if is_chunked(body) and not self.holds(body):
+                body.close()
+
+    def _run(self) -> None:
+        while True:
+            self.wakeup.wait()
+            if not self.closed:
+                self.full.wait(self.interval)
+            with self.lock:
+                self.wakeup.clear()
+                self.full.clear()
+            if not self.flush() and not self.closed:
+                time.sleep(self.interval)
+                self.wakeup.set()
+            if self.closed:
+                return
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+            self.wakeup.set()
+            self.full.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+
+recorder = Recorder()
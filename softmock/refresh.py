@@ -0,0 +1,26 @@
+import asyncio
+
+import click
+
+from softmock.recorder import recorder
+from softmock.replay import Refresher, select_urls
+from softmock.store import store
+
+
+def refresh(host, concurrency=8):
+    """
+    重新请求host下所有录制的接口，并写回数据库
+    """
+    urls = select_urls(host)
+
+    def progress(done, total, url, error):
+        if error:
+            click.secho(f'[{done}/{total}] {url} 失败：{error}', fg='red')
+        else:
+            click.secho(f'[{done}/{total}] {url}')
+
+    errors = asyncio.run(Refresher(concurrency, progress=progress).run(urls))
+    recorder.close()
+    store.close()
+    click.secho(f'刷新完成，共{len(urls)}条，失败{len(errors)}条',
+                fg='yellow' if errors else 'green')
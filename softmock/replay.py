@@ -0,0 +1,162 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from softmock.cache import mock_index
+from softmock.database import split_url, is_pattern, encode_html
+from softmock.recorder import recorder
+from softmock.store import store
+
+proxy = {
+    'http': None,
+    'https': None
+}
+
+
+def parse_headers(headers):
+    result = {}
+    for i in headers:
+        result[i[0]] = i[1]
+    return result
+
+
+def dump_headers(headers):
+    result = []
+    for key, value in headers.items():
+        result.append([key, value])
+    return result
+
+
+# (scheme, host) -> requests.Session，重放和刷新共用，keep-alive连接在多次操作之间复用
+_sessions: dict = {}
+_sessions_lock = threading.Lock()
+# 每个host保留的空闲连接数，不小于刷新的最大并发
+SESSION_POOL_SIZE = 16
+
+
+def shared_session(scheme: str, host: str) -> requests.Session:
+    with _sessions_lock:
+        session = _sessions.get((scheme, host), None)
+        if session is None:
+            session = requests.Session()
+            # 会话在重放之间共用，不保存响应的Set-Cookie，请求只带录制的cookie
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_maxsize=SESSION_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[(scheme, host)] = session
+        return session
+
+
+def proxy_req(result, session=None):
+    data = result['data']
+    req = data['request']
+    url = (req['scheme'] + '://' + req['host'] + req['path']).strip()
+    headers = parse_headers(req['headers'])
+    req_data = req['raw_content']
+    print('replay:', req['method'], url)
+    if session is None:
+        session = shared_session(req['scheme'], req['host'])
+    resp = session.request(req['method'], url, headers=headers, data=req_data,
+                           timeout=(10, 10), proxies=proxy)
+    if not data.get('response', None):
+        data['response'] = {}
+    data['response']['headers'] = dump_headers(resp.headers)
+    data['response'].pop('html_charset', None)
+    data['response'].pop('html_encoding', None)
+    data['response'].update(encode_html(resp.content))
+    return result, resp.content
+
+
+def select_urls(host: str = '', **filters) -> List[str]:
+    """
+    按条件选出需要刷新的记录，路由模板不是真实的地址，不参与刷新
+    """
+    urls = []
+    cursor = None
+    while True:
+        items, cursor = store.page(host, cursor=cursor, limit=500, **filters)
+        urls.extend(i['url'] for i in items if not is_pattern(i['path']))
+        if cursor is None:
+            return urls
+
+
+class Refresher:
+    """
+    并发刷新录制的mock数据
+
+    请求在大小为concurrency的线程池中执行，不阻塞事件循环；
+    同一个host共用一个requests.Session（与单条重放共用），复用keep-alive连接；
+    结果每batch_size条经recorder在一个事务中写回数据库。
+    progress(done, total, url, error)在事件循环中回调。
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        batch_size: int = 50,
+        progress: Optional[Callable[[int, int, str, Optional[str]], None]] = None,
+    ) -> None:
+        self.concurrency = max(concurrency, 1)
+        self.batch_size = batch_size
+        self.progress = progress
+
+    def session(self, url: str) -> requests.Session:
+        scheme, host, _, _ = split_url(url)
+        return shared_session(scheme, host)
+
+    def fetch(self, url: str) -> Tuple[dict, bool, bytes]:
+        record = recorder.get(url, with_body=False)
+        if not record:
+            raise KeyError(f'{url} not found')
+        result, body = proxy_req({'data': record.data}, self.session(url))
+        return result['data'], record.enabled, body
+
+    def write(self, batch: List[Tuple[str, dict, bool, bytes]]) -> None:
+        # 和录制走同一个队列，避免被之前未提交的录制覆盖
+        for url, data, enabled, body in batch:
+            recorder.put(url, data, enabled, body)
+            mock_index.invalidate(url)
+        recorder.flush()
+
+    async def run(self, urls: Iterable[str]) -> List[Tuple[str, str]]:
+        """
+        刷新全部url，返回失败的(url, 错误信息)
+        """
+        urls = list(urls)
+        total = len(urls)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='softmock refresh')
+        pending = iter(urls)
+        batch: List[Tuple[str, dict, bool, bytes]] = []
+        errors: List[Tuple[str, str]] = []
+        done = 0
+
+        async def worker():
+            nonlocal done, batch
+            for url in pending:
+                error = None
+                try:
+                    batch.append((url, *await loop.run_in_executor(executor, self.fetch, url)))
+                except Exception as e:
+                    error = str(e)
+                    errors.append((url, error))
+                done += 1
+                if len(batch) >= self.batch_size:
+                    items, batch = batch, []
+                    await loop.run_in_executor(executor, self.write, items)
+                if self.progress:
+                    self.progress(done, total, url, error)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, total))))
+            if batch:
+                await loop.run_in_executor(executor, self.write, batch)
+        finally:
+            executor.shutdown(wait=False)
+        return errors
@@ -0,0 +1,166 @@
+"""
+路由模板匹配
+
+模板与普通mock记录一样保存在Mock表中，key的path部分包含模板语法：
+
+    /users/{id}           {name} 匹配任意一段
+    /users/{id:\\d+}       {name:regex} 整段匹配正则
+    /static/*.js          包含*或?的段按glob匹配
+    /files/**             ** 匹配零段或多段
+
+method为*时匹配任意method。
+记录的data中可以带match，进一步限制请求的query/header/body：
+
+    {"match": {"query": {"type": "vip"}, "headers": {"x-env": "test*"}, "body": "keyword"}}
+
+query/header的值包含*时按glob匹配，否则需要完全相同；body为包含关系。
+
+所有模板编译成按段索引的前缀树，普通段直接字典查找，
+同一位置上相同的{name}/正则/glob共用一个节点，查找开销不随模板数量增长。
+优先级：普通段 > 正则/glob段 > {name} > **，精确的mock记录优先于所有模板。
+"""
+import fnmatch
+import re
+from typing import Dict, List, Optional, Tuple
+
+from softmock.database import split_url
+
+
+def _segments(path: str) -> List[str]:
+    return [i for i in path.split('/') if i]
+
+
+class Node:
+    __slots__ = ('literals', 'matchers', 'param', 'wildcard', 'routes')
+
+    def __init__(self) -> None:
+        self.literals: Dict[str, Node] = {}
+        # (原始段文本, 编译后的正则, 子节点)
+        self.matchers: List[Tuple[str, re.Pattern, Node]] = []
+        self.param: Optional[Node] = None
+        self.wildcard: Optional[Node] = None
+        self.routes: List[Route] = []
+
+    def child(self, segment: str) -> "Node":
+        if segment == '**':
+            if self.wildcard is None:
+                self.wildcard = Node()
+            return self.wildcard
+        if segment.startswith('{') and segment.endswith('}'):
+            _, _, regex = segment[1:-1].partition(':')
+            if not regex:
+                if self.param is None:
+                    self.param = Node()
+                return self.param
+            return self._matcher(segment, re.compile(regex))
+        if '*' in segment or '?' in segment:
+            return self._matcher(segment, re.compile(fnmatch.translate(segment)))
+        if segment not in self.literals:
+            self.literals[segment] = Node()
+        return self.literals[segment]
+
+    def _matcher(self, segment: str, regex: re.Pattern) -> "Node":
+        for text, _, node in self.matchers:
+            if text == segment:
+                return node
+        node = Node()
+        self.matchers.append((segment, regex, node))
+        return node
+
+    def match(self, segments: List[str], index: int, request) -> Optional["Route"]:
+        if index == len(segments):
+            for route in self.routes:
+                if route.accepts(request):
+                    return route
+            if self.wildcard is not None:
+                return self.wildcard.match(segments, index, request)
+            return None
+        segment = segments[index]
+        node = self.literals.get(segment, None)
+        if node is not None:
+            route = node.match(segments, index + 1, request)
+            if route:
+                return route
+        for _, regex, node in self.matchers:
+            if regex.fullmatch(segment):
+                route = node.match(segments, index + 1, request)
+                if route:
+                    return route
+        if self.param is not None:
+            route = self.param.match(segments, index + 1, request)
+            if route:
+                return route
+        if self.wildcard is not None:
+            # ** 依次尝试吃掉0..n段
+            for i in range(index, len(segments) + 1):
+                route = self.wildcard.match(segments, i, request)
+                if route:
+                    return route
+        return None
+
+
+def _value_match(expected, actual) -> bool:
+    if actual is None:
+        return False
+    expected = str(expected)
+    if '*' in expected:
+        return fnmatch.fnmatchcase(actual, expected)
+    return actual == expected
+
+
+class Route:
+    __slots__ = ('url', 'entry', 'query', 'headers', 'body')
+
+    def __init__(self, url: str, entry, match: Optional[dict] = None) -> None:
+        match = match or {}
+        self.url = url
+        self.entry = entry
+        self.query = match.get('query', None) or {}
+        self.headers = match.get('headers', None) or {}
+        body = match.get('body', None)
+        self.body = body.encode() if isinstance(body, str) else body
+
+    @property
+    def predicates(self) -> int:
+        return len(self.query) + len(self.headers) + (1 if self.body else 0)
+
+    def accepts(self, request) -> bool:
+        for key, value in self.query.items():
+            if not _value_match(value, request.query.get(key, None)):
+                return False
+        for key, value in self.headers.items():
+            if not _value_match(value, request.headers.get(key, None)):
+                return False
+        if self.body and self.body not in (request.raw_content or b''):
+            return False
+        return True
+
+
+class RouteTable:
+    def __init__(self) -> None:
+        # (scheme, host, method) -> 前缀树
+        self.roots: Dict[Tuple[str, str, str], Node] = {}
+
+    def add(self, route: Route) -> None:
+        scheme, host, path, method = split_url(route.url)
+        key = (scheme, host, method.upper())
+        if key not in self.roots:
+            self.roots[key] = Node()
+        node = self.roots[key]
+        for segment in _segments(path):
+            node = node.child(segment)
+        node.routes.append(route)
+        # 条件越多越具体，优先匹配
+        node.routes.sort(key=lambda i: -i.predicates)
+
+    def match(self, request) -> Optional[Route]:
+        if not self.roots:
+            return None
+        segments = _segments(request.path.split('?')[0])
+        for method in (request.method, '*'):
+            root = self.roots.get((request.scheme, request.host, method), None)
+            if root is not None:
+                route = root.match(segments, 0, request)
+                if route:
+                    return route
+        return None
@@ -0,0 +1,308 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from softmock.database import (
+    database, ensure_schema, MOCK_COLUMNS, MOCK_PLACEHOLDERS, mock_row, load_mock, body_to_html, format_status
+)
+
+"""
+所有sql都是固定文本，sqlite3按连接缓存预编译语句，连接复用后语句也随之复用
+"""
+SQL_GET = "select `url`, `enabled`, `meta`, `body` from Mock where url=?"
+SQL_GET_META = "select `url`, `enabled`, `meta`, NULL from Mock where url=?"
+SQL_LIST = "select `url`, `enabled`, `meta`, `body` from Mock where host like ?"
+SQL_LIST_META = "select `url`, `enabled`, `meta`, NULL from Mock where host like ?"
+SQL_INSERT = f"insert into Mock ({MOCK_COLUMNS}) values ({MOCK_PLACEHOLDERS})"
+SQL_UPSERT = SQL_INSERT + (
+    " on conflict(`url`) do update set"
+    " `status_code`=excluded.`status_code`, `meta`=excluded.`meta`, `body`=excluded.`body`"
+)
+SQL_UPSERT_ENABLED = SQL_UPSERT + ", `enabled`=excluded.`enabled`"
+SQL_PATTERNS = "select `url`, `enabled`, `meta`, `body` from Mock where `pattern`=1 and `enabled`=1"
+SQL_RESERVE_BODY = "update Mock set `body`=zeroblob(?) where url=?"
+SQL_SET_BODY = "update Mock set `body`=? where url=?"
+SQL_ROWID = "select rowid from Mock where url=?"
+SQL_SET_ENABLED = "update Mock set `enabled`=? where url=?"
+SQL_DELETE = "delete from Mock where url=?"
+SQL_CLEAR = "delete from Mock where host like ?"
+SQL_VERSION = "select `rev` from Revision"
+SQL_DELETED = "select `url` from MockDeleted where `rev` > ? order by `rev`"
+
+"""
+列表使用的摘要字段，全部来自带索引的列或meta中的少量字段，不读取body
+"""
+SUMMARY_COLUMNS = (
+    "Mock.rowid, `rev`, `id`, `url`, `scheme`, `host`, `path`, `method`, `status_code`, `enabled`, "
+    "json_extract(`meta`, '$.request.aliasName'), length(`body`)"
+)
+
+
+@dataclass
+class MockRecord:
+    url: str
+    enabled: bool
+    data: dict
+    # 原始响应body，不经过base64/文本转换
+    body: Optional[bytes] = None
+
+    def to_json(self) -> dict:
+        """
+        前端使用的json，响应body在这里才转换为html
+        """
+        data = self.data
+        response = data.get('response', None)
+        if response is not None:
+            response = dict(response)
+            response['html'] = body_to_html(response, self.body)
+            data = {**data, 'response': response}
+        return {**data, "status": format_status(self.enabled)}
+
+
+def is_chunked(body) -> bool:
+    """
+    body除了bytes之外，也可以是带size属性和chunks()方法的对象
+    （见mitmproxy.addons.streambodies.Tee），写入时按块复制，不在内存中拼接
+    """
+    return body is not None and not isinstance(body, (bytes, bytearray, memoryview))
+
+
+def _write_chunked(conn: sqlite3.Connection, url: str, body) -> None:
+    if not hasattr(conn, 'blobopen'):
+        # python3.11之前没有增量写blob的接口
+        conn.execute(SQL_SET_BODY, (b''.join(body.chunks()), url))
+        return
+    conn.execute(SQL_RESERVE_BODY, (body.size, url))
+    rowid = conn.execute(SQL_ROWID, (url,)).fetchone()[0]
+    with conn.blobopen("Mock", "body", rowid) as blob:
+        for chunk in body.chunks():
+            blob.write(chunk)
+
+
+def _summary(row) -> dict:
+    _, rev, id, url, scheme, host, path, method, status_code, enabled, alias_name, content_length = row
+    return {
+        "id": id,
+        "url": url,
+        "scheme": scheme,
+        "host": host,
+        "path": path,
+        "method": method,
+        "status_code": status_code,
+        "status": format_status(enabled),
+        "aliasName": alias_name,
+        "contentLength": content_length,
+        "rev": rev,
+    }
+
+
+def _record(row) -> MockRecord:
+    url, enabled, meta, body = row
+    return MockRecord(url, bool(enabled), load_mock(meta), body)
+
+
+class MockStore:
+    """
+    mock数据的统一存取入口
+
+    维护一个小的连接池，代理线程和tornado的handler共用，
+    数据库使用WAL模式，读操作不会被录制时的写操作阻塞
+    """
+
+    def __init__(self, path: str = database, size: int = 4) -> None:
+        self.path = path
+        self.size = size
+        self.pool: queue.LifoQueue = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.ready = False
+        self.schema_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, check_same_thread=False, cached_statements=64)
+        conn.execute("pragma journal_mode=WAL")
+        # WAL模式下NORMAL不会损坏数据库，只是断电时可能丢失最后几次提交
+        conn.execute("pragma synchronous=NORMAL")
+        conn.execute("pragma cache_size=-16000")
+        conn.execute("pragma temp_store=MEMORY")
+        with self.schema_lock:
+            if not self.ready:
+                ensure_schema(conn)
+                self.ready = True
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        从连接池借出一个连接，正常退出时提交，出错时回滚
+        """
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                new = self.created < self.size
+                if new:
+                    self.created += 1
+            if new:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                conn = self.pool.get()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.put(conn)
+
+    def open(self) -> None:
+        """
+        提前建立第一个连接，同时完成表结构的创建/迁移
+        """
+        with self.connection():
+            pass
+
+    def close(self) -> None:
+        with self.lock:
+            while True:
+                try:
+                    conn = self.pool.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self.created -= 1
+
+    def get(self, url: str, with_body: bool = True) -> Optional[MockRecord]:
+        with self.connection() as conn:
+            row = conn.execute(SQL_GET if with_body else SQL_GET_META, (url,)).fetchone()
+        return _record(row) if row else None
+
+    def list(self, host: str = '', with_body: bool = True) -> List[MockRecord]:
+        with self.connection() as conn:
+            rows = conn.execute(SQL_LIST if with_body else SQL_LIST_META, (f'%{host}%',)).fetchall()
+        return [_record(row) for row in rows]
+
+    def patterns(self) -> List[MockRecord]:
+        """
+        所有启用的路由模板
+        """
+        with self.connection() as conn:
+            rows = conn.execute(SQL_PATTERNS).fetchall()
+        return [_record(row) for row in rows]
+
+    def page(
+        self,
+        host: str = '',
+        method: Optional[str] = None,
+        path: Optional[str] = None,
+        status_code: Optional[int] = None,
+        cursor: Optional[int] = None,
+        since: Optional[int] = None,
+        limit: int = 100,
+        summary: bool = True,
+    ) -> Tuple[list, Optional[int]]:
+        """
+        分页读取，返回(本页数据, 下一页的cursor)，没有下一页时cursor为None
+
+        指定since时只返回版本号大于since的记录，按版本号排序，cursor为版本号；
+        否则按写入顺序排序，cursor为rowid
+        summary为True时返回不含body的摘要，否则返回MockRecord
+        """
+        key = "`rev`" if since is not None else "Mock.rowid"
+        where = ["host like ?"]
+        args: list = [f'%{host}%']
+        if method:
+            where.append("method = ?")
+            args.append(method.upper())
+        if path:
+            where.append("path like ?")
+            args.append(f'%{path}%')
+        if status_code is not None:
+            where.append("status_code = ?")
+            args.append(status_code)
+        if since is not None:
+            where.append(f"{key} > ?")
+            args.append(since)
+        if cursor is not None:
+            where.append(f"{key} > ?")
+            args.append(cursor)
+        columns = SUMMARY_COLUMNS if summary else f"{key}, `url`, `enabled`, `meta`, `body`"
+        sql = f"select {columns} from Mock where {' and '.join(where)} order by {key} limit ?"
+        # 多取一条用来判断是否还有下一页
+        args.append(limit + 1)
+        with self.connection() as conn:
+            rows = conn.execute(sql, args).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = None
+        if more:
+            next_cursor = rows[-1][1] if summary and since is not None else rows[-1][0]
+        if summary:
+            return [_summary(row) for row in rows], next_cursor
+        return [_record(row[1:]) for row in rows], next_cursor
+
+    def version(self) -> int:
+        with self.connection() as conn:
+            return conn.execute(SQL_VERSION).fetchone()[0]
+
+    def deleted(self, since: int) -> List[str]:
+        """
+        版本号since之后被删除的记录的url
+        """
+        with self.connection() as conn:
+            return [i[0] for i in conn.execute(SQL_DELETED, (since,))]
+
+    def put(self, url: str, data: dict, enabled: Optional[bool] = None, body: Optional[bytes] = None) -> None:
+        """
+        新增或更新记录，enabled为None时保留原来的状态（新记录默认启用），
+        body为None时由data中的html还原
+        """
+        chunked = is_chunked(body)
+        row = mock_row(url, data, True if enabled is None else enabled, b'' if chunked else body)
+        with self.connection() as conn:
+            conn.execute(SQL_UPSERT if enabled is None else SQL_UPSERT_ENABLED, row)
+            if chunked:
+                _write_chunked(conn, url, body)
+
+    def put_many(self, items) -> None:
+        """
+        在一个事务里批量写入(url, data, body)，记录原有的启用状态保持不变
+        """
+        chunked = []
+
+        def rows():
+            for url, data, body in items:
+                if is_chunked(body):
+                    chunked.append((url, body))
+                    body = b''
+                yield mock_row(url, data, True, body)
+
+        with self.connection() as conn:
+            conn.executemany(SQL_UPSERT, rows())
+            for url, body in chunked:
+                _write_chunked(conn, url, body)
+
+    def set_enabled(self, url: str, enabled: bool) -> None:
+        with self.connection() as conn:
+            conn.execute(SQL_SET_ENABLED, (int(enabled), url))
+
+    def delete(self, url: str) -> None:
+        with self.connection() as conn:
+            conn.execute(SQL_DELETE, (url,))
+
+    def clear(self, host: str = '') -> None:
+        with self.connection() as conn:
+            conn.execute(SQL_CLEAR, (f'%{host}%',))
+
+
+store = MockStore()